@@ -0,0 +1,336 @@
+import io
+import os
+import glob
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import main
+
+# ==========================================
+# ⏱️ 离线基准测试 (合成数据，不联网)
+# 用法:
+#   python bench.py                      全部跑一遍，结果追加到 bench_results.jsonl
+#   python bench.py --quick              只跑小规模
+#   python bench.py --fixtures fixtures  额外用录制下来的 FedWatch / ApeWisdom 页面
+#   python bench.py --processes 4        额外测多进程分片的扩展性
+# ==========================================
+
+# 股票数 × 年数
+BENCH_SIZES = [(100, 2), (100, 10), (500, 2), (500, 5), (500, 10), (3000, 2), (3000, 5), (3000, 10)]
+QUICK_SIZES = [(100, 2), (500, 2)]
+SECTORS = ["Information Technology", "Health Care", "Financials", "Consumer Discretionary",
+           "Communication Services", "Industrials", "Consumer Staples", "Energy",
+           "Utilities", "Real Estate", "Materials"]
+
+RESULTS = []
+
+def make_closes(days=504, n_tickers=500, seed=42):
+    """
+    生成合成收盘价矩阵 (交易日 × 股票)，带少量缺失值模拟新上市/停牌
+    """
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.0003, 0.015, size=(days, n_tickers))
+    values = (100 * np.exp(np.cumsum(returns, axis=0))).astype('float32')
+    # 约 5% 的股票前 60 天没有数据 (新上市)
+    late = rng.choice(n_tickers, size=max(1, n_tickers // 20), replace=False)
+    values[:60, late] = np.nan
+    index = pd.bdate_range(end="2026-10-16", periods=days)
+    columns = [f"T{i:04d}" for i in range(n_tickers)]
+    return pd.DataFrame(values, index=index, columns=columns)
+
+def make_universes(tickers, seed=42):
+    """
+    合成指数: 标普 = 前 50%，纳指 = 随机 20%，罗素 = 全部；标普成分股轮流分到 11 个行业
+    """
+    rng = np.random.default_rng(seed)
+    sp = tickers[:max(1, len(tickers) // 2)]
+    ndx = sorted(rng.choice(tickers, size=max(1, len(tickers) // 5), replace=False))
+    return {
+        "sp500": {"members": [{"symbol": t, "sector": SECTORS[i % len(SECTORS)]} for i, t in enumerate(sp)], "history": []},
+        "nasdaq100": {"members": [{"symbol": t, "sector": None} for t in ndx], "history": []},
+        "russell1000": {"members": [{"symbol": t, "sector": None} for t in tickers], "history": []},
+    }
+
+def make_fedwatch_html(filler_kb=300, seed=42):
+    """
+    合成 FedWatch 页面: 真实页面大部分是脚本 / 广告 / 页脚，概率表只有几行
+    """
+    rng = np.random.default_rng(seed)
+    probs = rng.dirichlet(np.ones(6)) * 100
+    rows = "".join(
+        f"<tr><td>{3.0 + i * 0.25:.2f} - {3.25 + i * 0.25:.2f}</td><td>{p:.1f}%</td><td>{p * 0.9:.1f}%</td></tr>"
+        for i, p in enumerate(probs)
+    )
+    block = "<div class='ad'><span>Markets</span> <a href='#'>Quotes</a> <p>" + "lorem ipsum " * 20 + "</p></div>\n"
+    filler = block * max(1, filler_kb * 1024 // len(block))
+    script = "<script>var cfg = {" + ",".join(f'"k{i}": {i}' for i in range(2000)) + "};</script>"
+    return (
+        f"<html><head>{script}<style>.a{{color:red}}</style></head><body>"
+        f"<header><nav>{block * 3}</nav></header>"
+        "<h1>Fed Rate Monitor Tool</h1>"
+        "<div class='info'><div><span>Meeting Time:</span> <span>Dec 10, 2026 02:00PM ET</span></div></div>"
+        "<div class='rate'><span>Current Fed Rate</span>: <b>4.00 - 4.25</b></div>"
+        "<table class='fedRateTbl'><thead><tr><th>Target Rate</th><th>Current</th><th>Previous Day</th></tr></thead>"
+        f"<tbody>{rows}</tbody></table>"
+        f"<footer>{filler}</footer></body></html>"
+    )
+
+def make_apewisdom_results(n=1000, seed=42):
+    """
+    合成 ApeWisdom 完整榜单 (按排名排序)
+    """
+    rng = np.random.default_rng(seed)
+    mentions = np.sort(rng.pareto(1.2, n) * 20 + 1)[::-1].astype(int)
+    return [
+        {"rank": i + 1, "ticker": f"R{i:04d}", "name": f"Company &amp; Co {i}",
+         "mentions": int(m), "upvotes": int(m * 3), "rank_24h_ago": int(rng.integers(0, n))}
+        for i, m in enumerate(mentions)
+    ]
+
+def make_reddit_history(n_tickers=3000, samples=540, seed=42):
+    """
+    合成 Reddit 提及历史 (股票 × 采样点)
+    """
+    rng = np.random.default_rng(seed)
+    mentions = rng.poisson(rng.pareto(1.2, n_tickers)[:, None] * 10 + 1, size=(n_tickers, samples)).astype('int32')
+    rank = (np.argsort(np.argsort(-mentions, axis=0), axis=0) + 1).astype('int16')
+    times = 1_700_000_000 + np.arange(samples, dtype='int64') * 4 * 3600
+    return main.RedditHistory([f"R{i:04d}" for i in range(n_tickers)], times, mentions, rank, path=os.devnull)
+
+def measure(name, fn, repeat=5, **params):
+    """
+    运行 repeat 次 (函数内部的 print 被屏蔽)，返回最短耗时 (秒) 和最后一次结果；最短 / 中位耗时记入 RESULTS
+    """
+    times, result = [], None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - t0)
+    RESULTS.append({"name": name, "params": params, "repeat": repeat,
+                    "best_s": round(min(times), 6), "median_s": round(statistics.median(times), 6)})
+    return min(times), result
+
+def bench_breadth_engines(days=504, n_tickers=500):
+    closes = make_closes(days, n_tickers)
+    print(f"📊 广度计算: {n_tickers} 只股票 × {days} 天")
+
+    t_batch, batch = measure("breadth.engine", lambda: main.compute_breadth_pandas(closes), engine="batch", tickers=n_tickers, days=days)
+    t_vec, vec = measure("breadth.engine", lambda: main.compute_breadth_vectorized(closes), engine="vectorized", tickers=n_tickers, days=days)
+
+    diff = max(np.nanmax(np.abs(batch[w].values - vec[w].values)) for w in main.BREADTH_WINDOWS)
+    print(f"   batch (pandas 分批): {t_batch * 1000:8.1f} ms")
+    print(f"   vectorized (矩阵)  : {t_vec * 1000:8.1f} ms  (x{t_batch / t_vec:.1f})")
+    print(f"   结果最大偏差: {diff:.6f} 个百分点")
+
+def bench_breadth_compute(sizes, repeat=3):
+    """
+    run_breadth_task 的计算核心: compute_breadth (3 个指数 + 11 个行业，全部均线)
+    """
+    print(f"📊 广度计算核心 (compute_breadth, 引擎 {main.BREADTH_ENGINE}):")
+    for n_tickers, years in sizes:
+        days = 252 * years
+        closes = make_closes(days, n_tickers)
+        universes = make_universes(list(closes.columns))
+        t, _ = measure("breadth.compute", lambda: main.compute_breadth(closes, universes), repeat=repeat,
+                       tickers=n_tickers, years=years, engine=main.BREADTH_ENGINE)
+        print(f"   {n_tickers:5d} 只 × {years:2d} 年: {t * 1000:9.1f} ms")
+        del closes
+
+def bench_breadth_sharded(processes, n_tickers=3000, years=10, repeat=3):
+    """
+    多进程分片的扩展性: 同一份数据 1 进程 vs processes 进程 (进程池先预热，不计启动开销)
+    """
+    closes = make_closes(252 * years, n_tickers)
+    universes = make_universes(list(closes.columns))
+    print(f"🧩 多进程分片 ({n_tickers} 只 × {years} 年，{os.cpu_count()} 核):")
+    main.BREADTH_SHARD_MIN_TICKERS = 1
+    baseline = None
+    for p in sorted({1, processes}):
+        main.BREADTH_PROCESSES = p
+        if p > 1:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main.compute_breadth(closes, universes)
+        t, _ = measure("breadth.sharded", lambda: main.compute_breadth(closes, universes), repeat=repeat,
+                       tickers=n_tickers, years=years, processes=p)
+        baseline = baseline or t
+        print(f"   {p:2d} 进程: {t * 1000:9.1f} ms  (x{baseline / t:.2f})")
+    main.BREADTH_PROCESSES = 0
+
+def bench_intraday(n_tickers=3000, repeat=10):
+    """
+    盘中广度: 每天一次的门槛价准备 vs 每次刷新的向量比较 (不含快照下载)
+    """
+    closes = make_closes(252, n_tickers)
+    tickers = list(closes.columns)
+    session = closes.index[-1]
+    state = main.IntradayBreadth()
+    print(f"⚡ 盘中广度 ({n_tickers} 只):")
+    t, _ = measure("breadth.intraday.prepare", lambda: state.prepare(closes, tickers, session), repeat=repeat, tickers=n_tickers)
+    print(f"   准备 (每天一次): {t * 1000:8.2f} ms")
+    prices = closes.iloc[-1]
+    t, (pct, _) = measure("breadth.intraday.evaluate", lambda: state.evaluate(prices), repeat=repeat * 10, tickers=n_tickers)
+    print(f"   刷新 (每次)    : {t * 1000:8.3f} ms")
+    full = main.compute_breadth_vectorized(closes, windows=main.INTRADAY_WINDOWS)
+    diff = max(abs(full[w].iloc[-1] - pct[w]) for w in main.INTRADAY_WINDOWS)
+    print(f"   和收盘广度偏差: {diff:.6f} 个百分点")
+
+def legacy_chart(b20, b50, b200):
+    """
+    旧的出图方式 (对照组): 每次新建 pyplot 图 + bbox_inches='tight'
+    画的元素和 BreadthChartRenderer 一致 (三条线、填充、阈值线和文字、末值标注、标题、网格、图例)，耗时可直接对比
+    """
+    plt, mdates = main.plt, main.mdates
+    plt.style.use('dark_background')
+    fig, ax = plt.subplots(figsize=(10, 5))
+    fig.patch.set_facecolor('#2b2d31')
+    ax.plot(b20.index, b20.values, color='#f1c40f', linewidth=2, label='Stocks > 20 Day SMA %')
+    ax.plot(b50.index, b50.values, color='#e74c3c', linewidth=2, label='Stocks > 50 Day SMA %')
+    ax.plot(b200.index, b200.values, color='#3498db', linewidth=1.5, label='Stocks > 200 Day SMA %')
+    ax.fill_between(b20.index, b20.values, alpha=0.1, color='#f1c40f')
+
+    ax.axhline(y=80, color='#ff5252', linestyle='--', linewidth=1, alpha=0.8)
+    ax.text(b20.index[0], 81, 'Overbought (80%)', color='#ff5252', fontsize=8)
+    ax.axhline(y=20, color='#448aff', linestyle='--', linewidth=1, alpha=0.8)
+    ax.text(b20.index[0], 21, 'Oversold (20%)', color='#448aff', fontsize=8)
+
+    ax.annotate(f'{b20.iloc[-1]:.1f}%', xy=(b20.index[-1], b20.iloc[-1]), xytext=(-10, 10), textcoords='offset points',
+                color='#f1c40f', fontsize=11, fontweight='bold', ha='right',
+                bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#f1c40f", alpha=0.8))
+    ax.annotate(f'{b50.iloc[-1]:.1f}%', xy=(b50.index[-1], b50.iloc[-1]), xytext=(-10, -20), textcoords='offset points',
+                color='#e74c3c', fontsize=11, fontweight='bold', ha='right',
+                bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#e74c3c", alpha=0.8))
+
+    ax.set_title('S&P 500 Market Breadth (20, 50 & 200 Day SMA)', fontsize=12, color='white', pad=15)
+    ax.set_ylim(0, 100)
+    ax.set_xlim(b20.index[0], b20.index[-1])
+    ax.grid(True, linestyle=':', alpha=0.3)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
+    ax.legend(loc='upper left', frameon=True, facecolor='#2f3136', edgecolor='#2f3136', labelcolor='white')
+
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight', dpi=100, facecolor='#2b2d31')
+    plt.close('all')
+    return buf
+
+def bench_chart_render(days=252):
+    closes = make_closes(days + 200, 500)
+    with contextlib.redirect_stdout(io.StringIO()):
+        series = main.compute_breadth_vectorized(closes)
+    b20, b50, b200 = (series[w].tail(days) for w in (20, 50, 200))
+    print(f"🖼️ 出图: {days} 天")
+
+    t_legacy, buf = measure("chart.render", lambda: legacy_chart(b20, b50, b200), mode="legacy", days=days)
+    print(f"   legacy (pyplot + tight) : {t_legacy * 1000:8.1f} ms  {buf.getbuffer().nbytes / 1024:6.0f} KB")
+
+    renderer = main.BreadthChartRenderer()
+    for encoder in ("matplotlib", "pillow-fast", "pillow-palette"):
+        t, buf = measure("chart.render", lambda: renderer.render(b20, b50, b200, encoder=encoder), mode=encoder, days=days)
+        print(f"   renderer ({encoder:14s}): {t * 1000:8.1f} ms  {buf.getbuffer().nbytes / 1024:6.0f} KB  (x{t_legacy / t:.1f})")
+
+def parse_fed_page(html):
+    """
+    FedWatch 解析热路径: 整页 HTML → 快照 → 头部信息 (利率 / 会议日期) + 概率表
+    """
+    snapshot = main.snapshot_from_html(html)
+    rate, meeting = main.scrape_header_info(None, snapshot["body_text"])
+    return rate, meeting, main.parse_fed_tables(snapshot["tables"])
+
+def bench_fed_parse(fixture_dir=None, repeat=10):
+    pages = [("synthetic-300KB", make_fedwatch_html(300)), ("synthetic-1MB", make_fedwatch_html(1024))]
+    if fixture_dir:
+        for path in sorted(glob.glob(os.path.join(fixture_dir, "fedwatch*.html"))):
+            with open(path, encoding="utf-8") as f:
+                pages.append((os.path.basename(path), f.read()))
+
+    print("🏦 FedWatch 解析 (snapshot_from_html + scrape_header_info + parse_fed_tables):")
+    for label, html in pages:
+        t, (rate, meeting, points) = measure("fed.parse", lambda: parse_fed_page(html), repeat=repeat,
+                                             page=label, kb=len(html) // 1024)
+        print(f"   {label:<24} {len(html) / 1024:7.0f} KB: {t * 1000:8.2f} ms  (利率 {rate}, 会议 {meeting}, {len(points)} 档)")
+
+def bench_reddit(fixture_dir=None, repeat=10):
+    results = make_apewisdom_results(1000)
+    if fixture_dir:
+        recorded = []
+        for path in sorted(glob.glob(os.path.join(fixture_dir, "apewisdom_page*.json"))):
+            with open(path) as f:
+                recorded.extend(json.load(f).get("results", []))
+        if recorded:
+            results = sorted(recorded, key=lambda item: int(item.get("rank") or 10**6))
+
+    print("🔴 Reddit 热度榜:")
+    history = make_reddit_history()
+    t, momentum = measure("reddit.momentum", lambda: main.reddit_momentum(history), repeat=repeat,
+                          tickers=len(history.tickers), samples=len(history.times))
+    print(f"   动量计算 ({len(history.tickers)} 只 × {len(history.times)} 个采样点): {t * 1000:8.2f} ms")
+
+    spikes = main.reddit_spikes(momentum, True)
+    t, _ = measure("reddit.payload", lambda: main.build_reddit_payload(results[:30], spikes), repeat=repeat * 10,
+                   rows=min(30, len(results)))
+    print(f"   Embed 生成 (Top {min(30, len(results))} + {len(spikes)} 条异动): {t * 1000:8.3f} ms")
+
+    def append_samples():
+        h = main.RedditHistory(path=os.devnull)
+        for k in range(30):
+            h.append(1_700_000_000 + k * 4 * 3600, results)
+        return h
+    t, _ = measure("reddit.append", append_samples, repeat=repeat, rows=len(results), samples=30)
+    print(f"   历史追加 ({len(results)} 只 × 30 次采样): {t * 1000:8.2f} ms")
+
+def git_revision():
+    """
+    当前提交号，工作区有改动时加 -dirty
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=cwd).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True, cwd=cwd).stdout.strip()
+        return rev + ("-dirty" if dirty else "") if rev else None
+    except Exception:
+        return None
+
+def save_results(path):
+    """
+    结果追加为一行 JSON (带提交号和运行环境)，方便跨提交对比
+    """
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": RESULTS,
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"💾 {len(RESULTS)} 项结果已写入 {path} (提交 {record['commit']})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线基准测试")
+    parser.add_argument("--quick", action="store_true", help="只跑小规模")
+    parser.add_argument("--fixtures", help="录制的 fixture 目录 (fedwatch*.html / apewisdom_page*.json)")
+    parser.add_argument("--processes", type=int, default=0, help="额外测多进程分片 (进程数)")
+    parser.add_argument("--output", default="bench_results.jsonl", help="结果文件 (JSON Lines，追加写入)")
+    args = parser.parse_args()
+
+    bench_breadth_engines()
+    bench_breadth_compute(QUICK_SIZES if args.quick else BENCH_SIZES)
+    if args.processes > 1:
+        bench_breadth_sharded(args.processes)
+    bench_intraday()
+    bench_chart_render()
+    bench_fed_parse(args.fixtures)
+    bench_reddit(args.fixtures)
+    save_results(args.output)
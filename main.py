@@ -1,27 +1,102 @@
 import time
+_IMPORT_T0 = time.perf_counter()
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import pytz
-import holidays
-import pandas as pd
-import yfinance as yf
 import io
 import json
 import warnings
 import re
 import shutil 
-import matplotlib
-# ⚠️【优化点1】强制使用非交互式后端，大幅节省内存
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 # ⚠️【优化点2】引入垃圾回收机制
 import gc 
-from datetime import datetime, timedelta
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
+import sys
+import uuid
+from collections import deque
+import asyncio
+import bisect
+import importlib
+import atexit
+import hashlib
+import sqlite3
+import resource
+import tempfile
+import multiprocessing
+import random
+import threading
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from datetime import datetime, timedelta, date
+from urllib.parse import parse_qs
+
+# ==========================================
+# 💤 延迟导入 (重依赖第一次用到时才加载)
+# ==========================================
+# pandas / yfinance / matplotlib / selenium 加起来导入要好几秒；
+# 进程启动时只建代理，哪个任务先用到谁就由谁加载 (FedWatch 关闭时永远不会导入 selenium)
+
+IMPORT_TIMINGS = {}   # 模块 → 实际导入耗时 (秒)
+
+class _LazyModule:
+    """
+    模块 (或模块里的某个类) 的占位代理: 第一次访问属性 / 调用时才 import。
+    加载后把本模块里同名的全局变量直接换成真正的对象，之后的访问不再经过代理
+    """
+
+    def __init__(self, module, alias, attr=None, before=None):
+        self._module_name = module
+        self._alias = alias
+        self._attr = attr
+        self._before = before
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    t0 = time.perf_counter()
+                    if self._before: self._before()
+                    target = importlib.import_module(self._module_name)
+                    if self._attr: target = getattr(target, self._attr)
+                    IMPORT_TIMINGS.setdefault(self._module_name, time.perf_counter() - t0)
+                    globals()[self._alias] = target
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        state = "loaded" if self._target is not None else "lazy"
+        return f"<{state} {self._module_name}{'.' + self._attr if self._attr else ''}>"
+
+def _matplotlib_agg():
+    import matplotlib
+    # ⚠️【优化点1】强制使用非交互式后端，大幅节省内存
+    matplotlib.use('Agg')
+
+pd = _LazyModule("pandas", "pd")
+np = _LazyModule("numpy", "np")
+yf = _LazyModule("yfinance", "yf")
+holidays = _LazyModule("holidays", "holidays")
+plt = _LazyModule("matplotlib.pyplot", "plt", before=_matplotlib_agg)
+mpl_style = _LazyModule("matplotlib.style", "mpl_style", before=_matplotlib_agg)
+mdates = _LazyModule("matplotlib.dates", "mdates", before=_matplotlib_agg)
+Figure = _LazyModule("matplotlib.figure", "Figure", attr="Figure", before=_matplotlib_agg)
+FigureCanvasAgg = _LazyModule("matplotlib.backends.backend_agg", "FigureCanvasAgg", attr="FigureCanvasAgg", before=_matplotlib_agg)
+Image = _LazyModule("PIL.Image", "Image")
+lxml_html = _LazyModule("lxml.html", "lxml_html")
+webdriver = _LazyModule("selenium.webdriver", "webdriver")
+Service = _LazyModule("selenium.webdriver.chrome.service", "Service", attr="Service")
+Options = _LazyModule("selenium.webdriver.chrome.options", "Options", attr="Options")
+By = _LazyModule("selenium.webdriver.common.by", "By", attr="By")
+WebDriverWait = _LazyModule("selenium.webdriver.support.ui", "WebDriverWait", attr="WebDriverWait")
 
 # ==========================================
 # ⚙️ 全局配置区
@@ -29,19 +104,79 @@ from selenium.webdriver.common.by import By
 
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") 
 
+# 每个机器人可以单独配置一个或多个 Webhook (逗号分隔)，不配则用 WEBHOOK_URL
+FED_WEBHOOK_URLS = os.getenv("FED_WEBHOOK_URLS")
+BREADTH_WEBHOOK_URLS = os.getenv("BREADTH_WEBHOOK_URLS")
+REDDIT_WEBHOOK_URLS = os.getenv("REDDIT_WEBHOOK_URLS")
+
+# 推送队列: 先落盘再发送，进程重启也不会丢
+OUTBOX_DIR = os.getenv("OUTBOX_DIR", "outbox")
+OUTBOX_MAX_MESSAGES = 200          # 每个 Webhook 最多积压多少条，满了丢最旧的
+OUTBOX_MAX_AGE_HOURS = float(os.getenv("OUTBOX_MAX_AGE_HOURS", "12"))  # 超过这个时间还没发出去的消息直接丢弃，不再迟发
+WEBHOOK_MAX_RETRIES = 6            # 网络错误 / 5xx 最多重试次数 (指数退避)
+WEBHOOK_BUCKET_SIZE = 5            # 令牌桶: Discord Webhook 大约每 2 秒 5 次
+WEBHOOK_REFILL_PER_SEC = 2.5
+
 # ------------------------------------------
 # ⏰ 时间表 (美东时间 ET)
+# 除了 "HH:MM"，也可以写相对当天开盘 / 收盘的时间: "close+00:30"、"open+00:15"
+# (提前收盘的半天交易日自动跟着提前；相对时间只在交易日触发)
 # ------------------------------------------
 
+# NYSE 交易时段 (半天交易日: 7/3、感恩节次日、平安夜 13:00 收盘)
+MARKET_OPEN_TIME = "09:30"
+MARKET_CLOSE_TIME = "16:00"
+MARKET_EARLY_CLOSE_TIME = "13:00"
+
 # 1. FedWatch (美联储观察) 时间点
 FED_SCHEDULE_TIMES = ["08:31", "10:31", "15:01"]
 
-# 2. 市场广度 (Market Breadth) 时间点 (收盘后)
-BREADTH_SCHEDULE_TIME = "16:30"
+# 2. 市场广度 (Market Breadth) 时间点 (收盘后半小时)
+BREADTH_SCHEDULE_TIME = "close+00:30"
 
-# 3. Reddit 热度榜 时间点 (盘前)
+# 3. Reddit 热度榜 时间点 (固定时间，和收盘时间无关)
 REDDIT_SCHEDULE_TIME = "16:42"
 
+# 4. Reddit 提及数采样 (每天都采，包括周末；积累历史用于计算热度动量)
+REDDIT_SAMPLE_TIMES = ["00:00", "04:00", "08:00", "12:00", "16:00", "20:00"]
+
+# 5. 盘中实时广度 (默认关闭): 开盘时段每 N 分钟拉一次最新价快照，跨过情绪档位才推送 (半天交易日收盘后自动跳过)
+INTRADAY_BREADTH = os.getenv("INTRADAY_BREADTH", "0") == "1"
+INTRADAY_INTERVAL_MINUTES = int(os.getenv("INTRADAY_INTERVAL_MINUTES", "10"))
+INTRADAY_START = "09:45"
+INTRADAY_END = "15:55"
+INTRADAY_SNAPSHOT_TIMEOUT = 20   # 快照只请求一次 (不重试、不逐只补抓)，超时就跳过这一轮
+
+# 调度器: 醒来晚了多少秒以内仍然补跑 (超过则记为错过)
+SCHEDULER_MISFIRE_GRACE = 300
+
+# 启动自检: off = 不做；health = 只检查本地状态 (不联网，不导入 pandas 等重依赖)；full = 把各任务完整跑一遍并推送
+SELF_TEST = os.getenv("SELF_TEST", "health")
+
+# 执行器: I/O 任务 (抓取 / 推送) 并发跑；CPU 密集的计算和画图单独排队，避免互相抢内存
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "1"))
+
+# 性能追踪: 每个阶段记录耗时 / CPU / 内存 / 流量
+# TRACE_LOG: "" 关闭 JSON 日志，"-" 打到标准输出，其他值为 JSON Lines 文件路径
+TRACE_LOG = os.getenv("TRACE_LOG", "")
+# METRICS_PORT: 本地 Prometheus 指标端口 (/metrics)，0 = 不开
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# 查询 API (0 = 不开): /breadth /fed /reddit /chart.png /health (+ /metrics)，结果放内存缓存，支持 ETag
+API_PORT = int(os.getenv("API_PORT", "0"))
+# 指标 / 查询 API 没有鉴权，默认只监听本机；确实要对外 (比如容器端口映射) 时设 HTTP_BIND_HOST=0.0.0.0
+HTTP_BIND_HOST = os.getenv("HTTP_BIND_HOST", "127.0.0.1")
+API_CACHE_TTL = 60                     # 广度 / 图表: 每隔多少秒重读一次历史库
+API_FED_MAX_AGE = 15 * 60              # FedWatch 数据超过多久才重新抓取
+API_REDDIT_MAX_AGE = 10 * 60           # Reddit 榜单超过多久才重新抓取
+API_BREADTH_SETTLE_MINUTES = 30        # 收盘后多久还没更新历史库才算过期 (和定时任务 close+00:30 对齐)
+API_RECOMPUTE_COOLDOWN = 30 * 60       # 过期触发的后台重算，两次之间至少间隔 (秒)
+
+# HTTP 连接池: 长连接复用 + 默认超时 + 连接数上限
+HTTP_POOL_SIZE = 10
+HTTP_DEFAULT_TIMEOUT = 20
+
 # ------------------------------------------
 # 🤖 机器人信息配置
 # ------------------------------------------
@@ -51,15 +186,53 @@ ENABLE_FED_BOT = False  # 如果不需要跑Fed，保持False
 FED_BOT_NAME = "CME FedWatch Bot"
 FED_BOT_AVATAR = "https://i.imgur.com/d8KLt6Z.png"
 
+# 常驻浏览器: 复用同一个 Chromium，用够次数或内存涨太多就重启
+FED_BROWSER_MAX_USES = 20
+FED_BROWSER_MAX_RSS_MB = 600
+FED_PAGE_WAIT_SECONDS = 20     # 等概率表出现的最长时间 (替代固定 sleep)
+# html: 一次性取 page_source，用 lxml 本地解析 (默认)
+# webdriver: 逐个元素读 .text (旧模式，每个单元格一次 IPC)
+FED_EXTRACT_MODE = os.getenv("FED_EXTRACT_MODE", "html")
+# auto: 先用普通 HTTP 请求 (不启动浏览器)，解析不到数据才退回 Chromium
+# http: 只用 HTTP；browser: 只用 Chromium
+FED_FETCH_MODE = os.getenv("FED_FETCH_MODE", "auto")
+FED_HTTP_TIMEOUT = 15
+
 # 市场广度 Bot
 BREADTH_BOT_NAME = "标普500 广度日报" 
 BREADTH_BOT_AVATAR = "https://i.imgur.com/Segc5PF.jpeg"
 
+# 图表输出
+# matplotlib: Agg 自带 PNG 编码 (默认)
+# pillow-fast: Pillow 低压缩级别，编码最快，文件稍大
+# pillow-palette: 量化为调色板 PNG，文件最小
+CHART_PNG_ENCODER = os.getenv("CHART_PNG_ENCODER", "matplotlib")
+CHART_MAX_BYTES = int(os.getenv("CHART_MAX_BYTES", 8 * 1024 * 1024))  # Discord 附件上限
+
+# Reddit 提及历史 (npz: 提及数 int32 / 排名 int16，股票 × 采样点)
+REDDIT_HISTORY_PATH = os.getenv("REDDIT_HISTORY_PATH", "reddit_history.npz")
+REDDIT_MAX_PAGES = int(os.getenv("REDDIT_MAX_PAGES", "10"))   # 每页约 100 只股票
+REDDIT_FETCH_WORKERS = 4
+REDDIT_HISTORY_MAX_SAMPLES = 6 * 90       # 约 90 天
+REDDIT_SAMPLE_MIN_GAP = 30 * 60           # 两次采样间隔太近则覆盖上一次 (秒)
+REDDIT_VELOCITY_HOURS = 24                # 提及速度: 和至少 24 小时前的最近一个采样点比 (按时间戳找，不按采样个数)
+REDDIT_ZSCORE_SAMPLES = 42                # 异动基线: 前 42 个采样点 (约 7 天)
+REDDIT_MIN_SAMPLES = 12                   # 历史不足时不算异动
+REDDIT_SPIKE_Z = 3.0
+REDDIT_SPIKE_MIN_MENTIONS = 20
+REDDIT_SPIKE_TOP = 5
+
 # Reddit 热度 Bot (新)
 REDDIT_BOT_NAME = "Stocksera 舆情热度"
 REDDIT_BOT_AVATAR = "https://i.imgur.com/8Qj5X9A.png" # 这里的头像可以使用Reddit Logo
 
-PREV_CUT_PROB = None
+# 发布状态 (持久化): 每个任务上次推送内容的指纹和关键数值，重启后也能判断 "有没有实质变化"
+STATE_PATH = os.getenv("STATE_PATH", "state.json")
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+FED_CHANGE_TOLERANCE = float(os.getenv("FED_CHANGE_TOLERANCE", "0.5"))          # 任一目标利率概率变动超过 (百分点)
+BREADTH_CHANGE_TOLERANCE = float(os.getenv("BREADTH_CHANGE_TOLERANCE", "0.1"))  # 同一交易日广度变动超过 (百分点)
+REDDIT_CHANGE_TOLERANCE = float(os.getenv("REDDIT_CHANGE_TOLERANCE", "0.2"))    # 前 10 名提及数相对变动超过 20%
+REDDIT_CHANGE_TOP = 10
 
 # 【保底策略】万一爬虫抓不到日期/利率
 BACKUP_SCHEDULE = [
@@ -68,6 +241,86 @@ BACKUP_SCHEDULE = [
 ]
 DEFAULT_BACKUP_RATE = 3.50 
 
+# ------------------------------------------
+# 🔌 数据源 (Data Provider)
+# ------------------------------------------
+# live: 真实数据源 (Wikipedia / yfinance / ApeWisdom / investing.com)
+# fixture: 离线回放 FIXTURE_DIR 里录制好的数据，HTTP 部分走进程内的本地服务器
+DATA_PROVIDER = os.getenv("DATA_PROVIDER", "live")
+FIXTURE_DIR = os.getenv("FIXTURE_DIR", "fixtures")
+RECORD_FIXTURES_DIR = os.getenv("RECORD_FIXTURES_DIR")  # 设置后把真实数据录制成 fixture
+
+APEWISDOM_API_URL = os.getenv("APEWISDOM_API_URL", "https://apewisdom.io/api/v1.0/filter/all-stocks/page/{page}")
+FED_MONITOR_URL = os.getenv("FED_MONITOR_URL", "https://www.investing.com/central-banks/fed-rate-monitor")
+
+# ------------------------------------------
+# 📋 成分股缓存 (避免每次都解析整个 Wikipedia 页面)
+# ------------------------------------------
+CONSTITUENTS_CACHE_DIR = os.getenv("CONSTITUENTS_CACHE_DIR", "constituents")   # 每个指数一个 <universe>.json
+CONSTITUENTS_TTL_HOURS = 24        # 超过这个时间才去做一次条件请求 (ETag / Last-Modified)
+# 按历史成分股口径计算广度 (某天只统计当天在指数里的股票)，需配合 vectorized 算法
+BREADTH_POINT_IN_TIME = os.getenv("BREADTH_POINT_IN_TIME", "0") == "1"
+FALLBACK_TICKERS = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'BRK-B', 'LLY', 'AVGO']
+
+# ------------------------------------------
+# 🌍 广度统计范围 (多个指数共用一份价格矩阵)
+# ------------------------------------------
+# sp500 为主指数 (行业广度也基于它的 GICS 行业分类)，其余指数附在报告里
+BREADTH_UNIVERSES = [u.strip() for u in os.getenv("BREADTH_UNIVERSES", "sp500,nasdaq100,russell1000").split(",") if u.strip()]
+UNIVERSE_SOURCES = {
+    "sp500": {"label": "S&P 500", "url": os.getenv("SP500_LIST_URL", "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies")},
+    "nasdaq100": {"label": "Nasdaq-100", "url": "https://en.wikipedia.org/wiki/Nasdaq-100"},
+    "russell1000": {"label": "Russell 1000", "url": "https://en.wikipedia.org/wiki/Russell_1000_Index"},
+}
+BREADTH_SECTOR_WINDOW = 50    # 行业广度用哪条均线
+
+# ------------------------------------------
+# 💾 本地价格库 (增量更新，避免每天重下 2 年数据)
+# ------------------------------------------
+PRICE_STORE_DIR = os.getenv("PRICE_STORE_DIR", "price_store")
+PRICE_HISTORY_PERIOD = "2y"      # 首次建库 / 新股票 的回溯长度
+PRICE_STORE_MAX_DAYS = 520       # 库里最多保留多少个交易日
+PRICE_OVERLAP_DAYS = 7           # 增量下载时向前多取几天 (日历日)，用于校验复权
+PRICE_ADJUST_TOLERANCE = 1e-4    # 重叠区收盘价偏差超过 0.01% 视为发生复权 (含小额分红)，整段重下
+
+# ------------------------------------------
+# 📥 下载调度 (并发 + 限速 + 重试)
+# ------------------------------------------
+FETCH_BATCH_SIZE = 100
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "3"))       # 同时进行的批次数
+FETCH_MAX_RPS = float(os.getenv("FETCH_MAX_RPS", "2"))     # 每秒最多发起几次批次请求
+FETCH_MAX_RETRIES = 3                                       # 每个批次/单只股票最多重试次数
+FETCH_BACKOFF_BASE = 2.0                                    # 指数退避基数 (秒): 2, 4, 8...
+# yfinance 走自己的 curl_cffi 会话，连接池统计不到流量；下载量按返回行数估算 (Yahoo chart 接口未压缩 JSON)
+FETCH_EST_BYTES_PER_ROW = 115                               # 每只股票每天: 时间戳 + OHLC + 复权价 + 成交量
+FETCH_EST_BYTES_PER_TICKER = 1500                           # 每只股票的 meta 等固定开销
+BREADTH_MIN_COVERAGE = 0.95     # 覆盖率低于此值时在报告里显著提示
+BREADTH_ABORT_COVERAGE = 0.50   # 覆盖率低于此值时不发布广度报告
+
+# ------------------------------------------
+# 🧮 广度计算引擎
+# ------------------------------------------
+# batch: 每次全量 pandas rolling (经典模式)
+# vectorized: 全部收盘价放进一个 float32 矩阵，一次累加和算出所有均线
+# streaming: 环形缓冲 + 滑动窗口和，状态落盘，每天只增量更新一行
+BREADTH_ENGINE = os.getenv("BREADTH_ENGINE", "vectorized")
+BREADTH_WINDOWS = (20, 50, 200)
+BREADTH_STATE_PATH = os.getenv("BREADTH_STATE_PATH", "breadth_state.npz")
+# 低内存模式: 设置 RSS 预算 (MB) 后，按预算分块从价格库 memmap 逐批读股票，
+# 每天只保留 int16 计数；下载改为单并发小批次。0 = 关闭 (256MB 的 worker 建议设 200)
+BREADTH_RSS_BUDGET_MB = int(os.getenv("BREADTH_RSS_BUDGET_MB", "0"))
+LOWMEM_FETCH_BATCH_SIZE = 25
+# 多进程分片: 股票按行切成若干片交给进程池，价格矩阵落到 memmap 文件里共享 (不经过 pickle)。
+# 0/1 = 关闭；股票数少于 BREADTH_SHARD_MIN_TICKERS 时不值得开进程，仍走单进程
+BREADTH_PROCESSES = int(os.getenv("BREADTH_PROCESSES", "0"))
+BREADTH_SHARD_MIN_TICKERS = int(os.getenv("BREADTH_SHARD_MIN_TICKERS", "1000"))
+BREADTH_MP_START = os.getenv("BREADTH_MP_START", "forkserver")  # 主进程有很多线程，不用 fork
+# 广度历史库 (SQLite): 每天每个分组每条均线一行 + 每天的样本覆盖
+BREADTH_HISTORY_PATH = os.getenv("BREADTH_HISTORY_PATH", "breadth_history.db")
+# 盘中广度: 只算短均线 (200 日线一天之内几乎不动)；越过档位后要再远离边界这么多个百分点才算穿越，防止来回抖动
+INTRADAY_WINDOWS = (20, 50)
+INTRADAY_BAND_HYSTERESIS = 1.0
+
 # ==========================================
 # 🛠️ 辅助函数
 # ==========================================
@@ -96,11 +349,128 @@ def get_backup_meeting_date():
             return meeting_date
     return "TBD"
 
-def is_market_holiday(now_et):
-    if now_et.weekday() >= 5: return True, "周末休市"
-    us_holidays = holidays.US(years=now_et.year) 
-    if now_et.date() in us_holidays: return True, f"假期: {us_holidays.get(now_et.date())}"
-    return False, None
+ET = pytz.timezone('US/Eastern')
+
+def _as_date(day):
+    return day.date() if isinstance(day, datetime) else day
+
+class TradingCalendar:
+    """
+    NYSE 交易日历 (holidays.NYSE，不是联邦假日: 哥伦布日 / 退伍军人节照常开市):
+    - 第一次查询时一次算好若干年的交易日 → (开盘, 收盘)，按日期 O(1) 查询；查到范围外的年份时再补算
+    - 提前收盘: 7/3、感恩节次日、12/24 (当天是交易日时) 13:00 收盘
+    - next_session / previous_session / last_closed_session 供调度器和数据新鲜度检查共用
+    """
+
+    def __init__(self, years=None):
+        self.lock = threading.Lock()
+        self.open_time = datetime.strptime(MARKET_OPEN_TIME, "%H:%M").time()
+        self.close_time = datetime.strptime(MARKET_CLOSE_TIME, "%H:%M").time()
+        self.early_close_time = datetime.strptime(MARKET_EARLY_CLOSE_TIME, "%H:%M").time()
+        self.years = set()
+        self.holidays = {}
+        self.sessions = {}       # 交易日 → (开盘, 收盘)
+        self.session_list = []   # 有序交易日，给 next / previous 二分查找
+        self.default_years = years
+
+    def _build(self, years):
+        years = sorted(set(years) | self.years)
+        with stage_timer("calendar.build", quiet=True, years=len(years)):
+            holiday_map = dict(holidays.NYSE(years=years).items())
+        sessions = {}
+        for year in years:
+            day = date(year, 1, 1)
+            while day.year == year:
+                if day.weekday() < 5 and day not in holiday_map:
+                    sessions[day] = (self.open_time, self.close_time)
+                day += timedelta(days=1)
+            # 感恩节: 11 月第四个星期四
+            thanksgiving = date(year, 11, 1) + timedelta(days=(3 - date(year, 11, 1).weekday()) % 7 + 21)
+            for early in (date(year, 7, 3), thanksgiving + timedelta(days=1), date(year, 12, 24)):
+                if early in sessions:
+                    sessions[early] = (self.open_time, self.early_close_time)
+        self.holidays = holiday_map
+        self.sessions = sessions
+        self.session_list = sorted(sessions)
+        self.years = set(years)
+
+    def _ensure(self, day):
+        if day.year not in self.years:
+            with self.lock:
+                if day.year not in self.years:
+                    years = set(self.years)
+                    if not years:
+                        this_year = datetime.now(ET).year
+                        years = set(self.default_years or range(this_year - 2, this_year + 3))
+                    years.add(day.year)
+                    self._build(range(min(years), max(years) + 1))
+
+    def is_session(self, day):
+        day = _as_date(day)
+        self._ensure(day)
+        return day in self.sessions
+
+    def holiday_name(self, day):
+        day = _as_date(day)
+        self._ensure(day)
+        return self.holidays.get(day)
+
+    def session_hours(self, day):
+        """
+        (开盘, 收盘) 时间；非交易日返回 None
+        """
+        day = _as_date(day)
+        self._ensure(day)
+        return self.sessions.get(day)
+
+    def is_early_close(self, day):
+        hours = self.session_hours(day)
+        return bool(hours) and hours[1] != self.close_time
+
+    def close_at(self, day):
+        hours = self.session_hours(day)
+        return ET.localize(datetime.combine(_as_date(day), hours[1])) if hours else None
+
+    def is_open(self, now=None):
+        now = (now or datetime.now(ET)).astimezone(ET)
+        hours = self.session_hours(now.date())
+        return bool(hours) and hours[0] <= now.time() < hours[1]
+
+    def next_session(self, day, inclusive=False):
+        """
+        day 之后 (inclusive 时含当天) 的第一个交易日
+        """
+        day = _as_date(day)
+        self._ensure(day)
+        i = (bisect.bisect_left if inclusive else bisect.bisect_right)(self.session_list, day)
+        if i == len(self.session_list):
+            self._ensure(date(day.year + 1, 1, 1))
+            return self.next_session(date(day.year + 1, 1, 1), inclusive=True)
+        return self.session_list[i]
+
+    def previous_session(self, day, inclusive=False):
+        """
+        day 之前 (inclusive 时含当天) 的最后一个交易日
+        """
+        day = _as_date(day)
+        self._ensure(day)
+        i = (bisect.bisect_right if inclusive else bisect.bisect_left)(self.session_list, day)
+        if i == 0:
+            self._ensure(date(day.year - 1, 12, 31))
+            return self.previous_session(date(day.year - 1, 12, 31), inclusive=True)
+        return self.session_list[i - 1]
+
+    def last_closed_session(self, now=None):
+        """
+        最近一个已经收盘的交易日 (收盘价应该已经有了的那一天)
+        """
+        now = (now or datetime.now(ET)).astimezone(ET)
+        close = self.close_at(now.date())
+        if close is not None and now >= close:
+            return now.date()
+        return self.previous_session(now.date())
+
+CALENDAR = TradingCalendar()
 
 def get_bar(p):
     length = 15
@@ -120,355 +490,2755 @@ def format_target_label(target_str, current_rate_base):
         return target_str
 
 # ==========================================
-# 🟢 模块 1: 降息概率 (FedWatch)
+# 📮 Webhook 推送队列 (Outbox)
 # ==========================================
 
-def scrape_header_info(driver, page_text):
-    rate = None
-    meeting_date = None
-    try:
-        rate_match = re.search(r"Current.*?Rate.*?(\d+\.\d+)", page_text, re.IGNORECASE)
-        if rate_match:
-            val = float(rate_match.group(1))
-            if 0.0 <= val <= 10.0: rate = val
-    except: pass
+class TokenBucket:
+    """
+    每个 Webhook 一个令牌桶；收到 Discord 的限流信息时整体暂停到指定时间
+    """
 
-    try:
-        months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-        date_pattern = re.compile(r'(?:' + '|'.join(months) + r')\.?\s+\d{1,2},?\s+\d{4}', re.IGNORECASE)
-        top_text = page_text[:2000]
-        dates_found = date_pattern.findall(top_text)
-        tz = pytz.timezone('US/Eastern')
-        today = datetime.now(tz).date()
+    def __init__(self, capacity=WEBHOOK_BUCKET_SIZE, refill_per_sec=WEBHOOK_REFILL_PER_SEC):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
 
-        for d_str in dates_found:
-            parsed = parse_date_string(d_str)
-            if parsed:
-                p_date = datetime.strptime(parsed, "%Y-%m-%d").date()
-                if p_date >= today:
-                    meeting_date = parsed
-                    break 
-    except: pass
-    return rate, meeting_date
+    def delay(self):
+        """
+        拿一个令牌需要等待的秒数 (0 表示已拿到)
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.refill_per_sec
 
-def get_fed_data():
-    if not ENABLE_FED_BOT:
-        print("⏸️ [系统] FedWatch Bot 已禁用，跳过抓取...")
-        return None
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
 
-    print(f"⚡ 启动 Chromium...")
-    options = Options()
-    options.binary_location = "/usr/bin/chromium" 
-    options.add_argument("--headless=new") 
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    options.add_argument("--disable-gpu")
-    options.add_argument("--disable-blink-features=AutomationControlled")
-    options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64)")
-
-    driver = None
-    result = {"current_base_rate": None, "next_meeting": None, "data": []}
-      
-    try:
-        service = Service("/usr/bin/chromedriver") 
-        driver = webdriver.Chrome(service=service, options=options)
-        driver.set_page_load_timeout(60)
-        driver.get("https://www.investing.com/central-banks/fed-rate-monitor")
-        time.sleep(5) 
-        
-        page_text = driver.find_element(By.TAG_NAME, "body").text
-        scraped_rate, scraped_date = scrape_header_info(driver, page_text)
-        
-        if scraped_rate: result["current_base_rate"] = scraped_rate
-        else: result["current_base_rate"] = DEFAULT_BACKUP_RATE
-            
-        if scraped_date: result["next_meeting"] = scraped_date
-        else: result["next_meeting"] = get_backup_meeting_date()
+def _rate_limit_pause(resp):
+    """
+    从 Discord 响应里读出需要暂停多久 (秒)；None 表示不用暂停
+    """
+    if resp.status_code == 429:
+        try:
+            return float(resp.json().get("retry_after"))
+        except Exception:
+            return float(resp.headers.get("Retry-After", 1))
+    if resp.headers.get("X-RateLimit-Remaining") == "0":
+        try: return float(resp.headers.get("X-RateLimit-Reset-After", 1))
+        except ValueError: return 1.0
+    return None
+
+class WebhookOutbox:
+    """
+    可靠推送:
+    - 每条消息 (含图片附件) 先写进 OUTBOX_DIR/<webhook>/，发送成功才删除，重启后继续发
+    - 每个 Webhook 一个后台线程 + 令牌桶，按顺序发送；多个 Webhook 之间并行
+    - 遵守 429 retry_after / X-RateLimit-* 头；网络错误和 5xx 指数退避重试；其他 4xx 直接丢弃
+    - 队列有上限，积压过多时丢弃最旧的消息；超过 max_age_hours 的消息过期丢弃
+    任务线程只负责入队，不等网络往返
+    """
+
+    def __init__(self, root=None, max_messages=OUTBOX_MAX_MESSAGES, max_retries=WEBHOOK_MAX_RETRIES,
+                 max_age_hours=OUTBOX_MAX_AGE_HOURS):
+        self.root = root or OUTBOX_DIR
+        self.max_messages = max_messages
+        self.max_retries = max_retries
+        self.max_age_s = max_age_hours * 3600
+        self.cond = threading.Condition()
+        self.queues = {}     # key -> deque[消息文件路径]
+        self.urls = {}       # key -> url
+        self.buckets = {}
+        self.workers = {}
+        self.stats = {}
+        self.inflight = set()
+        self.recovered = False
 
-        data_points = []
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode()).hexdigest()[:12]
+
+    def _expired(self, message):
+        return self.max_age_s > 0 and time.time() - message.get("created_at", 0) > self.max_age_s
+
+    def start(self):
+        """
+        进程启动时调用一次: 恢复上次没发完的消息并启动对应的发送线程 (不用等下一次入队)
+        """
+        with self.cond:
+            if not self.recovered:
+                self._recover()
+            self.cond.notify_all()
+
+    def _recover(self):
+        """
+        把上次没发完的消息重新排队 (过期的直接丢弃)
+        """
+        self.recovered = True
+        if not os.path.isdir(self.root): return
+        expired = 0
+        for key in sorted(os.listdir(self.root)):
+            folder = os.path.join(self.root, key)
+            if not os.path.isdir(folder): continue
+            for name in sorted(os.listdir(folder)):
+                if not name.endswith(".json"): continue
+                path = os.path.join(folder, name)
+                try:
+                    with open(path) as f:
+                        message = json.load(f)
+                except Exception:
+                    continue
+                if self._expired(message):
+                    self._discard(path)
+                    expired += 1
+                    continue
+                self._queue_for(message["url"]).append(path)
+        pending = sum(len(q) for q in self.queues.values())
+        if expired:
+            print(f"🗑️ 丢弃 {expired} 条过期的推送 (超过 {self.max_age_s / 3600:.0f} 小时)")
+        if pending:
+            print(f"📮 恢复 {pending} 条未发送的推送")
+        for key in list(self.queues):
+            self._ensure_worker(key)
+
+    def _queue_for(self, url):
+        key = self._key(url)
+        self.urls[key] = url
+        self.buckets.setdefault(key, TokenBucket())
+        self.stats.setdefault(key, {"sent": 0, "retried": 0, "rate_limited": 0, "dropped": 0})
+        return self.queues.setdefault(key, deque())
+
+    def _ensure_worker(self, key):
+        worker = self.workers.get(key)
+        if worker is None or not worker.is_alive():
+            worker = threading.Thread(target=self._worker, args=(key,), daemon=True, name=f"webhook-{key}")
+            self.workers[key] = worker
+            worker.start()
+
+    def enqueue(self, url, payload, files=None):
+        """
+        files: {"file": (文件名, bytes 或 file-like, content_type)}
+        """
+        if not url:
+            print("⚠️ 未配置 Webhook，跳过推送")
+            return None
+        with self.cond:
+            if not self.recovered:
+                self._recover()
+            key = self._key(url)
+            folder = os.path.join(self.root, key)
+            os.makedirs(folder, exist_ok=True)
+            msg_id = f"{time.time_ns()}-{uuid.uuid4().hex[:6]}"
+
+            attachments = []
+            for i, (field, (filename, content, content_type)) in enumerate((files or {}).items()):
+                if hasattr(content, "getvalue"): content = content.getvalue()
+                elif hasattr(content, "read"): content = content.read()
+                blob_path = os.path.join(folder, f"{msg_id}.{i}.bin")
+                with open(blob_path, "wb") as f:
+                    f.write(content)
+                attachments.append({"field": field, "filename": filename, "content_type": content_type, "path": blob_path})
+
+            message = {"url": url, "payload": payload, "files": attachments,
+                       "attempts": 0, "next_attempt_at": 0, "created_at": time.time()}
+            path = os.path.join(folder, f"{msg_id}.json")
+            self._write(path, message)
+
+            queue = self._queue_for(url)
+            queue.append(path)
+            while len(queue) > self.max_messages:
+                # 正在发送的那条不能丢，丢它后面最旧的
+                victim = queue[1] if queue[0] in self.inflight else queue[0]
+                queue.remove(victim)
+                self._discard(victim)
+                self.stats[key]["dropped"] += 1
+                print("⚠️ 推送队列已满，丢弃最旧的一条")
+            self._ensure_worker(key)
+            self.cond.notify_all()
+            return path
+
+    @staticmethod
+    def _write(path, message):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(message, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _discard(path):
         try:
-            tables = driver.find_elements(By.TAG_NAME, "table")
-            target_table = None
-            for tbl in tables:
-                if "%" in tbl.text and len(tbl.find_elements(By.TAG_NAME, "tr")) < 15:
-                    target_table = tbl
-                    break
-            if not target_table and tables: target_table = tables[0]
-
-            if target_table:
-                rows = target_table.find_elements(By.TAG_NAME, "tr")
-                for row in rows:
-                    cols = row.find_elements(By.TAG_NAME, "td")
-                    if len(cols) >= 2:
-                        txt0, txt1 = cols[0].text.strip(), cols[1].text.strip()
-                        try:
-                            if "%" in txt0: prob, target = float(txt0.replace("%", "")), txt1
-                            elif "%" in txt1: prob, target = float(txt1.replace("%", "")), txt0
-                            else: continue
-                            data_points.append({"prob": prob, "target": target})
-                        except: continue
-        except: pass
+            with open(path) as f:
+                message = json.load(f)
+            for att in message.get("files", []):
+                try: os.remove(att["path"])
+                except OSError: pass
+        except Exception:
+            pass
+        try: os.remove(path)
+        except OSError: pass
 
-        if not data_points: return None
-        result["data"] = data_points
-        return result
+    def _send(self, message):
+        if message["files"]:
+            handles = {}
+            try:
+                for att in message["files"]:
+                    handles[att["field"]] = (att["filename"], open(att["path"], "rb"), att["content_type"])
+                return HTTP_SESSION.post(message["url"], data={"payload_json": json.dumps(message["payload"])}, files=handles)
+            finally:
+                for _, fh, _ in handles.values():
+                    fh.close()
+        return HTTP_SESSION.post(message["url"], json=message["payload"])
 
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        return None
-    finally:
-        if driver:
-            try: driver.quit()
-            except: pass
+    def _deliver(self, key, path):
+        """
+        发送一次，返回 "done" / "retry" / "drop"
+        """
+        with open(path) as f:
+            message = json.load(f)
+        if self._expired(message):
+            self.stats[key]["dropped"] += 1
+            print("🗑️ 推送已过期 (一直没发出去)，丢弃")
+            return "drop"
+        wait_s = message["next_attempt_at"] - time.time()
+        if wait_s > 0:
+            time.sleep(min(wait_s, 30))
+            return "wait"
+        bucket, stats = self.buckets[key], self.stats[key]
+        delay = bucket.delay()
+        while delay > 0:
+            time.sleep(delay)
+            delay = bucket.delay()
 
-def send_fed_embed(data):
-    global PREV_CUT_PROB
-    if not data or not data['data']: return
-    
-    base_rate = data.get("current_base_rate")
-    next_meeting_date = data.get("next_meeting")
-    
-    current_cut_prob = 0.0
-    target_cut_lower = base_rate - 0.25
-    
-    cut_item = None
-    rest_items = []
-    
-    for item in data['data']:
         try:
-            lower = float(item['target'].split('-')[0].strip())
-            if abs(lower - target_cut_lower) <= 0.05:
-                cut_item = item
-                current_cut_prob = item['prob']
-            else:
-                rest_items.append(item)
-        except:
-            rest_items.append(item)
-    
-    delta = 0.0
-    if PREV_CUT_PROB is not None:
-        delta = current_cut_prob - PREV_CUT_PROB
-    PREV_CUT_PROB = current_cut_prob
-    
-    trend_title = "📉 降息趋势变动"
-    if not cut_item and current_cut_prob == 0: trend_text = "无降息预期"
-    elif delta > 0.1: trend_text = f"概率上升 +{delta:.1f}% 🔥"
-    elif delta < -0.1: trend_text = f"概率下降 {delta:.1f}% ❄️"
-    else: trend_text = "稳定"
+            with stage_timer("webhook.deliver", quiet=True, webhook=key, attempt=message["attempts"] + 1):
+                resp = self._send(message)
+        except Exception as e:
+            resp, error = None, e
 
-    display_list = []
-    if cut_item: display_list.append(cut_item)
-    if rest_items:
-        rest_items.sort(key=lambda x: x['prob'], reverse=True)
-        display_list.append(rest_items[0])
-    
-    if not display_list:
-        data['data'].sort(key=lambda x: x['prob'], reverse=True)
-        display_list = data['data'][:2]
+        if resp is not None:
+            pause = _rate_limit_pause(resp)
+            if pause:
+                bucket.pause(pause)
+            if 200 <= resp.status_code < 300:
+                stats["sent"] += 1
+                return "done"
+            if resp.status_code == 429:
+                stats["rate_limited"] += 1
+                print(f"⏳ Webhook 限流，{pause:.1f}s 后重试")
+                return "wait"
+            if 400 <= resp.status_code < 500:
+                stats["dropped"] += 1
+                print(f"❌ Webhook 拒绝 ({resp.status_code})，丢弃: {resp.text[:200]}")
+                return "drop"
+            error = f"HTTP {resp.status_code}"
 
-    all_sorted = sorted(data['data'], key=lambda x: x['prob'], reverse=True)
-    top1_real = all_sorted[0]
-    
-    label1_raw = format_target_label(top1_real['target'], base_rate)
-    if "(维持)" in label1_raw: consensus_short = "⏸️ 维持利率 (Hold)"
-    elif "(降息)" in label1_raw: consensus_short = "📉 降息 (Cut)"
-    else: consensus_short = "📈 加息 (Hike)"
+        message["attempts"] += 1
+        if message["attempts"] > self.max_retries:
+            stats["dropped"] += 1
+            print(f"❌ 推送重试 {self.max_retries} 次仍失败，丢弃: {error}")
+            return "drop"
+        backoff = min(300, 2 ** message["attempts"]) * (1 + random.random() * 0.25)
+        message["next_attempt_at"] = time.time() + backoff
+        self._write(path, message)
+        stats["retried"] += 1
+        print(f"⚠️ 推送失败 ({error})，{backoff:.0f}s 后第 {message['attempts']} 次重试")
+        return "retry"
 
-    desc_lines = [f"**🗓️ 下次会议:** `{next_meeting_date}`\n"]
-    
-    for item in display_list:
-        label = format_target_label(item['target'], base_rate)
-        desc_lines.append(f"**目标: {label}**")
-        desc_lines.append(f"`{get_bar(item['prob'])}` **{item['prob']}%**\n")
-    
-    desc_lines.append("\n------------------------")
+    def _worker(self, key):
+        while True:
+            with self.cond:
+                while not self.queues.get(key):
+                    self.cond.wait()
+                path = self.queues[key][0]
+                self.inflight.add(path)
+            try:
+                result = self._deliver(key, path)
+            except Exception as e:
+                print(f"⚠️ 推送线程异常: {e}")
+                result = "drop"
+            with self.cond:
+                self.inflight.discard(path)
+                if result in ("done", "drop"):
+                    if self.queues[key] and self.queues[key][0] == path:
+                        self.queues[key].popleft()
+                    self._discard(path)
+                self.cond.notify_all()
 
-    payload = {
-        "username": FED_BOT_NAME,
-        "avatar_url": FED_BOT_AVATAR,
-        "embeds": [{
-            "title": "🏛️ CME FedWatch™",
-            "description": "\n".join(desc_lines),
-            "color": 0x3498DB,
-            "fields": [
-                {"name": trend_title, "value": trend_text, "inline": True},
-                {"name": "💡 华尔街共识", "value": consensus_short, "inline": True},
-                {"name": "📊 当前基准利率", "value": f"{base_rate}%", "inline": False}
-            ],
-            "footer": {"text": f"Updated at {datetime.now().strftime('%H:%M')} ET | Auto-Scraped"}
-        }]
-    }
-    try: requests.post(WEBHOOK_URL, json=payload)
-    except Exception as e: print(f"❌ 推送失败: {e}")
+    def pending(self):
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def flush(self, timeout=60):
+        """
+        等待队列清空 (单次运行模式退出前用)，返回是否全部发完
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while any(self.queues.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: return False
+                self.cond.wait(remaining)
+        return True
+
+OUTBOX = WebhookOutbox()
+
+def _webhook_urls(specific):
+    urls = [u.strip() for u in (specific or "").split(",") if u.strip()]
+    return urls or [WEBHOOK_URL]
+
+def post_webhook(payload, files=None, urls=None):
+    """
+    把消息放进推送队列 (立即返回)；urls 为逗号分隔的 Webhook 列表，多个 Webhook 并行发送
+    """
+    for url in _webhook_urls(urls):
+        OUTBOX.enqueue(url, payload, files)
 
 # ==========================================
-# 🔵 模块 2: 市场广度 (Market Breadth)
+# 🧾 发布状态 (State Store / 去重)
 # ==========================================
-def generate_breadth_chart(breadth_20_series, breadth_50_series):
-    plt.style.use('dark_background')
-    fig, ax = plt.subplots(figsize=(10, 5))
-    
-    ax.plot(breadth_20_series.index, breadth_20_series.values, color='#f1c40f', linewidth=2, label='Stocks > 20 Day SMA %')
-    ax.plot(breadth_50_series.index, breadth_50_series.values, color='#e74c3c', linewidth=2, label='Stocks > 50 Day SMA %')
-    ax.fill_between(breadth_20_series.index, breadth_20_series.values, alpha=0.1, color='#f1c40f')
-    
-    ax.axhline(y=80, color='#ff5252', linestyle='--', linewidth=1, alpha=0.8)
-    ax.text(breadth_20_series.index[0], 81, 'Overbought (80%)', color='#ff5252', fontsize=8)
-    ax.axhline(y=20, color='#448aff', linestyle='--', linewidth=1, alpha=0.8)
-    ax.text(breadth_20_series.index[0], 21, 'Oversold (20%)', color='#448aff', fontsize=8)
-
-    ax.set_xlim(left=breadth_20_series.index[0], right=breadth_20_series.index[-1])
-
-    last_date = breadth_20_series.index[-1]
-    last_val_20 = breadth_20_series.iloc[-1]
-    last_val_50 = breadth_50_series.iloc[-1]
-
-    ax.annotate(f'{last_val_20:.1f}%', 
-                xy=(last_date, last_val_20), 
-                xytext=(-10, 10), textcoords='offset points',
-                color='#f1c40f', fontsize=11, fontweight='bold', 
-                ha='right', bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#f1c40f", alpha=0.8))
-
-    ax.annotate(f'{last_val_50:.1f}%', 
-                xy=(last_date, last_val_50), 
-                xytext=(-10, -20), textcoords='offset points',
-                color='#e74c3c', fontsize=11, fontweight='bold', 
-                ha='right', bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#e74c3c", alpha=0.8))
-
-    ax.set_title('S&P 500 Market Breadth (20 & 50 Day SMA)', fontsize=12, color='white', pad=15)
-    ax.set_ylim(0, 100)
-    ax.grid(True, linestyle=':', alpha=0.3)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
-    plt.xticks(rotation=0)
-    ax.legend(loc='upper left', frameon=True, facecolor='#2f3136', edgecolor='#2f3136', labelcolor='white')
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', dpi=100, facecolor='#2b2d31')
-    buf.seek(0)
-    plt.close('all') 
-    return buf
 
-def get_market_sentiment(p):
-    if p > 80: return "🔥🔥 **深度火热**"
-    if p > 60: return "🔥 **火热**"      
-    if p < 20: return "❄️❄️ **深度寒冷**"
-    if p < 40: return "❄️ **寒冷**"      
-    return "🍃 **稳定**"     
+def content_hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
 
-def run_breadth_task():
-    print("📊 启动市场广度统计 (极速省钱+对齐修复版)...")
-    
-    # 结果累加器
-    total_above_20 = None
-    total_above_50 = None
-    total_stocks_count = None
+class StateStore:
+    """
+    持久化的发布状态 (state.json): {任务: {"hash", "values", "published_at", ...}}
+    - values: 上次推送时的关键数值，下一次据此算变动 (重启后仍然有效)
+    - 先写临时文件再替换，线程安全
+    - persist=False: 只存在内存里 (离线回放每次从空状态开始，结果可重复)
+    """
+
+    def __init__(self, path=None, persist=True):
+        self.path = path or STATE_PATH
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.data = {}
+        try:
+            if persist and os.path.exists(self.path):
+                with open(self.path) as f:
+                    self.data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ 读取发布状态失败，从空状态开始: {e}")
+
+    def get(self, job):
+        with self.lock:
+            return dict(self.data.get(job) or {})
+
+    def put(self, job, **entry):
+        with self.lock:
+            self.data[job] = dict(self.data.get(job) or {}, **entry)
+            if not self.persist: return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def last_values(self, job):
+        return self.get(job).get("values") or {}
+
+    def changed(self, job, values, tolerance=0.0, rel_tolerance=0.0):
+        """
+        和上次推送的关键数值比较是否有实质变化:
+        - 指纹完全一致 → 没变
+        - 数值: |新 - 旧| > max(tolerance, rel_tolerance × |旧|) 才算变化；其他类型不相等即变化
+        - 键集合不同 (新增 / 消失) 算变化
+        返回 (是否变化, 原因)
+        """
+        if not DEDUP_ENABLED:
+            return True, "去重已关闭"
+        prev = self.get(job)
+        if not prev:
+            return True, "首次推送"
+        if prev.get("hash") == content_hash(values):
+            return False, "内容完全相同"
+        old = prev.get("values") or {}
+        if set(old) != set(values):
+            return True, "项目有增减"
+        for key, new in values.items():
+            before = old[key]
+            if isinstance(new, (int, float)) and isinstance(before, (int, float)) and not isinstance(new, bool):
+                if abs(new - before) > max(tolerance, rel_tolerance * abs(before)):
+                    return True, f"{key}: {before} → {new}"
+            elif new != before:
+                return True, f"{key}: {before} → {new}"
+        return False, "变动在容差内"
+
+    def published(self, job, values, **extra):
+        self.put(job, hash=content_hash(values), values=values,
+                 published_at=datetime.now(ET).isoformat(timespec="seconds"), **extra)
+
+# --once / fixture 数据源是离线回放和基准测试用的，不读写 state.json，否则第二次回放会被去重跳过
+STATE = StateStore(persist=not ("--once" in sys.argv or DATA_PROVIDER == "fixture"))
+
+# ==========================================
+# ⏱️ 性能追踪 (Tracing / Metrics)
+# ==========================================
+
+class Tracer:
+    """
+    轻量追踪: 每个 span 记录墙钟时间、CPU 时间、内存 (结束时 RSS / 进程峰值)、HTTP 收发字节数。
+    - span 按线程嵌套；连接池里的请求字节数记到当前线程所有打开的 span 上
+    - CPU 执行器里跑的部分由 run_cpu 把 CPU 时间补回调用方的 span
+    - 结束的 span 写 JSON 日志 (TRACE_LOG)，并按名字累计，供 /metrics 输出
+    """
+
+    def __init__(self, log_path=None):
+        self.log_path = TRACE_LOG if log_path is None else log_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.aggregates = {}
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, quiet=False, **attrs):
+        record = {"name": name, "attrs": attrs, "bytes_in": 0, "bytes_out": 0, "extra_cpu_s": 0.0}
+        stack = self._stack()
+        stack.append(record)
+        t0, c0 = time.perf_counter(), time.thread_time()
+        error = None
+        try:
+            yield record
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            # 按身份弹出 (dict 的 == 比较内容，remove 可能删错同名的 span)
+            if stack and stack[-1] is record:
+                stack.pop()
+            else:
+                stack[:] = [r for r in stack if r is not record]
+            wall = time.perf_counter() - t0
+            cpu = time.thread_time() - c0 + record.pop("extra_cpu_s")
+            record.update({
+                "ts": datetime.now().isoformat(timespec="seconds"),
+                "wall_s": round(wall, 4), "cpu_s": round(cpu, 4),
+                "rss_mb": round(current_rss_mb(), 1), "peak_rss_mb": round(peak_rss_mb(), 1),
+                "thread": threading.current_thread().name, "error": error,
+            })
+            self._finish(record)
+            if not quiet:
+                print(f"⏱️ [{name}] {wall:.2f}s")
+
+    def add_bytes(self, received=0, sent=0):
+        for record in self._stack():
+            record["bytes_in"] += received
+            record["bytes_out"] += sent
+
+    def add_cpu(self, seconds):
+        for record in self._stack():
+            record["extra_cpu_s"] += seconds
+
+    def _finish(self, record):
+        name = record["name"]
+        with self.lock:
+            agg = self.aggregates.setdefault(name, {
+                "count": 0, "errors": 0, "wall_s": 0.0, "cpu_s": 0.0, "max_wall_s": 0.0,
+                "last_wall_s": 0.0, "bytes_in": 0, "bytes_out": 0,
+            })
+            agg["count"] += 1
+            agg["errors"] += record["error"] is not None
+            agg["wall_s"] += record["wall_s"]
+            agg["cpu_s"] += record["cpu_s"]
+            agg["max_wall_s"] = max(agg["max_wall_s"], record["wall_s"])
+            agg["last_wall_s"] = record["wall_s"]
+            agg["bytes_in"] += record["bytes_in"]
+            agg["bytes_out"] += record["bytes_out"]
+
+        if not self.log_path: return
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        try:
+            if self.log_path == "-":
+                print(line)
+            else:
+                with self.lock, open(self.log_path, "a") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"⚠️ 追踪日志写入失败: {e}")
+
+    def prometheus(self):
+        """
+        Prometheus 文本格式
+        """
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        with self.lock:
+            aggs = {k: dict(v) for k, v in self.aggregates.items()}
+        for field, kind, help_text in (
+            ("count", "counter", "Number of finished spans"),
+            ("errors", "counter", "Number of spans that raised"),
+            ("wall_s", "counter", "Total wall-clock seconds"),
+            ("cpu_s", "counter", "Total CPU seconds"),
+            ("last_wall_s", "gauge", "Wall-clock seconds of the latest span"),
+            ("max_wall_s", "gauge", "Slowest span in seconds"),
+            ("bytes_in", "counter", "HTTP bytes received (pooled session; price download batches are estimated from returned rows)"),
+            ("bytes_out", "counter", "HTTP bytes sent via the pooled session"),
+        ):
+            metric(f"market_stage_{field}", kind, help_text,
+                   [({"stage": name}, round(agg[field], 6)) for name, agg in sorted(aggs.items())])
+
+        metric("market_process_rss_bytes", "gauge", "Current resident memory", [({}, int(current_rss_mb() * 1024 * 1024))])
+        metric("market_process_peak_rss_bytes", "gauge", "Peak resident memory", [({}, int(peak_rss_mb() * 1024 * 1024))])
+
+        if SCHEDULER is not None:
+            stats = SCHEDULER.stats()
+            for field in ("runs", "failures", "skipped_overlap", "missed", "max_jitter_s", "total_duration_s"):
+                metric(f"market_job_{field}", "gauge", f"Scheduler job {field}",
+                       [({"job": name}, st[field]) for name, st in stats.items()])
+
+        with OUTBOX.cond:
+            outbox_stats = {k: dict(v) for k, v in OUTBOX.stats.items()}
+        for field in ("sent", "retried", "rate_limited", "dropped"):
+            metric(f"market_webhook_{field}", "counter", f"Webhook messages {field}",
+                   [({"webhook": key}, st[field]) for key, st in outbox_stats.items()])
+        metric("market_webhook_pending", "gauge", "Messages waiting in the outbox", [({}, OUTBOX.pending())])
+        metric("market_startup_seconds", "gauge", "Startup phase durations",
+               [({"phase": phase}, round(v, 6)) for phase, v in STARTUP_TIMINGS.items()])
+        metric("market_import_seconds", "gauge", "Lazy import durations",
+               [({"module": name}, round(v, 6)) for name, v in sorted(IMPORT_TIMINGS.items())])
+        return "\n".join(lines) + "\n"
+
+TRACER = Tracer()
+SCHEDULER = None  # 主程序启动后赋值，/metrics 用
+
+def stage_timer(name, quiet=False, **attrs):
+    """
+    统计某个阶段 (抓取 / 计算 / 画图 / 推送) 的耗时、CPU、内存和流量；quiet=True 不打印耗时行
+    """
+    return TRACER.span(name, quiet=quiet, **attrs)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = TRACER.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(port=None, handler=None):
+    """
+    后台线程里起一个本地 HTTP 服务，默认只提供 /metrics (handler=ApiHandler 时同时提供查询 API)
+    """
+    port = METRICS_PORT if port is None else port
+    if not port: return None
+    handler = handler or MetricsHandler
+    server = ThreadingHTTPServer((HTTP_BIND_HOST, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name=f"http-{port}").start()
+    print(f"📈 HTTP 服务: http://{HTTP_BIND_HOST}:{server.server_address[1]} ({', '.join(getattr(handler, 'PATHS', ['/metrics']))})")
+    return server
+
+def current_rss_mb():
+    """
+    当前进程常驻内存 (MB)，读 /proc/self/statm，非 Linux 返回 0
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except:
+        return 0.0
+
+def peak_rss_mb():
+    """
+    进程启动以来的峰值常驻内存 (MB)；Linux 上 ru_maxrss 单位是 KB
+    """
+    try:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except:
+        return 0.0
+
+def report_memory(label):
+    peak = peak_rss_mb()
+    print(f"🧠 [{label}] 内存: 当前 {current_rss_mb():.0f}MB，峰值 {peak:.0f}MB"
+          + (f" (预算 {BREADTH_RSS_BUDGET_MB}MB)" if BREADTH_RSS_BUDGET_MB else ""))
+    if BREADTH_RSS_BUDGET_MB and peak > BREADTH_RSS_BUDGET_MB:
+        print(f"⚠️ 峰值内存超出预算 {peak - BREADTH_RSS_BUDGET_MB:.0f}MB")
+
+# ==========================================
+# 🌐 HTTP 连接池
+# ==========================================
+
+class PooledSession(requests.Session):
+    """
+    全进程共享的 HTTP 客户端: keep-alive 连接池，连接数封顶 (满了就排队)，没写 timeout 的请求自动加默认超时
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_DEFAULT_TIMEOUT):
+        super().__init__()
+        self.default_timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+    def send(self, request, **kwargs):
+        resp = super().send(request, **kwargs)
+        # 流量记到当前线程打开的追踪 span 上 (流式响应只看 Content-Length，不提前读正文)
+        sent = len(request.body) if isinstance(request.body, (bytes, str)) else 0
+        if kwargs.get("stream"):
+            received = int(resp.headers.get("Content-Length") or 0)
+        else:
+            received = len(resp.content or b"")
+        TRACER.add_bytes(received, sent)
+        return resp
+
+HTTP_SESSION = PooledSession()
+
+# ==========================================
+# 🧵 执行器 (I/O 与 CPU 分开)
+# ==========================================
+
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+
+def run_cpu(fn, *args, **kwargs):
+    """
+    把 CPU 密集的步骤 (广度计算 / 画图) 交给 CPU 执行器并等待结果；
+    已经在 CPU 线程里时直接调用，避免单线程池自己等自己
+    """
+    if threading.current_thread().name.startswith("cpu"):
+        return fn(*args, **kwargs)
+    cpu = [0.0]
+    def timed():
+        c0 = time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            cpu[0] = time.thread_time() - c0
+    try:
+        return CPU_EXECUTOR.submit(timed).result()
+    finally:
+        # CPU 线程里花的时间算回调用方的追踪 span
+        TRACER.add_cpu(cpu[0])
+
+# FedWatch 各抓取路径的统计: 次数 / 成功 / 累计耗时 / 最近一次耗时
+FED_FETCH_STATS = {}
+
+def _record_fed_fetch(path, ok, elapsed):
+    stats = FED_FETCH_STATS.setdefault(path, {"calls": 0, "ok": 0, "total_s": 0.0, "last_s": 0.0})
+    stats["calls"] += 1
+    stats["ok"] += int(ok)
+    stats["total_s"] += elapsed
+    stats["last_s"] = elapsed
+    print(f"🛰️ FedWatch 路径 [{path}] {'成功' if ok else '无数据'} {elapsed:.2f}s "
+          f"(累计 {stats['ok']}/{stats['calls']})")
+
+# ==========================================
+# 🌐 常驻浏览器 (Browser Session)
+# ==========================================
+
+def _process_tree_rss_mb(root_pid):
+    """
+    统计某进程及其所有子进程的常驻内存 (MB)，读 /proc，非 Linux 返回 0
+    """
+    try:
+        children = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit(): continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # 第 2 个字段 (进程名) 可能含空格，从最后一个 ')' 之后开始切
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except: continue
+
+        total_kb, stack = 0, [root_pid]
+        while stack:
+            pid = stack.pop()
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total_kb += int(line.split()[1])
+                            break
+            except: pass
+            stack.extend(children.get(pid, []))
+        return total_kb / 1024
+    except:
+        return 0.0
+
+class BrowserSession:
+    """
+    常驻的无头 Chromium，多次抓取复用同一个进程:
+    - 使用前做健康检查，挂了就重建
+    - 用满 max_uses 次或内存超过 max_rss_mb 就回收重启，防止泄漏越积越多
+    """
+
+    def __init__(self, max_uses=FED_BROWSER_MAX_USES, max_rss_mb=FED_BROWSER_MAX_RSS_MB):
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self.driver = None
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    def _create(self):
+        print(f"⚡ 启动 Chromium...")
+        options = Options()
+        options.binary_location = "/usr/bin/chromium" 
+        options.add_argument("--headless=new") 
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--disable-blink-features=AutomationControlled")
+        options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64)")
+
+        service = Service("/usr/bin/chromedriver") 
+        driver = webdriver.Chrome(service=service, options=options)
+        driver.set_page_load_timeout(60)
+        return driver
+
+    def _healthy(self):
+        try:
+            return self.driver.execute_script("return 1") == 1
+        except:
+            return False
+
+    def rss_mb(self):
+        try:
+            return _process_tree_rss_mb(self.driver.service.process.pid)
+        except:
+            return 0.0
+
+    def _recycle_reason(self):
+        if self.driver is None: return "首次启动"
+        if self.uses >= self.max_uses: return f"已使用 {self.uses} 次"
+        rss = self.rss_mb()
+        if rss > self.max_rss_mb: return f"内存 {rss:.0f}MB 超限"
+        if not self._healthy(): return "健康检查失败"
+        return None
+
+    def close(self):
+        if self.driver:
+            try: self.driver.quit()
+            except: pass
+        self.driver = None
+
+    @contextmanager
+    def session(self):
+        """
+        借出浏览器 (同一时间只有一个任务使用)；使用中出错则直接回收
+        """
+        with self.lock:
+            reason = self._recycle_reason()
+            if reason:
+                if self.driver: print(f"♻️ 重启 Chromium ({reason})")
+                self.close()
+                self.driver = self._create()
+                self.uses = 0
+            self.uses += 1
+            try:
+                yield self.driver
+            except Exception:
+                self.close()
+                raise
+            finally:
+                # 用完回到空白页，释放页面占用的内存
+                if self.driver:
+                    try: self.driver.get("about:blank")
+                    except: self.close()
+
+    @staticmethod
+    def wait_for_tables(driver, timeout=FED_PAGE_WAIT_SECONDS):
+        """
+        等到页面出现含 % 的表格 (一次 JS 调用判断)，超时也继续，由后续解析决定成败
+        """
+        script = "return Array.from(document.querySelectorAll('table')).some(t => t.innerText.includes('%'))"
+        try:
+            WebDriverWait(driver, timeout, poll_frequency=0.5).until(lambda d: d.execute_script(script))
+        except Exception:
+            print(f"⚠️ {timeout}s 内未等到概率表，按当前页面解析")
+
+FED_BROWSER = BrowserSession()
+atexit.register(FED_BROWSER.close)
+
+# ==========================================
+# 🔌 数据源 (Data Provider)
+# ==========================================
+
+class MarketDataProvider:
+    """
+    真实数据源。所有外部数据都经过这里，方便替换成离线 fixture 做回放和基准测试。
+    """
+    name = "live"
+
+    def get_constituents_page(self, universe, etag=None, last_modified=None):
+        """
+        指数成分股页面 (UNIVERSE_SOURCES)，支持条件请求 (ETag / Last-Modified)。
+        返回 {"status", "text", "etag", "last_modified"}；304 时 text 为 None
+        """
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        if etag: headers['If-None-Match'] = etag
+        if last_modified: headers['If-Modified-Since'] = last_modified
+        resp = HTTP_SESSION.get(UNIVERSE_SOURCES[universe]["url"], headers=headers, timeout=10)
+        if resp.status_code == 304:
+            return {"status": 304, "text": None, "etag": etag, "last_modified": last_modified}
+        resp.raise_for_status()
+        return {
+            "status": resp.status_code,
+            "text": resp.text,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
+
+    def get_closes(self, tickers, **kwargs):
+        """
+        收盘价矩阵 (日期 × 股票)，kwargs 透传给 yf.download (period / start)
+        """
+        return _yf_fetch_batch(tickers, **kwargs)
+
+    def get_last_prices(self, tickers, timeout=None):
+        """
+        盘中最新价快照: 单行 DataFrame (今天 × 股票)
+        """
+        return _yf_fetch_last_prices(tickers, timeout=timeout or INTRADAY_SNAPSHOT_TIMEOUT)
+
+    def get_apewisdom_page(self, page=1):
+        """
+        ApeWisdom 热度榜的一页 (JSON)，失败返回 None
+        """
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+        }
+        response = HTTP_SESSION.get(APEWISDOM_API_URL.format(page=page), headers=headers, timeout=20)
+        if response.status_code == 200:
+            return response.json()
+        print(f"⚠️ ApeWisdom API 错误: {response.status_code}")
+        return None
+
+    def get_fed_snapshot(self):
+        """
+        抓取 FedWatch 页面快照 {"body_text", "tables", "path"}。
+        按 FED_FETCH_MODE 先走轻量 HTTP，拿不到概率表再启动浏览器；每条路径的次数和耗时记入 FED_FETCH_STATS
+        """
+        paths = {"http": ["http"], "browser": ["browser"]}.get(FED_FETCH_MODE, ["http", "browser"])
+        for path in paths:
+            fetch = self.get_fed_snapshot_http if path == "http" else self.get_fed_snapshot_browser
+            t0 = time.perf_counter()
+            snapshot = None
+            try:
+                with stage_timer(f"fed.fetch.{path}", quiet=True):
+                    snapshot = fetch()
+            except Exception as e:
+                print(f"⚠️ FedWatch [{path}] 抓取失败: {e}")
+            ok = bool(snapshot) and bool(parse_fed_tables(snapshot.get("tables", [])))
+            _record_fed_fetch(path, ok, time.perf_counter() - t0)
+            if ok:
+                snapshot["path"] = path
+                return snapshot
+        return None
+
+    def get_fed_snapshot_http(self):
+        """
+        不启动浏览器，直接用连接池 GET 页面再本地解析
+        """
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "en-US,en;q=0.9",
+        }
+        resp = HTTP_SESSION.get(FED_MONITOR_URL, headers=headers, timeout=FED_HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return snapshot_from_html(resp.text)
+
+    def get_fed_snapshot_browser(self):
+        """
+        用 Chromium 打开 FedWatch 页面，返回 {"body_text": 页面文字, "tables": [{"text", "rows"}]}
+        """
+        with ExitStack() as stack:
+            with stage_timer("fed.browser.acquire", quiet=True):
+                driver = stack.enter_context(FED_BROWSER.session())
+            with stage_timer("fed.browser.load", quiet=True):
+                driver.get(FED_MONITOR_URL)
+            with stage_timer("fed.browser.wait", quiet=True):
+                FED_BROWSER.wait_for_tables(driver)
+
+            with stage_timer("fed.browser.extract", quiet=True, mode=FED_EXTRACT_MODE):
+                if FED_EXTRACT_MODE == "html":
+                    # 只跨进程取一次页面源码，其余全部本地解析
+                    return snapshot_from_html(driver.page_source)
+
+                snapshot = {"body_text": driver.find_element(By.TAG_NAME, "body").text, "tables": []}
+                try:
+                    for tbl in driver.find_elements(By.TAG_NAME, "table"):
+                        rows = []
+                        for row in tbl.find_elements(By.TAG_NAME, "tr"):
+                            rows.append([col.text.strip() for col in row.find_elements(By.TAG_NAME, "td")])
+                        snapshot["tables"].append({"text": tbl.text, "rows": rows})
+                except: pass
+                return snapshot
+
+class FixtureProvider(MarketDataProvider):
+    """
+    离线回放: 价格直接读 fixture 文件；
+    Wikipedia / ApeWisdom / FedWatch 仍走 HTTP 代码路径，只是 URL 指向进程内的 FixtureHTTPServer。
+    文件布局:
+      prices.csv          收盘价宽表 (Date × 股票)
+      fedwatch.html       FedWatch 整页 HTML
+      fedwatch.json       get_fed_snapshot 的返回值 (没有整页 HTML 时用)
+      <universe>.html     成分股页面 (sp500.html / nasdaq100.html ...)
+      apewisdom_page1.json
+    """
+    name = "fixture"
+
+    def __init__(self, fixture_dir=None):
+        self.fixture_dir = fixture_dir or FIXTURE_DIR
+        self._prices = None
+
+    def _path(self, name):
+        return os.path.join(self.fixture_dir, name)
+
+    def get_closes(self, tickers, start=None, period=None, **kwargs):
+        if self._prices is None:
+            self._prices = pd.read_csv(self._path("prices.csv"), index_col=0, parse_dates=True).astype('float32')
+        closes = self._prices.reindex(columns=[t for t in tickers if t in self._prices.columns])
+        if start is not None:
+            closes = closes[closes.index >= pd.Timestamp(start)]
+        if closes.empty:
+            raise RuntimeError("fixture 中没有这些股票的数据")
+        return closes.copy()
+
+    def get_last_prices(self, tickers, timeout=None):
+        # 回放时用 prices.csv 的最后一行充当 "现价"
+        return self.get_closes(tickers).ffill().iloc[-1:]
+
+    def get_fed_snapshot(self):
+        # 本地替身在跑时和线上一样 HTTP GET 整页再解析 (FED_MONITOR_URL 已指向替身)
+        if _FIXTURE_SERVER is not None and os.path.exists(self._path("fedwatch.html")):
+            with stage_timer("fed.fetch.http", quiet=True):
+                snapshot = self.get_fed_snapshot_http()
+            snapshot["path"] = "http"
+            return snapshot
+        # 没有替身 (直接构造的 FixtureProvider): 读文件，走同样的本地解析
+        if os.path.exists(self._path("fedwatch.html")):
+            with open(self._path("fedwatch.html"), encoding="utf-8") as f:
+                return snapshot_from_html(f.read())
+        with open(self._path("fedwatch.json")) as f:
+            return json.load(f)
+
+class RecordingProvider(MarketDataProvider):
+    """
+    调用真实数据源，同时把结果写进 fixture 目录，供以后离线回放
+    """
+    name = "record"
+
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+        self.lock = threading.Lock()
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    def _write(self, name, text):
+        with open(os.path.join(self.fixture_dir, name), "w") as f:
+            f.write(text)
+
+    def get_constituents_page(self, universe, etag=None, last_modified=None):
+        page = super().get_constituents_page(universe, etag, last_modified)
+        if page["text"] is not None:
+            self._write(f"{universe}.html", page["text"])
+        return page
+
+    def get_closes(self, tickers, **kwargs):
+        closes = super().get_closes(tickers, **kwargs)
+        path = os.path.join(self.fixture_dir, "prices.csv")
+        with self.lock:
+            if os.path.exists(path):
+                old = pd.read_csv(path, index_col=0, parse_dates=True)
+                merged = closes.combine_first(old)
+            else:
+                merged = closes
+            merged.to_csv(path)
+        return closes
+
+    def get_apewisdom_page(self, page=1):
+        data = super().get_apewisdom_page(page)
+        if data is not None:
+            self._write(f"apewisdom_page{page}.json", json.dumps(data))
+        return data
+
+    def get_fed_snapshot(self):
+        snapshot = super().get_fed_snapshot()
+        if not snapshot:
+            # 抓取失败不写 fixture
+            return snapshot
+        if snapshot.get("html"):
+            self._write("fedwatch.html", snapshot["html"])
+        record = {k: v for k, v in snapshot.items() if k != "html"}
+        self._write("fedwatch.json", json.dumps(record, ensure_ascii=False))
+        return snapshot
+
+class FixtureHTTPServer:
+    """
+    进程内的 HTTP 替身，模拟 Wikipedia / FedWatch / ApeWisdom / Discord Webhook:
+      GET  /constituents/<u>      -> <u>.html
+      GET  /fed                   -> fedwatch.html
+      GET  /apewisdom/page/<n>    -> apewisdom_page<n>.json
+      POST /webhook               -> 204，记录收到的请求数和字节数
+    """
+
+    def __init__(self, fixture_dir=None, port=0):
+        self.fixture_dir = fixture_dir or FIXTURE_DIR
+        self.posts = []
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def do_GET(self):
+                name = None
+                if self.path.startswith("/constituents/"):
+                    universe = self.path.rstrip("/").rsplit("/", 1)[-1]
+                    name, ctype = f"{universe}.html", "text/html; charset=utf-8"
+                elif self.path.startswith("/fed"):
+                    name, ctype = "fedwatch.html", "text/html; charset=utf-8"
+                elif self.path.startswith("/apewisdom/page/"):
+                    page = self.path.rstrip("/").rsplit("/", 1)[-1]
+                    name, ctype = f"apewisdom_page{page}.json", "application/json"
+                path = os.path.join(owner.fixture_dir, name) if name else None
+                if not path or not os.path.exists(path):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                owner.posts.append({"path": self.path, "bytes": len(body)})
+                self.send_response(204)
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+_PROVIDER = None
+_FIXTURE_SERVER = None
+
+def get_provider():
+    """
+    按 DATA_PROVIDER 创建数据源 (进程内单例)。
+    fixture 模式会启动本地 HTTP 替身，并把相关 URL 和 WEBHOOK_URL 指向它。
+    """
+    global _PROVIDER, _FIXTURE_SERVER, APEWISDOM_API_URL, FED_MONITOR_URL, WEBHOOK_URL
+    if _PROVIDER is not None:
+        return _PROVIDER
+
+    if DATA_PROVIDER == "fixture":
+        _FIXTURE_SERVER = FixtureHTTPServer(FIXTURE_DIR).start()
+        base = _FIXTURE_SERVER.base_url
+        for universe, source in UNIVERSE_SOURCES.items():
+            source["url"] = f"{base}/constituents/{universe}"
+        APEWISDOM_API_URL = base + "/apewisdom/page/{page}"
+        FED_MONITOR_URL = f"{base}/fed"
+        WEBHOOK_URL = f"{base}/webhook"
+        print(f"🧪 离线模式: fixture={FIXTURE_DIR}, 本地服务 {base}")
+        _PROVIDER = FixtureProvider(FIXTURE_DIR)
+    elif RECORD_FIXTURES_DIR:
+        print(f"📼 录制模式: 数据写入 {RECORD_FIXTURES_DIR}")
+        _PROVIDER = RecordingProvider(RECORD_FIXTURES_DIR)
+    else:
+        _PROVIDER = MarketDataProvider()
+    return _PROVIDER
+
+# ==========================================
+# 🟢 模块 1: 降息概率 (FedWatch)
+# ==========================================
+
+def scrape_header_info(driver, page_text):
+    rate = None
+    meeting_date = None
+    try:
+        rate_match = re.search(r"Current.*?Rate.*?(\d+\.\d+)", page_text, re.IGNORECASE)
+        if rate_match:
+            val = float(rate_match.group(1))
+            if 0.0 <= val <= 10.0: rate = val
+    except: pass
+
+    try:
+        months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+        date_pattern = re.compile(r'(?:' + '|'.join(months) + r')\.?\s+\d{1,2},?\s+\d{4}', re.IGNORECASE)
+        top_text = page_text[:2000]
+        dates_found = date_pattern.findall(top_text)
+        tz = pytz.timezone('US/Eastern')
+        today = datetime.now(tz).date()
+
+        for d_str in dates_found:
+            parsed = parse_date_string(d_str)
+            if parsed:
+                p_date = datetime.strptime(parsed, "%Y-%m-%d").date()
+                if p_date >= today:
+                    meeting_date = parsed
+                    break 
+    except: pass
+    return rate, meeting_date
+
+_BLOCK_TAGS = (
+    "p", "div", "section", "article", "header", "footer", "nav", "aside", "main",
+    "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol", "li", "table", "thead", "tbody",
+    "tr", "br", "form", "label",
+)
+
+def _html_to_text(element):
+    """
+    近似浏览器的 innerText: 块级元素之间换行，单元格之间空格，行内多余空白压缩
+    """
+    for el in element.iter(*_BLOCK_TAGS):
+        el.tail = "\n" + (el.tail or "")
+        el.text = "\n" + (el.text or "")
+    for el in element.iter("td", "th"):
+        el.tail = " " + (el.tail or "")
+    lines = (" ".join(line.split()) for line in element.text_content().split("\n"))
+    return "\n".join(line for line in lines if line)
+
+def snapshot_from_html(html):
+    """
+    把整页 HTML 一次性解析成快照 {"body_text", "tables", "html"}，和 webdriver 模式结构一致
+    """
+    root = lxml_html.fromstring(html)
+    for bad in root.xpath("//script|//style|//noscript|//template"):
+        bad.drop_tree()
+
+    tables = []
+    for tbl in root.iter("table"):
+        rows = []
+        for row in tbl.iter("tr"):
+            rows.append([" ".join(col.text_content().split()) for col in row if col.tag == "td"])
+        tables.append({"text": " ".join(" ".join(tbl.itertext()).split()), "rows": rows})
+
+    # _html_to_text 会改写节点的 text/tail，所以放在表格解析之后
+    body = root.find("body")
+    body_text = _html_to_text(body if body is not None else root)
+    return {"body_text": body_text, "tables": tables, "html": html}
+
+def parse_fed_tables(tables):
+    """
+    从表格快照中找出概率表 (含 % 且行数较少)，解析出 [{"prob", "target"}]
+    """
+    data_points = []
+    target_table = None
+    for tbl in tables:
+        if "%" in tbl["text"] and len(tbl["rows"]) < 15:
+            target_table = tbl
+            break
+    if not target_table and tables: target_table = tables[0]
+
+    if target_table:
+        for cols in target_table["rows"]:
+            if len(cols) >= 2:
+                txt0, txt1 = cols[0].strip(), cols[1].strip()
+                try:
+                    if "%" in txt0: prob, target = float(txt0.replace("%", "")), txt1
+                    elif "%" in txt1: prob, target = float(txt1.replace("%", "")), txt0
+                    else: continue
+                    data_points.append({"prob": prob, "target": target})
+                except: continue
+    return data_points
+
+def get_fed_data():
+    if not ENABLE_FED_BOT:
+        print("⏸️ [系统] FedWatch Bot 已禁用，跳过抓取...")
+        return None
+
+    result = {"current_base_rate": None, "next_meeting": None, "data": []}
+      
+    try:
+        with stage_timer("fed.fetch"):
+            snapshot = get_provider().get_fed_snapshot()
+        if not snapshot: return None
+
+        with stage_timer("fed.parse"):
+            scraped_rate, scraped_date = scrape_header_info(None, snapshot["body_text"])
+            
+            if scraped_rate: result["current_base_rate"] = scraped_rate
+            else: result["current_base_rate"] = DEFAULT_BACKUP_RATE
+                
+            if scraped_date: result["next_meeting"] = scraped_date
+            else: result["next_meeting"] = get_backup_meeting_date()
+
+            data_points = []
+            try: data_points = parse_fed_tables(snapshot["tables"])
+            except: pass
+
+        if not data_points: return None
+        result["data"] = data_points
+        return result
+
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return None
+
+def send_fed_embed(data):
+    if not data or not data['data']: return
+    
+    base_rate = data.get("current_base_rate")
+    next_meeting_date = data.get("next_meeting")
+    
+    current_cut_prob = 0.0
+    target_cut_lower = base_rate - 0.25
+    
+    cut_item = None
+    rest_items = []
+    
+    for item in data['data']:
+        try:
+            lower = float(item['target'].split('-')[0].strip())
+            if abs(lower - target_cut_lower) <= 0.05:
+                cut_item = item
+                current_cut_prob = item['prob']
+            else:
+                rest_items.append(item)
+        except:
+            rest_items.append(item)
+    
+    # 关键数值: 会议日期 / 基准利率 / 每个目标区间的概率；都在容差内就不再推送
+    values = {"meeting": next_meeting_date, "base_rate": base_rate}
+    values.update({f"prob:{item['target']}": item['prob'] for item in data['data']})
+    changed, reason = STATE.changed("fed", values, tolerance=FED_CHANGE_TOLERANCE)
+    if not changed:
+        print(f"⏭️ FedWatch 无实质变化 ({reason})，跳过推送")
+        return
+
+    # 趋势和上一次推送的降息概率比 (持久化，重启后不丢)
+    prev_cut_prob = STATE.get("fed").get("cut_prob")
+    delta = 0.0
+    if prev_cut_prob is not None:
+        delta = current_cut_prob - prev_cut_prob
+    
+    trend_title = "📉 降息趋势变动"
+    if not cut_item and current_cut_prob == 0: trend_text = "无降息预期"
+    elif delta > 0.1: trend_text = f"概率上升 +{delta:.1f}% 🔥"
+    elif delta < -0.1: trend_text = f"概率下降 {delta:.1f}% ❄️"
+    else: trend_text = "稳定"
+
+    display_list = []
+    if cut_item: display_list.append(cut_item)
+    if rest_items:
+        rest_items.sort(key=lambda x: x['prob'], reverse=True)
+        display_list.append(rest_items[0])
+    
+    if not display_list:
+        data['data'].sort(key=lambda x: x['prob'], reverse=True)
+        display_list = data['data'][:2]
+
+    all_sorted = sorted(data['data'], key=lambda x: x['prob'], reverse=True)
+    top1_real = all_sorted[0]
+    
+    label1_raw = format_target_label(top1_real['target'], base_rate)
+    if "(维持)" in label1_raw: consensus_short = "⏸️ 维持利率 (Hold)"
+    elif "(降息)" in label1_raw: consensus_short = "📉 降息 (Cut)"
+    else: consensus_short = "📈 加息 (Hike)"
+
+    desc_lines = [f"**🗓️ 下次会议:** `{next_meeting_date}`\n"]
+    
+    for item in display_list:
+        label = format_target_label(item['target'], base_rate)
+        desc_lines.append(f"**目标: {label}**")
+        desc_lines.append(f"`{get_bar(item['prob'])}` **{item['prob']}%**\n")
+    
+    desc_lines.append("\n------------------------")
+
+    payload = {
+        "username": FED_BOT_NAME,
+        "avatar_url": FED_BOT_AVATAR,
+        "embeds": [{
+            "title": "🏛️ CME FedWatch™",
+            "description": "\n".join(desc_lines),
+            "color": 0x3498DB,
+            "fields": [
+                {"name": trend_title, "value": trend_text, "inline": True},
+                {"name": "💡 华尔街共识", "value": consensus_short, "inline": True},
+                {"name": "📊 当前基准利率", "value": f"{base_rate}%", "inline": False}
+            ],
+            "footer": {"text": f"Updated at {datetime.now().strftime('%H:%M')} ET | Auto-Scraped"}
+        }]
+    }
+    try:
+        with stage_timer("fed.post"):
+            post_webhook(payload, urls=FED_WEBHOOK_URLS)
+        STATE.published("fed", values, cut_prob=current_cut_prob)
+    except Exception as e: print(f"❌ 推送失败: {e}")
+
+# ==========================================
+# 📋 成分股缓存 (Constituents)
+# ==========================================
+# constituents/<universe>.json:
+#   members: 当前成分股 [{"symbol", "sector"}]
+#   history: 成分股变动 [{"date", "added", "removed"}] (Wikipedia 变动表 + 本地观察到的差异)
+#   etag / last_modified / checked_at: 条件刷新用
+
+def _normalize_symbol(symbol):
+    return str(symbol).strip().replace('.', '-')
+
+def parse_constituents_page(html):
+    """
+    只解析需要的表 (成分股表 id=constituents，变动表 id=changes)，返回 (members, history)。
+    没有 id 的页面退回到第一张含 Symbol / Ticker 列的表
+    """
+    try:
+        df = pd.read_html(io.StringIO(html), attrs={'id': 'constituents'})[0]
+    except ValueError:
+        tables = pd.read_html(io.StringIO(html), match='Symbol|Ticker')
+        df = next(t for t in tables if {'Symbol', 'Ticker'} & set(map(str, t.columns)))
+
+    symbol_col = 'Symbol' if 'Symbol' in df.columns else 'Ticker'
+    sector_col = next((c for c in df.columns if 'Sector' in str(c)), None)
+    members = []
+    for _, row in df.iterrows():
+        if pd.isna(row[symbol_col]): continue
+        members.append({
+            "symbol": _normalize_symbol(row[symbol_col]),
+            "sector": str(row[sector_col]) if sector_col is not None and pd.notna(row[sector_col]) else None,
+        })
+
+    history = []
+    try:
+        changes = pd.read_html(io.StringIO(html), attrs={'id': 'changes'}, flavor='lxml')[0]
+        cols = list(changes.columns)
+        flat = [" ".join(map(str, c)) if isinstance(c, tuple) else str(c) for c in cols]
+        date_col = cols[next(i for i, c in enumerate(flat) if 'Date' in c)]
+        added_col = cols[next(i for i, c in enumerate(flat) if 'Added' in c and 'Ticker' in c)]
+        removed_col = cols[next(i for i, c in enumerate(flat) if 'Removed' in c and 'Ticker' in c)]
+        for _, row in changes.iterrows():
+            date = pd.to_datetime(row[date_col], errors='coerce')
+            if pd.isna(date): continue
+            added = [_normalize_symbol(row[added_col])] if pd.notna(row[added_col]) else []
+            removed = [_normalize_symbol(row[removed_col])] if pd.notna(row[removed_col]) else []
+            if added or removed:
+                history.append({"date": date.strftime("%Y-%m-%d"), "added": added, "removed": removed, "source": "wikipedia"})
+    except ValueError:
+        pass  # 页面没有变动表
+    except Exception as e:
+        print(f"⚠️ 成分股变动表解析失败: {e}")
+
+    return members, history
+
+def _constituents_cache_path(universe):
+    return os.path.join(CONSTITUENTS_CACHE_DIR, f"{universe}.json")
+
+def _load_constituents_cache(universe):
+    path = _constituents_cache_path(universe)
+    if not os.path.exists(path): return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ 读取成分股缓存失败 ({universe}): {e}")
+        return None
+
+def _save_constituents_cache(universe, cache):
+    os.makedirs(CONSTITUENTS_CACHE_DIR, exist_ok=True)
+    path = _constituents_cache_path(universe)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def get_constituents(universe="sp500", provider=None, force=False):
+    """
+    返回某个指数的成分股缓存 dict (members / history / ...)
+    - 缓存未过期: 直接用，不发请求
+    - 过期: 条件请求，304 则只刷新检查时间
+    - 请求失败: 用旧缓存；连缓存都没有时，标普500退回备选名单，其他指数返回空名单 (都带 fallback 标记)
+    """
+    provider = provider or get_provider()
+    cache = _load_constituents_cache(universe)
+    now = datetime.now()
+    label = UNIVERSE_SOURCES[universe]["label"]
+
+    if cache and not force:
+        checked_at = datetime.fromisoformat(cache.get("checked_at", "1970-01-01T00:00:00"))
+        if now - checked_at < timedelta(hours=CONSTITUENTS_TTL_HOURS):
+            print(f"📋 {label} 成分股缓存有效 ({len(cache['members'])} 只)，跳过刷新")
+            return cache
+
+    try:
+        page = provider.get_constituents_page(
+            universe,
+            etag=cache.get("etag") if cache else None,
+            last_modified=cache.get("last_modified") if cache else None,
+        )
+        if page["status"] == 304 and cache:
+            print(f"📋 {label} 成分股列表未变化 (304)")
+            cache["checked_at"] = now.isoformat()
+        else:
+            members, wiki_history = parse_constituents_page(page["text"])
+            if not members or (cache and len(members) < 0.8 * len(cache["members"])):
+                raise ValueError(f"成分股数量异常: {len(members)}")
+
+            history = [h for h in (cache or {}).get("history", []) if h.get("source") == "observed"]
+            if cache:
+                old = {m["symbol"] for m in cache["members"]}
+                new = {m["symbol"] for m in members}
+                if old != new:
+                    change = {"date": now.strftime("%Y-%m-%d"), "added": sorted(new - old),
+                              "removed": sorted(old - new), "source": "observed"}
+                    print(f"📋 {label} 成分股变动: +{change['added']} -{change['removed']}")
+                    history.append(change)
+            history = wiki_history + history
+            cache = {
+                "members": members,
+                "history": history,
+                "etag": page.get("etag"),
+                "last_modified": page.get("last_modified"),
+                "fetched_at": now.isoformat(),
+                "checked_at": now.isoformat(),
+            }
+            print(f"📋 {label} 成分股列表已刷新 ({len(members)} 只)")
+        _save_constituents_cache(universe, cache)
+        return cache
+    except Exception as e:
+        if cache:
+            print(f"⚠️ {label} 成分股刷新失败，继续使用缓存: {e}")
+            return cache
+        fallback = FALLBACK_TICKERS if universe == "sp500" else []
+        print(f"⚠️ 无法获取 {label} 完整列表{'，使用备选名单' if fallback else '，本次跳过'}: {e}")
+        return {"members": [{"symbol": t, "sector": None} for t in fallback],
+                "history": [], "fallback": True}
+
+def membership_mask(cache, tickers, dates):
+    """
+    历史成分股掩码: bool 矩阵 (交易日 × 股票)，True 表示当天该股票在指数里
+    """
+    col = {t: i for i, t in enumerate(tickers)}
+    dates = pd.DatetimeIndex(dates)
+    mask = np.zeros((len(dates), len(tickers)), dtype=bool)
+
+    members = {m["symbol"] for m in cache["members"]}
+    end = len(dates)
+    for change in sorted(cache.get("history", []), key=lambda h: h["date"], reverse=True):
+        start = int(dates.searchsorted(pd.Timestamp(change["date"])))
+        idx = [col[t] for t in members if t in col]
+        if start < end and idx:
+            mask[start:end, idx] = True
+        end = min(end, start)
+        members = (members - set(change["added"])) | set(change["removed"])
+        if end <= 0: break
+    idx = [col[t] for t in members if t in col]
+    if end > 0 and idx:
+        mask[:end, idx] = True
+    return mask
+
+def point_in_time_universe(cache, since):
+    """
+    当前成分股 + since 之后被剔除的股票 (历史口径需要它们的价格)
+    """
+    tickers = [m["symbol"] for m in cache["members"]]
+    since_str = pd.Timestamp(since).strftime("%Y-%m-%d")
+    for change in cache.get("history", []):
+        if change["date"] >= since_str:
+            tickers += change["removed"]
+    return list(dict.fromkeys(tickers))
+
+# ==========================================
+# 💾 本地价格库 (Price Store)
+# ==========================================
+# 布局: closes.npy 为 float32 矩阵 (股票 × 交易日)，每只股票一行连续存放；
+#       dates.npy 为 datetime64[D] 日期轴；tickers.json 为行顺序。
+# 首次运行下载 2 年历史，之后每天只补缺失的几天。
+
+def _extract_closes(df_batch):
+    """
+    从 yf.download 的结果中取出收盘价 (float32, 去时区, 只保留日期)
+    """
+    if isinstance(df_batch.columns, pd.MultiIndex):
+        try: closes = df_batch['Close']
+        except KeyError: 
+            try: closes = df_batch['Adj Close']
+            except: closes = df_batch
+    elif 'Close' in df_batch.columns:
+        closes = df_batch['Close']
+    else:
+        closes = df_batch
+
+    # 单只股票时 yfinance 可能返回 Series
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame()
+
+    # 强制 float32
+    closes = closes.astype('float32')
+
+    # ⚠️ 【关键修复】统一移除时区信息，只保留日期，防止不同批次对齐报错
+    index = pd.DatetimeIndex(closes.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    closes.index = index.normalize()
+    closes = closes[~closes.index.duplicated(keep='last')]
+    return closes
+
+class RateLimiter:
+    """
+    简单的线程安全限速器: 两次请求之间至少间隔 1/max_rps 秒
+    """
+
+    def __init__(self, max_rps, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / max_rps if max_rps and max_rps > 0 else 0.0
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        if not self.interval: return
+        with self.lock:
+            now = self.clock()
+            wait_s = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait_s > 0:
+            self.sleep(wait_s)
+
+def _yf_fetch_batch(batch_tickers, **kwargs):
+    """
+    默认数据源: yf.download 一个批次，返回收盘价矩阵 (日期 × 股票)
+    """
+    df_batch = yf.download(batch_tickers, auto_adjust=True, threads=True, progress=False, **kwargs)
+    if df_batch is None or df_batch.empty:
+        raise RuntimeError("yfinance 返回空数据")
+    closes = _extract_closes(df_batch)
+    # 单只股票时列名可能是 'Close'，统一成代码
+    if len(batch_tickers) == 1 and list(closes.columns) != list(batch_tickers):
+        closes.columns = list(batch_tickers)
+    return closes
+
+def estimate_download_bytes(frame):
+    """
+    按返回的收盘价矩阵估算一个下载批次的流量 (yfinance 的请求不经过 HTTP_SESSION)
+    """
+    if frame is None or frame.empty: return 0
+    rows = int(frame.notna().to_numpy().sum())
+    return rows * FETCH_EST_BYTES_PER_ROW + frame.shape[1] * FETCH_EST_BYTES_PER_TICKER
+
+def _yf_fetch_last_prices(batch_tickers, timeout=None):
+    """
+    盘中快照: 当天 1 分钟线，每只股票取最后一笔成交 (个别股票最后一分钟没成交，先向前填充)
+    """
+    df_batch = yf.download(batch_tickers, period="1d", interval="1m", auto_adjust=True, threads=True,
+                           progress=False, timeout=timeout or INTRADAY_SNAPSHOT_TIMEOUT)
+    if df_batch is None or df_batch.empty:
+        raise RuntimeError("yfinance 返回空数据")
+    closes = _extract_closes(df_batch.ffill())
+    if len(batch_tickers) == 1 and list(closes.columns) != list(batch_tickers):
+        closes.columns = list(batch_tickers)
+    return closes
+
+class FetchScheduler:
+    """
+    批量下载调度器:
+    - 线程池并发 (max_workers)，全局限速 (max_rps)
+    - 每个批次失败后指数退避重试；批次里仍缺数据的股票再逐只重试
+    - 返回覆盖率报告 (实际拿到 / 应有)，避免广度悄悄建立在残缺样本上
+    fetch_fn(tickers, **kwargs) -> DataFrame (日期 × 股票)，可替换成本地假数据源做测试
+    """
+
+    def __init__(self, fetch_fn=None, max_workers=FETCH_WORKERS, max_rps=FETCH_MAX_RPS,
+                 max_retries=FETCH_MAX_RETRIES, backoff_base=FETCH_BACKOFF_BASE, sleep=time.sleep):
+        self.fetch_fn = fetch_fn or _yf_fetch_batch
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.sleep = sleep
+        self.limiter = RateLimiter(max_rps, sleep=sleep)
+
+    def _fetch_with_retry(self, tickers, **kwargs):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = self.backoff_base * (2 ** (attempt - 1)) * (1 + random.random() * 0.25)
+                self.sleep(delay)
+            self.limiter.wait()
+            try:
+                with stage_timer("prices.fetch_batch", quiet=True, tickers=len(tickers), attempt=attempt + 1) as span:
+                    frame = self.fetch_fn(tickers, **kwargs)
+                    TRACER.add_bytes(received=estimate_download_bytes(frame))
+                    span["attrs"]["bytes_estimated"] = True
+                    return frame
+            except Exception as e:
+                last_error = e
+                print(f"   ⚠️ 下载失败 ({len(tickers)} 只, 第 {attempt + 1} 次): {e}")
+        raise last_error
+
+    @staticmethod
+    def _got(frame, tickers):
+        if frame is None or frame.empty: return set()
+        return {t for t in tickers if t in frame.columns and frame[t].notna().any()}
+
+    def run(self, tickers, batch_size=FETCH_BATCH_SIZE, **kwargs):
+        """
+        下载全部股票，返回 (收盘价矩阵, 覆盖率报告)
+        """
+        tickers = list(dict.fromkeys(tickers))
+        batches = [tickers[i:i + batch_size] for i in range(0, len(tickers), batch_size)]
+        frames = []
+        print(f"   🚀 {len(tickers)} 只股票分 {len(batches)} 批下载 (并发 {self.max_workers})...")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self._fetch_with_retry, batch, **kwargs): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    frames.append(future.result())
+                except Exception as e:
+                    print(f"   ⚠️ 批次彻底失败 ({len(batch)} 只)，稍后逐只重试: {e}")
+
+        got = set()
+        for frame in frames:
+            got |= self._got(frame, tickers)
+
+        # 批次里缺失的股票逐只补抓 (全军覆没说明数据源本身挂了，不再逐只浪费时间)
+        missing = [t for t in tickers if t not in got]
+        if missing and got:
+            print(f"   🔁 逐只补抓 {len(missing)} 只缺失股票...")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {pool.submit(self._fetch_with_retry, [t], **kwargs): t for t in missing}
+                for future in as_completed(futures):
+                    try:
+                        frame = future.result()
+                        if self._got(frame, [futures[future]]):
+                            frames.append(frame)
+                            got.add(futures[future])
+                    except Exception:
+                        pass
+
+        coverage = {
+            "expected": len(tickers),
+            "fetched": len(got),
+            "missing": [t for t in tickers if t not in got],
+        }
+        coverage["ratio"] = coverage["fetched"] / coverage["expected"] if tickers else 1.0
+        # 批次在线程池里跑，估算的下载量再记到调用方线程的 span 上 (比如 breadth.fetch)
+        TRACER.add_bytes(received=sum(estimate_download_bytes(frame) for frame in frames))
+        print(f"   📶 覆盖率: {coverage['fetched']}/{coverage['expected']} ({coverage['ratio']:.1%})")
+
+        if not frames:
+            return pd.DataFrame(dtype='float32'), coverage
+        merged = pd.concat(frames, axis=1)
+        merged = merged.loc[:, ~merged.columns.duplicated(keep='last')]
+        merged = merged[[t for t in merged.columns if t in got]]
+        gc.collect()
+        return merged.sort_index(), coverage
+
+def _download_closes(tickers, fetch_fn=None, **kwargs):
+    """
+    并发下载收盘价矩阵 (日期 × 股票)，返回 (DataFrame, 覆盖率报告)
+    """
+    if BREADTH_RSS_BUDGET_MB:
+        # 低内存: yf.download 每批都会先建一个 float64 的多层大表，改成单并发 + 小批次
+        scheduler = FetchScheduler(fetch_fn=fetch_fn, max_workers=1)
+        kwargs.setdefault("batch_size", LOWMEM_FETCH_BATCH_SIZE)
+    else:
+        scheduler = FetchScheduler(fetch_fn=fetch_fn)
+    return scheduler.run(tickers, **kwargs)
+
+def load_price_store(store_dir=None, mmap=False):
+    """
+    读取本地价格库，返回 DataFrame (日期 × 股票, float32)；库不存在时返回 None
+    mmap=True: 不读进内存，DataFrame 直接挂在只读 memmap 上 (每只股票一行连续存储，按列取用时才读盘)
+    """
+    store_dir = store_dir or PRICE_STORE_DIR
+    try:
+        closes_path = os.path.join(store_dir, "closes.npy")
+        if not os.path.exists(closes_path): return None
+        with open(os.path.join(store_dir, "tickers.json")) as f:
+            tickers = json.load(f)
+        dates = np.load(os.path.join(store_dir, "dates.npy"))
+        closes = np.load(closes_path, mmap_mode='r')
+        if closes.shape != (len(tickers), len(dates)):
+            print("⚠️ 价格库维度不一致，忽略本地库")
+            return None
+        index = pd.DatetimeIndex(dates.astype('datetime64[ns]'))
+        if mmap:
+            return pd.DataFrame(closes.T, index=index, columns=tickers, copy=False)
+        return pd.DataFrame(np.asarray(closes).T, index=index, columns=tickers)
+    except Exception as e:
+        print(f"⚠️ 读取价格库失败: {e}")
+        return None
+
+def save_price_store(frame, store_dir=None):
+    """
+    写入本地价格库 (先写临时文件再替换，防止写到一半进程被杀)
+    """
+    store_dir = store_dir or PRICE_STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    tickers = [str(t) for t in frame.columns]
+    dates = np.asarray(frame.index.values, dtype='datetime64[D]')
+    closes = np.ascontiguousarray(frame.to_numpy(dtype='float32').T)
+
+    for name, writer in (
+        ("closes.npy", lambda fh: np.save(fh, closes)),
+        ("dates.npy", lambda fh: np.save(fh, dates)),
+        ("tickers.json", lambda fh: fh.write(json.dumps(tickers).encode())),
+    ):
+        tmp_path = os.path.join(store_dir, name + ".tmp")
+        with open(tmp_path, "wb") as fh:
+            writer(fh)
+        os.replace(tmp_path, os.path.join(store_dir, name))
+
+def _first_changed_date(old, new, tickers):
+    """
+    对比更新前后的价格库，返回所需股票里数据有变化的最早交易日 (新日期 / 改值 / 新股票)
+    """
+    cols = [t for t in tickers if t in new.columns]
+    if not cols: return None
+    if any(t not in old.columns for t in cols) or not len(old.index):
+        return new.index[0]
+    old_part = old.reindex(index=new.index, columns=cols)
+    new_part = new[cols]
+    same = (old_part == new_part) | (old_part.isna() & new_part.isna())
+    changed = ~same.all(axis=1).to_numpy()
+    return new.index[changed.argmax()] if changed.any() else None
+
+def update_price_store(tickers, store_dir=None, fetch_fn=None, changes=None):
+    """
+    增量更新价格库并返回所需股票的收盘价矩阵 (日期 × 股票, float32)
+    - 新股票: 下载完整 2 年历史
+    - 老股票: 只下载最后一个交易日之后的数据 (带几天重叠用于校验复权)
+    - 不在 tickers 里的股票从库里删掉
+    fetch_fn: 可替换的数据源 (默认 yfinance)
+    changes: 可选 dict，写入 first_changed = 本次有变化的最早交易日 (None 表示没变化)
+    """
+    warnings.simplefilter(action='ignore', category=FutureWarning)
+    try:
+        if os.path.exists('yfinance.cache'): shutil.rmtree('yfinance.cache')
+    except: pass
+
+    frame = load_price_store(store_dir)
+    if frame is None:
+        frame = pd.DataFrame(dtype='float32')
+    before = frame
+
+    known = [t for t in tickers if t in frame.columns]
+    fresh = [t for t in tickers if t not in frame.columns]
+    full_refresh = list(fresh)
+
+    if known and len(frame.index):
+        last_date = frame.index[-1]
+        expected = pd.Timestamp(CALENDAR.last_closed_session())
+        if last_date >= expected:
+            print(f"💾 价格库已是最新 ({last_date.date()})，跳过增量下载")
+        else:
+            start = (last_date - timedelta(days=PRICE_OVERLAP_DAYS)).strftime("%Y-%m-%d")
+            print(f"💾 增量更新 {len(known)} 只股票 (自 {start})...")
+            inc, _ = _download_closes(known, fetch_fn=fetch_fn, start=start)
+            if not inc.empty:
+                # 复权校验: 只比较最后一个库内交易日之前的重叠区 (最后一天可能是盘中未收盘数据)
+                overlap = inc.index[(inc.index < last_date) & inc.index.isin(frame.index)]
+                cols = [t for t in known if t in inc.columns]
+                if len(overlap) and cols:
+                    ratio = inc.loc[overlap, cols] / frame.loc[overlap, cols]
+                    drift = (ratio - 1).abs().max()
+                    adjusted = drift[drift > PRICE_ADJUST_TOLERANCE].index.tolist()
+                    if adjusted:
+                        print(f"🔁 检测到复权变化，整段重下: {adjusted[:10]}{'...' if len(adjusted) > 10 else ''}")
+                        full_refresh += adjusted
+                # 新数据优先，旧数据补空
+                frame = inc.combine_first(frame)
+            del inc
+
+    if full_refresh:
+        print(f"💾 完整下载 {len(full_refresh)} 只股票的 {PRICE_HISTORY_PERIOD} 历史...")
+        full, _ = _download_closes(full_refresh, fetch_fn=fetch_fn, period=PRICE_HISTORY_PERIOD)
+        if not full.empty:
+            frame = frame.drop(columns=[t for t in full.columns if t in frame.columns])
+            frame = pd.concat([frame, full], axis=1).sort_index()
+        del full
+
+    if frame.empty:
+        return frame
+
+    # 已被移出成分股的股票不再保留，避免库越存越大
+    wanted = set(tickers)
+    dropped = [t for t in frame.columns if t not in wanted]
+    if dropped:
+        print(f"🧹 价格库移除 {len(dropped)} 只已不在成分股里的股票")
+        frame = frame.drop(columns=dropped)
+
+    frame = frame.astype('float32').tail(PRICE_STORE_MAX_DAYS)
+    if changes is not None:
+        changes["first_changed"] = _first_changed_date(before, frame, tickers)
+        del before
+    try:
+        save_price_store(frame, store_dir)
+    except Exception as e:
+        print(f"⚠️ 价格库写入失败: {e}")
+    gc.collect()
+    return frame.reindex(columns=tickers)
+
+# ==========================================
+# 🧮 矩阵广度算法 (Vectorized SMA)
+# ==========================================
+
+def _sma_hits(x, windows):
+    """
+    对每个窗口产出 (k, w, hit)：hit 为 bool 矩阵 (交易日-w+1 × 股票)，hit[t] 对应第 w-1+t 天
+    "收盘价 > N 日均线"。一次累加和 (cumsum) 得到所有窗口的滑动和。
+    """
+    days, n = x.shape
+    is_num = ~np.isnan(x)
+
+    # 前面补一行 0，窗口和 = cs[t+1] - cs[t+1-w]
+    cs = np.zeros((days + 1, n), dtype='float64')
+    np.cumsum(np.where(is_num, x, 0), axis=0, dtype='float64', out=cs[1:])
+    cn = np.zeros((days + 1, n), dtype='int32')
+    np.cumsum(is_num, axis=0, dtype='int32', out=cn[1:])
+
+    for k, w in enumerate(windows):
+        if days < w: continue
+        win_sum = cs[w:] - cs[:-w]
+        win_cnt = cn[w:] - cn[:-w]
+        hit = (win_cnt == w) & (x[w - 1:] > win_sum / w)
+        del win_sum, win_cnt
+        yield k, w, hit
+
+def compute_breadth_matrix(values, windows=BREADTH_WINDOWS, mask=None):
+    """
+    values: float32 矩阵 (交易日 × 股票)，NaN 表示当天无数据。
+    mask: 可选 bool 矩阵 (同形状)，False 的格子不参与统计 (例如当天不在指数里)。
+    返回:
+      above: int32 (交易日 × 窗口数) 站上各均线的股票数
+      valid: int32 (交易日,) 当天有收盘价的股票数
+    口径与 pandas rolling(N).mean() 一致 (窗口内有 NaN 则不计入)。
+    """
+    x = np.asarray(values, dtype='float32')
+    above = np.zeros((x.shape[0], len(windows)), dtype='int32')
+    for k, w, hit in _sma_hits(x, windows):
+        if mask is not None:
+            hit &= mask[w - 1:]
+        above[w - 1:, k] = np.count_nonzero(hit, axis=1)
+
+    is_num = ~np.isnan(x)
+    if mask is not None:
+        is_num &= mask
+    valid = np.count_nonzero(is_num, axis=1).astype('int32')
+    return above, valid
+
+def build_group_matrix(tickers, groups):
+    """
+    groups: {分组名: 成员集合} → float32 矩阵 (股票 × 分组)，成员为 1
+    """
+    col = {t: i for i, t in enumerate(tickers)}
+    matrix = np.zeros((len(tickers), len(groups)), dtype='float32')
+    for j, members in enumerate(groups.values()):
+        idx = [col[t] for t in members if t in col]
+        matrix[idx, j] = 1
+    return matrix
+
+def compute_breadth_grouped(values, windows, group_matrix, mask=None, masked_groups=None):
+    """
+    多个指数 / 行业一次算完: 对同一个价格矩阵做一次均线比较，
+    再用 (交易日 × 股票) @ (股票 × 分组) 的矩阵乘法做分组求和，不复制任何子表。
+    mask / masked_groups: 历史成分股掩码只作用于 masked_groups 为 True 的分组
+    返回 above: int32 (窗口 × 交易日 × 分组)，valid: int32 (交易日 × 分组)
+    """
+    x = np.asarray(values, dtype='float32')
+    days, groups = x.shape[0], group_matrix.shape[1]
+    use_mask = mask is not None and masked_groups is not None and np.any(masked_groups)
+
+    def reduce(flags, offset=0):
+        plain = flags.astype('float32') @ group_matrix
+        if use_mask:
+            masked = (flags & mask[offset:]).astype('float32') @ group_matrix
+            plain = np.where(masked_groups, masked, plain)
+        return np.rint(plain).astype('int32')
+
+    above = np.zeros((len(windows), days, groups), dtype='int32')
+    for k, w, hit in _sma_hits(x, windows):
+        above[k, w - 1:] = reduce(hit, w - 1)
+        del hit
+
+    valid = reduce(~np.isnan(x))
+    return above, valid
+
+def _lowmem_block_size(days, n_tickers):
+    """
+    按 RSS 预算剩余空间估算一次处理几只股票: 每只股票每天约 32 字节中间数据
+    (float32 收盘价 + float64/int32 累加和 + 命中标记)，只用剩余空间的一半
+    """
+    headroom_mb = max(BREADTH_RSS_BUDGET_MB - current_rss_mb(), 8) / 2
+    return int(max(1, min(n_tickers, headroom_mb * 1024 * 1024 // max(days * 32, 1))))
+
+def compute_breadth_lowmem(closes_all, windows, group_matrix, mask=None, masked_groups=None):
+    """
+    低内存版 compute_breadth_grouped: 按预算分块取股票 (memmap 上每只股票是连续的一行)，
+    每块算完立刻并入 int16 计数 (窗口 × 交易日 × 分组)，中间矩阵不超过一块的大小
+    """
+    days, n = closes_all.shape
+    groups = group_matrix.shape[1]
+    above = np.zeros((len(windows), days, groups), dtype='int16')
+    valid = np.zeros((days, groups), dtype='int16')
+
+    i = 0
+    while i < n:
+        block = _lowmem_block_size(days, n - i)
+        x = closes_all.iloc[:, i:i + block].to_numpy(dtype='float32')
+        block_mask = mask[:, i:i + block] if mask is not None else None
+        a, v = compute_breadth_grouped(x, windows, group_matrix[i:i + block], block_mask, masked_groups)
+        above += a.astype('int16')
+        valid += v.astype('int16')
+        del x, a, v
+        i += block
+        if BREADTH_RSS_BUDGET_MB and current_rss_mb() > BREADTH_RSS_BUDGET_MB:
+            gc.collect()
+
+    return above, valid
+
+_BREADTH_POOLS = {}
+_BREADTH_POOL_LOCK = threading.Lock()
+
+def _breadth_pool(processes):
+    """
+    常驻进程池 (按进程数缓存，第一次用时创建)；forkserver / spawn 下子进程只在启动时 import 一次
+    """
+    with _BREADTH_POOL_LOCK:
+        pool = _BREADTH_POOLS.get(processes)
+        if pool is None:
+            ctx = multiprocessing.get_context(BREADTH_MP_START)
+            pool = _BREADTH_POOLS[processes] = ProcessPoolExecutor(max_workers=processes, mp_context=ctx)
+            atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+        return pool
+
+def _shared_dir():
+    # /dev/shm 是内存文件系统，memmap 放这里等于共享内存
+    return "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+
+def _breadth_shard(values_path, mask_path, start, end, windows, group_matrix, masked_groups):
+    """
+    子进程: 只读映射 (股票 × 交易日) 矩阵里 [start, end) 这几行，返回这一片的计数
+    """
+    values = np.load(values_path, mmap_mode='r')[start:end].T
+    mask = np.load(mask_path, mmap_mode='r')[start:end].T if mask_path else None
+    above, valid = compute_breadth_grouped(values, windows, group_matrix, mask, masked_groups)
+    del values, mask
+    return above, valid
+
+def compute_breadth_sharded(closes_all, windows, group_matrix, mask=None, masked_groups=None, processes=None):
+    """
+    多进程版 compute_breadth_grouped:
+    - 价格 (和历史成分股掩码) 按 股票 × 交易日 写进一个临时 .npy，子进程 memmap 只读共享
+    - 股票按行均分成 processes 片，每个子进程只回传 (窗口 × 交易日 × 分组) 的计数，父进程相加
+    """
+    processes = max(1, processes or BREADTH_PROCESSES)
+    days, n = closes_all.shape
+    pool = _breadth_pool(processes)
+    tmp_dir = tempfile.mkdtemp(prefix="breadth-", dir=_shared_dir())
+    try:
+        values_path = os.path.join(tmp_dir, "closes.npy")
+        np.save(values_path, np.ascontiguousarray(closes_all.to_numpy(dtype='float32').T))
+        mask_path = None
+        if mask is not None:
+            mask_path = os.path.join(tmp_dir, "mask.npy")
+            np.save(mask_path, np.ascontiguousarray(mask.T))
+
+        bounds = np.linspace(0, n, processes + 1).astype(int)
+        futures = [
+            pool.submit(_breadth_shard, values_path, mask_path, int(a), int(b), tuple(windows),
+                        group_matrix[a:b], masked_groups)
+            for a, b in zip(bounds[:-1], bounds[1:]) if b > a
+        ]
+        above = np.zeros((len(windows), days, group_matrix.shape[1]), dtype='int32')
+        valid = np.zeros((days, group_matrix.shape[1]), dtype='int32')
+        for future in futures:
+            a, v = future.result()
+            above += a
+            valid += v
+        return above, valid
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def compute_breadth_vectorized(closes_all, mask=None, windows=BREADTH_WINDOWS):
+    """
+    矩阵算法: 返回 {窗口: 百分比序列}；mask 见 compute_breadth_matrix
+    """
+    print(f"🧮 矩阵计算 {closes_all.shape[1]} 只股票 × {closes_all.shape[0]} 天...")
+    values = closes_all.to_numpy(dtype='float32')
+    above, valid = compute_breadth_matrix(values, windows, mask)
+    valid = np.where(valid == 0, 1, valid)
+    return {
+        w: pd.Series(above[:, k] / valid * 100, index=closes_all.index).sort_index()
+        for k, w in enumerate(windows)
+    }
+
+# ==========================================
+# 🧮 流式广度引擎 (Streaming SMA)
+# ==========================================
+
+class StreamingBreadthEngine:
+    """
+    为每只股票维护一个环形缓冲区和各窗口的滑动和。
+    每追加一天的收盘价只需 O(股票数) 计算，状态可以保存到磁盘，下次继续。
+    口径与 pandas rolling(N).mean() 一致: 窗口内有 NaN 时该股票当天不计入 "站上均线"。
+    """
+
+    def __init__(self, tickers, windows=BREADTH_WINDOWS, history_len=300):
+        self.tickers = list(tickers)
+        self.windows = tuple(sorted(int(w) for w in windows))
+        self.history_len = history_len
+        n, max_w = len(self.tickers), max(self.windows)
+        self.buffer = np.full((n, max_w), np.nan, dtype='float32')
+        self.pos = 0
+        self.steps = 0
+        self.sums = np.zeros((len(self.windows), n), dtype='float64')
+        self.counts = np.zeros((len(self.windows), n), dtype='int32')
+        self.last_date = None
+        # 每日输出: 站上各均线的股票数 + 有效样本数
+        self.hist_dates = np.array([], dtype='datetime64[D]')
+        self.hist_above = np.zeros((0, len(self.windows)), dtype='int32')
+        self.hist_valid = np.zeros(0, dtype='int32')
+
+    def update(self, date, closes):
+        """
+        追加一天的收盘价 (长度 = 股票数)，返回 (各窗口站上均线数量, 有效样本数)
+        """
+        x = np.asarray(closes, dtype='float32')
+        is_num = ~np.isnan(x)
+        x0 = np.where(is_num, x, 0).astype('float64')
+        max_w = self.buffer.shape[1]
+
+        above = np.zeros(len(self.windows), dtype='int32')
+        for k, w in enumerate(self.windows):
+            # 离开窗口的是 w 步之前写入的那一格
+            old = self.buffer[:, (self.pos - w) % max_w]
+            old_num = ~np.isnan(old)
+            self.sums[k] += x0 - np.where(old_num, old, 0)
+            self.counts[k] += is_num.astype('int32') - old_num.astype('int32')
+            full = self.counts[k] == w
+            sma = self.sums[k] / w
+            above[k] = np.count_nonzero(full & is_num & (x > sma))
+
+        self.buffer[:, self.pos] = x
+        self.pos = (self.pos + 1) % max_w
+        self.steps += 1
+        # 每转一圈用缓冲区重算一次精确和，防止浮点误差累积
+        if self.pos == 0:
+            self._resync()
+
+        valid = int(np.count_nonzero(is_num))
+        self.last_date = np.datetime64(pd.Timestamp(date).date(), 'D')
+        self.hist_dates = np.append(self.hist_dates, self.last_date)[-self.history_len:]
+        self.hist_above = np.vstack([self.hist_above, above])[-self.history_len:]
+        self.hist_valid = np.append(self.hist_valid, valid)[-self.history_len:]
+        return above, valid
+
+    def _resync(self):
+        max_w = self.buffer.shape[1]
+        for k, w in enumerate(self.windows):
+            # 最近 w 格 (按写入顺序) 的下标
+            idx = [(self.pos - j) % max_w for j in range(1, w + 1)]
+            window = self.buffer[:, idx].astype('float64')
+            self.sums[k] = np.nansum(window, axis=1)
+            self.counts[k] = np.count_nonzero(~np.isnan(window), axis=1)
+
+    def advance(self, closes_frame):
+        """
+        追加若干天 (DataFrame: 日期 × 股票，列顺序需与 self.tickers 一致)
+        """
+        values = closes_frame.reindex(columns=self.tickers).to_numpy(dtype='float32')
+        for date, row in zip(closes_frame.index, values):
+            self.update(date, row)
+
+    def last_row(self):
+        """
+        最近一次写入的收盘价 (用于校验价格库是否被修订)
+        """
+        return self.buffer[:, (self.pos - 1) % self.buffer.shape[1]]
+
+    def percent_series(self):
+        """
+        返回 {窗口: 百分比序列}
+        """
+        index = pd.DatetimeIndex(self.hist_dates.astype('datetime64[ns]'))
+        valid = np.where(self.hist_valid == 0, 1, self.hist_valid)
+        return {
+            w: pd.Series(self.hist_above[:, k] / valid * 100, index=index)
+            for k, w in enumerate(self.windows)
+        }
+
+    def save(self, path=None):
+        path = path or BREADTH_STATE_PATH
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            tickers=np.array(self.tickers, dtype=str),
+            windows=np.array(self.windows, dtype='int32'),
+            history_len=np.array(self.history_len),
+            buffer=self.buffer, pos=np.array(self.pos), steps=np.array(self.steps),
+            sums=self.sums, counts=self.counts,
+            last_date=np.array([self.last_date], dtype='datetime64[D]'),
+            hist_dates=self.hist_dates, hist_above=self.hist_above, hist_valid=self.hist_valid,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or BREADTH_STATE_PATH
+        if not os.path.exists(path): return None
+        try:
+            with np.load(path) as z:
+                engine = cls(z['tickers'].tolist(), z['windows'].tolist(), int(z['history_len']))
+                engine.buffer = z['buffer']
+                engine.pos = int(z['pos'])
+                engine.steps = int(z['steps'])
+                engine.sums = z['sums']
+                engine.counts = z['counts']
+                engine.last_date = z['last_date'][0]
+                engine.hist_dates = z['hist_dates']
+                engine.hist_above = z['hist_above']
+                engine.hist_valid = z['hist_valid']
+            return engine
+        except Exception as e:
+            print(f"⚠️ 读取广度状态失败: {e}")
+            return None
+
+def compute_breadth_streaming(closes_all, tickers):
+    """
+    流式算法: 读取上次保存的引擎状态，只追加新的交易日；
+    股票列表变化或历史价格被修订 (复权) 时才从价格库重新初始化。
+    """
+    engine = StreamingBreadthEngine.load()
+    reseed = (
+        engine is None
+        or engine.tickers != list(tickers)
+        or engine.windows != tuple(sorted(BREADTH_WINDOWS))
+        or engine.last_date is None
+    )
+
+    if not reseed:
+        last_ts = pd.Timestamp(engine.last_date)
+        if last_ts not in closes_all.index:
+            reseed = True
+        else:
+            # 价格库里这一天的收盘价和引擎当时用的不一致 → 历史被修订，重建
+            stored = closes_all.loc[last_ts].to_numpy(dtype='float32')
+            if not np.allclose(stored, engine.last_row(), rtol=1e-4, equal_nan=True):
+                print("🔁 历史价格已修订，重建广度状态")
+                reseed = True
+
+    if reseed:
+        print(f"🧮 初始化流式广度引擎 ({len(tickers)} 只股票 × {len(closes_all)} 天)...")
+        engine = StreamingBreadthEngine(tickers, BREADTH_WINDOWS)
+        engine.advance(closes_all)
+    else:
+        new_rows = closes_all[closes_all.index > pd.Timestamp(engine.last_date)]
+        print(f"🧮 流式更新 {len(new_rows)} 个交易日...")
+        engine.advance(new_rows)
+
+    try:
+        engine.save()
+    except Exception as e:
+        print(f"⚠️ 广度状态保存失败: {e}")
+
+    return engine.percent_series()
+
+# ==========================================
+# 🗄️ 广度历史库 (SQLite，按日期增量写入)
+# ==========================================
+
+class BreadthHistory:
+    """
+    广度结果的持久化时间序列:
+    - breadth: (日期, 分组, 均线) → 百分比 / 站上数量 / 有效样本
+    - coverage: 每天主指数成分股数量和有数据的数量
+    - meta: 分组口径指纹，口径变化时整段重算
+    每次调用单独开连接，线程安全。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS breadth (
+            date TEXT NOT NULL, grp TEXT NOT NULL, win INTEGER NOT NULL,
+            pct REAL NOT NULL, above INTEGER NOT NULL, valid INTEGER NOT NULL,
+            PRIMARY KEY (date, grp, win)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS breadth_grp ON breadth (grp, win, date);
+        CREATE TABLE IF NOT EXISTS coverage (
+            date TEXT PRIMARY KEY, members INTEGER NOT NULL, fetched INTEGER NOT NULL, fallback INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path=None):
+        self.path = path or BREADTH_HISTORY_PATH
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get_meta(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def last_date(self):
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(date) FROM breadth").fetchone()
+        return pd.Timestamp(row[0]) if row and row[0] else None
+
+    def groups(self):
+        with self._connect() as conn:
+            return {r[0] for r in conn.execute("SELECT DISTINCT grp FROM breadth")}
+
+    def write(self, pct, valid, coverage=None):
+        """
+        pct: {窗口: DataFrame(交易日 × 分组)}，valid: DataFrame(交易日 × 分组)
+        coverage: 可选 DataFrame(交易日, 列 members / fetched / fallback)
+        已有的 (日期, 分组, 均线) 直接覆盖 (回补 / 修订)
+        """
+        rows = []
+        for w, frame in pct.items():
+            counts = valid.reindex(index=frame.index, columns=frame.columns)
+            for grp in frame.columns:
+                p = frame[grp].to_numpy(dtype='float64')
+                n = counts[grp].to_numpy(dtype='float64')
+                for date, pv, nv in zip(frame.index.strftime("%Y-%m-%d"), p, n):
+                    if np.isnan(pv) or np.isnan(nv): continue
+                    rows.append((date, grp, int(w), float(pv), int(round(pv * nv / 100)), int(nv)))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO breadth VALUES (?, ?, ?, ?, ?, ?)", rows)
+            if coverage is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?)",
+                    [(d.strftime("%Y-%m-%d"), int(r.members), int(r.fetched), int(r.fallback))
+                     for d, r in coverage.iterrows()],
+                )
+        return len(rows)
+
+    def series(self, grp, window, days=None):
+        """
+        读取某个分组某条均线的百分比序列 (最近 days 天)
+        """
+        sql = "SELECT date, pct FROM breadth WHERE grp = ? AND win = ? ORDER BY date DESC"
+        args = [grp, int(window)]
+        if days:
+            sql += " LIMIT ?"
+            args.append(int(days))
+        with self._connect() as conn:
+            rows = conn.execute(sql, args).fetchall()[::-1]
+        return pd.Series([r[1] for r in rows], index=pd.DatetimeIndex([r[0] for r in rows]), dtype='float64')
+
+    def latest(self):
+        """
+        最新交易日所有分组的数值: (日期, {分组: {窗口: 百分比}})
+        """
+        date = self.last_date()
+        if date is None: return None, {}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT grp, win, pct FROM breadth WHERE date = ?",
+                                (date.strftime("%Y-%m-%d"),)).fetchall()
+        values = {}
+        for grp, w, p in rows:
+            values.setdefault(grp, {})[w] = p
+        return date, values
+
+    def coverage(self, date):
+        with self._connect() as conn:
+            row = conn.execute("SELECT members, fetched, fallback FROM coverage WHERE date = ?",
+                               (pd.Timestamp(date).strftime("%Y-%m-%d"),)).fetchone()
+        return {"members": row[0], "fetched": row[1], "fallback": bool(row[2])} if row else None
+
+def universe_fingerprint(universes):
+    """
+    分组口径指纹: 成分股 / 行业 / 均线 / 引擎 / 历史成分股开关，任一变化都要整段重算
+    """
+    spec = {
+        "universes": {u: sorted((m["symbol"], m.get("sector") or "") for m in c["members"]) for u, c in universes.items()},
+        "history": len(next(iter(universes.values())).get("history", [])) if BREADTH_POINT_IN_TIME else 0,
+        "windows": list(BREADTH_WINDOWS),
+        "engine": BREADTH_ENGINE,
+        "pit": BREADTH_POINT_IN_TIME,
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def refresh_breadth_history(history, closes_all, universes, first_changed=None):
+    """
+    只重算历史库里缺失或价格有变化的交易日，写回历史库；返回本次写入的交易日数。
+    每个交易日只依赖最近 N 天的收盘价，所以只需要往前多带 最长均线-1 天。
+    """
+    fingerprint = universe_fingerprint(universes)
+    stored_last = history.last_date() if history.get_meta("fingerprint") == fingerprint else None
+    index = closes_all.index
+
+    if stored_last is None:
+        start = index[0]
+    else:
+        start = index[index > stored_last][0] if (index > stored_last).any() else None
+        if first_changed is not None and (start is None or first_changed < start):
+            start = first_changed
+    if start is None:
+        print(f"🗄️ 广度历史库已是最新 ({stored_last.date()})")
+        return 0
+
+    pos = index.searchsorted(start)
+    lookback = max(BREADTH_WINDOWS) - 1
+    # 流式引擎自己维护增量状态 (需要完整价格库来判断修订)，其他引擎只算需要的尾部
+    if BREADTH_ENGINE == "streaming":
+        closes = closes_all
+    else:
+        closes = closes_all.iloc[max(0, pos - lookback):]
+    print(f"🗄️ 重算 {len(index) - pos} 个交易日 (自 {start.date()})，计算区间 {len(closes)} 天")
+
+    breadth = compute_breadth(closes, universes)
+    # 只保留均线窗口完整的日期 (价格库开头不足 N 天的日期没有意义)
+    pct = {}
+    for w, frame in breadth["pct"].items():
+        first_valid = index[w - 1] if len(index) >= w else None
+        keep = frame.index >= start
+        keep &= frame.index >= first_valid if first_valid is not None else False
+        pct[w] = frame[keep]
+
+    primary = next(iter(universes))
+    tickers = [m["symbol"] for m in universes[primary]["members"]]
+    part = closes_all.iloc[pos:]
+    coverage = pd.DataFrame({
+        "members": len(tickers),
+        "fetched": part.reindex(columns=tickers).notna().sum(axis=1),
+        "fallback": int(bool(universes[primary].get("fallback"))),
+    }, index=part.index)
+
+    written = history.write(pct, breadth["valid"], coverage)
+    history.set_meta("fingerprint", fingerprint)
+    print(f"🗄️ 广度历史库写入 {written} 行")
+    return len(part)
+
+# ==========================================
+# 🔵 模块 2: 市场广度 (Market Breadth)
+# ==========================================
+class BreadthChartRenderer:
+    """
+    可复用的广度图: Figure / 坐标轴 / 线条 / 标注只在第一次创建，之后每次只更新数据。
+    - 不经过 pyplot，不需要 plt.close，也不改全局样式
+    - 固定画布尺寸和边距，不做 bbox_inches='tight' 的二次排版
+    """
+    BG = '#2b2d31'
+
+    def __init__(self, figsize=(10, 5), dpi=100):
+        self.dpi = dpi
+        self.lock = threading.Lock()
+        with mpl_style.context('dark_background'):
+            self.fig = Figure(figsize=figsize, dpi=dpi, facecolor=self.BG)
+            self.canvas = FigureCanvasAgg(self.fig)
+            self.fig.subplots_adjust(left=0.06, right=0.98, top=0.9, bottom=0.08)
+            ax = self.ax = self.fig.add_subplot()
+
+            self.line_20, = ax.plot([], [], color='#f1c40f', linewidth=2, label='Stocks > 20 Day SMA %')
+            self.line_50, = ax.plot([], [], color='#e74c3c', linewidth=2, label='Stocks > 50 Day SMA %')
+            self.line_200, = ax.plot([], [], color='#3498db', linewidth=1.5, label='Stocks > 200 Day SMA %')
+            self.fill = None
+
+            ax.axhline(y=80, color='#ff5252', linestyle='--', linewidth=1, alpha=0.8)
+            self.text_ob = ax.text(0, 81, 'Overbought (80%)', color='#ff5252', fontsize=8)
+            ax.axhline(y=20, color='#448aff', linestyle='--', linewidth=1, alpha=0.8)
+            self.text_os = ax.text(0, 21, 'Oversold (20%)', color='#448aff', fontsize=8)
+
+            self.ann_20 = ax.annotate('', xy=(0, 0), xytext=(-10, 10), textcoords='offset points',
+                                      color='#f1c40f', fontsize=11, fontweight='bold', ha='right',
+                                      bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#f1c40f", alpha=0.8))
+            self.ann_50 = ax.annotate('', xy=(0, 0), xytext=(-10, -20), textcoords='offset points',
+                                      color='#e74c3c', fontsize=11, fontweight='bold', ha='right',
+                                      bbox=dict(boxstyle="round,pad=0.3", fc="#2f3136", ec="#e74c3c", alpha=0.8))
+
+            self.title = ax.set_title('', fontsize=12, color='white', pad=15)
+            ax.set_ylim(0, 100)
+            ax.grid(True, linestyle=':', alpha=0.3)
+            ax.xaxis_date()
+            ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %Y'))
+            self.legend = None
+
+    def update(self, breadth_20_series, breadth_50_series, breadth_200_series=None):
+        """
+        只替换线条数据、标注位置和标题
+        """
+        x = mdates.date2num(breadth_20_series.index.to_pydatetime())
+        y20 = breadth_20_series.to_numpy(dtype='float64')
+        y50 = breadth_50_series.to_numpy(dtype='float64')
+        ax = self.ax
+
+        self.line_20.set_data(x, y20)
+        self.line_50.set_data(x, y50)
+        has_200 = breadth_200_series is not None
+        self.line_200.set_visible(has_200)
+        if has_200:
+            self.line_200.set_data(mdates.date2num(breadth_200_series.index.to_pydatetime()),
+                                   breadth_200_series.to_numpy(dtype='float64'))
+
+        # 填充区域是 PolyCollection，没法原地改数据，只能换掉
+        if self.fill is not None: self.fill.remove()
+        self.fill = ax.fill_between(x, y20, alpha=0.1, color='#f1c40f')
+
+        self.text_ob.set_x(x[0])
+        self.text_os.set_x(x[0])
+        ax.set_xlim(left=x[0], right=x[-1])
+
+        self.ann_20.xy = (x[-1], y20[-1])
+        self.ann_20.set_text(f'{y20[-1]:.1f}%')
+        self.ann_50.xy = (x[-1], y50[-1])
+        self.ann_50.set_text(f'{y50[-1]:.1f}%')
+
+        title_windows = '20, 50 & 200' if has_200 else '20 & 50'
+        self.title.set_text(f'S&P 500 Market Breadth ({title_windows} Day SMA)')
+
+        # 图例跟着 200 日线显隐重建 (很便宜)
+        handles = [self.line_20, self.line_50] + ([self.line_200] if has_200 else [])
+        if self.legend is not None: self.legend.remove()
+        self.legend = ax.legend(handles=handles, loc='upper left', frameon=True,
+                                facecolor='#2f3136', edgecolor='#2f3136', labelcolor='white')
+
+    def encode(self, encoder=None, max_bytes=None):
+        """
+        渲染并编码为 PNG (BytesIO)。超过 max_bytes 时先退到调色板编码，再按比例缩小
+        """
+        encoder = encoder or CHART_PNG_ENCODER
+        max_bytes = max_bytes or CHART_MAX_BYTES
+
+        if encoder == "matplotlib":
+            buf = io.BytesIO()
+            self.canvas.print_png(buf)
+        else:
+            self.canvas.draw()
+            img = Image.frombuffer("RGBA", self.canvas.get_width_height(), self.canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+            buf = self._encode_pillow(img.convert("RGB"), encoder)
+
+        size = buf.getbuffer().nbytes
+        if size > max_bytes:
+            print(f"⚠️ 图表 {size/1024:.0f}KB 超过上限 {max_bytes/1024:.0f}KB，改用调色板编码")
+            self.canvas.draw()
+            img = Image.frombuffer("RGBA", self.canvas.get_width_height(), self.canvas.buffer_rgba(), "raw", "RGBA", 0, 1).convert("RGB")
+            buf = self._encode_pillow(img, "pillow-palette")
+            size = buf.getbuffer().nbytes
+            while size > max_bytes and min(img.size) > 100:
+                scale = max(0.5, (max_bytes / size) ** 0.5 * 0.95)
+                img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+                buf = self._encode_pillow(img, "pillow-palette")
+                size = buf.getbuffer().nbytes
+            if size > max_bytes:
+                raise ValueError(f"图表无法压缩到 {max_bytes} 字节以内 ({size})")
+
+        buf.seek(0)
+        return buf
+
+    @staticmethod
+    def _encode_pillow(img, encoder):
+        buf = io.BytesIO()
+        if encoder == "pillow-palette":
+            # 图里只有少数几种纯色，64 色调色板几乎无损
+            img.quantize(colors=64, method=Image.Quantize.MEDIANCUT).save(buf, format="PNG", optimize=True)
+        else:
+            img.save(buf, format="PNG", compress_level=1)
+        return buf
+
+    def render(self, breadth_20_series, breadth_50_series, breadth_200_series=None, encoder=None, max_bytes=None):
+        with self.lock:
+            self.update(breadth_20_series, breadth_50_series, breadth_200_series)
+            return self.encode(encoder, max_bytes)
+
+_BREADTH_RENDERER = None
+_BREADTH_RENDERER_LOCK = threading.Lock()
+
+def get_breadth_renderer():
+    global _BREADTH_RENDERER
+    with _BREADTH_RENDERER_LOCK:
+        if _BREADTH_RENDERER is None:
+            _BREADTH_RENDERER = BreadthChartRenderer()
+        return _BREADTH_RENDERER
+
+def generate_breadth_chart(breadth_20_series, breadth_50_series, breadth_200_series=None):
+    return get_breadth_renderer().render(breadth_20_series, breadth_50_series, breadth_200_series)
+
+SENTIMENT_LEVELS = (20, 40, 60, 80)
+SENTIMENT_LABELS = ("❄️❄️ **深度寒冷**", "❄️ **寒冷**", "🍃 **稳定**", "🔥 **火热**", "🔥🔥 **深度火热**")
+
+def get_sentiment_band(p):
+    """
+    情绪档位 0-4 (对应 SENTIMENT_LABELS)，边界和 get_market_sentiment 一致
+    """
+    if p > 80: return 4
+    if p > 60: return 3
+    if p < 20: return 0
+    if p < 40: return 1
+    return 2
+
+def get_market_sentiment(p):
+    return SENTIMENT_LABELS[get_sentiment_band(p)]
+
+def compute_breadth_pandas(closes_all, windows=BREADTH_WINDOWS, batch_size=100):
+    """
+    经典算法: 按批次做 pandas rolling，返回 {窗口: 百分比序列}
+    """
+    # 结果累加器
+    total_above = {w: None for w in windows}
+    total_stocks_count = None
+
+    total_batches = (closes_all.shape[1] + batch_size - 1) // batch_size
+    print(f"📦 共有 {closes_all.shape[1]} 只股票，分为 {total_batches} 批处理...")
+
+    for i in range(0, closes_all.shape[1], batch_size):
+        print(f"   🚀 处理第 {i//batch_size + 1}/{total_batches} 批...")
+        
+        try:
+            closes = closes_all.iloc[:, i:i + batch_size]
+
+            for w in windows:
+                # 计算均线
+                sma = closes.rolling(window=w).mean()
+                batch_sum = (closes > sma).sum(axis=1)
+                # 累加 (使用 add 自动对齐日期，fill_value=0 防止日期错位产生 NaN)
+                if total_above[w] is None: total_above[w] = batch_sum
+                else: total_above[w] = total_above[w].add(batch_sum, fill_value=0)
+                del sma
+
+            batch_count = closes.notna().sum(axis=1)
+            if total_stocks_count is None: total_stocks_count = batch_count
+            else: total_stocks_count = total_stocks_count.add(batch_count, fill_value=0)
+
+        except Exception as e:
+            print(f"⚠️ 批次跳过: {e}")
+        
+        # 内存清理
+        try: del closes
+        except: pass
+        gc.collect() 
+
+    print("🧮 合并计算中...")
+    total_stocks_count = total_stocks_count.replace(0, 1) 
+
+    # 排序索引，防止画图连线混乱
+    return {w: ((total_above[w] / total_stocks_count) * 100).sort_index() for w in windows}
+
+def compute_breadth(closes_all, universes):
+    """
+    universes: {指数: 成分股缓存}，第一个为主指数 (sp500)。
+    返回 {"pct": {窗口: DataFrame(交易日 × 分组)}, "valid": DataFrame(交易日 × 分组 有数据的股票数),
+          "labels": {分组: 显示名}}
+    - vectorized: 所有指数 + 主指数的各 GICS 行业，一次矩阵计算
+    - batch / streaming: 只算主指数
+    - 设置了 BREADTH_RSS_BUDGET_MB 时不管引擎设置，一律按块低内存计算 (结果同 vectorized)
+    - BREADTH_PROCESSES > 1 且股票够多时多进程分片计算 (结果同 vectorized)
+    """
+    primary = next(iter(universes))
+    primary_tickers = [m["symbol"] for m in universes[primary]["members"]]
+    labels = {u: UNIVERSE_SOURCES[u]["label"] for u in universes}
+
+    sharded = BREADTH_PROCESSES > 1 and closes_all.shape[1] >= BREADTH_SHARD_MIN_TICKERS
+    if BREADTH_ENGINE in ("batch", "streaming") and not (BREADTH_POINT_IN_TIME or BREADTH_RSS_BUDGET_MB or sharded):
+        closes = closes_all.reindex(columns=primary_tickers)
+        if BREADTH_ENGINE == "streaming":
+            series = compute_breadth_streaming(closes, primary_tickers)
+        else:
+            series = compute_breadth_pandas(closes)
+        pct = {w: pd.DataFrame({primary: s}) for w, s in series.items()}
+        valid = pd.DataFrame({primary: closes.notna().sum(axis=1)}).sort_index()
+        return {"pct": pct, "valid": valid, "labels": {primary: labels[primary]}}
+
+    # 分组: 各指数 + 主指数的行业
+    groups = {u: {m["symbol"] for m in cache["members"]} for u, cache in universes.items()}
+    # 行业分组只含当前成分股 (变动历史里没有被剔除股票的行业)
+    for m in universes[primary]["members"]:
+        if m.get("sector"):
+            key = f"sector:{m['sector']}"
+            groups.setdefault(key, set()).add(m["symbol"])
+            labels[key] = m["sector"]
+
+    tickers = list(closes_all.columns)
+    mask, masked_groups = None, None
+    if BREADTH_POINT_IN_TIME:
+        # 历史成分股口径: 只对主指数及其行业生效 (其他指数没有变动历史)
+        mask = membership_mask(universes[primary], tickers, closes_all.index)
+        # 主指数分组要包含掩码选得到的所有股票 (含已被剔除的)，否则剔除前的日子里它们不计数
+        groups[primary] |= {t for t, member in zip(tickers, mask.any(axis=0)) if member}
+        masked_groups = np.array([g == primary or g.startswith("sector:") for g in groups])
+
+    group_matrix = build_group_matrix(tickers, groups)
+
+    if BREADTH_RSS_BUDGET_MB:
+        print(f"🧮 低内存计算 {len(tickers)} 只股票 × {len(closes_all)} 天，{len(groups)} 个分组...")
+        above, valid = compute_breadth_lowmem(closes_all, BREADTH_WINDOWS, group_matrix, mask, masked_groups)
+    elif BREADTH_PROCESSES > 1 and len(tickers) >= BREADTH_SHARD_MIN_TICKERS:
+        print(f"🧮 {BREADTH_PROCESSES} 进程分片计算 {len(tickers)} 只股票 × {len(closes_all)} 天，{len(groups)} 个分组...")
+        above, valid = compute_breadth_sharded(closes_all, BREADTH_WINDOWS, group_matrix, mask, masked_groups)
+    else:
+        print(f"🧮 矩阵计算 {len(tickers)} 只股票 × {len(closes_all)} 天，{len(groups)} 个分组...")
+        above, valid = compute_breadth_grouped(
+            closes_all.to_numpy(dtype='float32'), BREADTH_WINDOWS, group_matrix, mask, masked_groups)
+    valid_counts = pd.DataFrame(valid, index=closes_all.index, columns=list(groups)).sort_index()
+    valid = np.where(valid == 0, 1, valid)
+    pct = {
+        w: pd.DataFrame(above[k] / valid * 100, index=closes_all.index, columns=list(groups)).sort_index()
+        for k, w in enumerate(BREADTH_WINDOWS)
+    }
+    return {"pct": pct, "valid": valid_counts, "labels": labels}
+
+_BREADTH_TASK_LOCK = threading.Lock()
+
+def run_breadth_task(publish=True):
+    """
+    publish=False: 只更新价格库和广度历史库，不出图不推送 (查询 API 发现数据过期时在后台调用)。
+    同一时间只跑一个；定时任务会等正在进行的后台更新跑完，后台更新遇到正在跑的任务直接放弃
+    """
+    if not _BREADTH_TASK_LOCK.acquire(blocking=publish):
+        print("⏭️ 广度任务正在运行，跳过本次后台更新")
+        return
+    try:
+        _run_breadth_task(publish)
+    finally:
+        _BREADTH_TASK_LOCK.release()
+        API_CACHE.invalidate("/breadth")
+        API_CACHE.invalidate("/chart.png")
+        _API_GROUPS["at"] = 0.0
+
+def _run_breadth_task(publish=True):
+    print("📊 启动市场广度统计 (极速省钱+对齐修复版)...")
     
     chart_buffer = None
     
     try:
-        # 1. 获取标普500列表
-        try:
-            url = 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies'
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            resp = requests.get(url, headers=headers, timeout=10)
-            tables = pd.read_html(io.StringIO(resp.text))
-            df_tickers = next((df for df in tables if 'Symbol' in df.columns), None)
-            tickers = [t.replace('.', '-') for t in df_tickers['Symbol'].tolist()] 
-        except:
-            print("⚠️ 无法获取完整列表，使用备选名单")
-            tickers = ['AAPL', 'MSFT', 'NVDA', 'AMZN', 'GOOGL', 'META', 'TSLA', 'BRK-B', 'LLY', 'AVGO']
+        provider = get_provider()
 
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        try:
-            if os.path.exists('yfinance.cache'): shutil.rmtree('yfinance.cache')
-        except: pass
+        # 1. 获取各指数成分股 (本地缓存 + 条件刷新)，主指数 (标普500) 排第一
+        with stage_timer("breadth.constituents"):
+            universes = {}
+            for u in ["sp500"] + [u for u in BREADTH_UNIVERSES if u != "sp500"]:
+                cache = get_constituents(u, provider)
+                if u != "sp500" and (cache.get("fallback") or not cache["members"]):
+                    print(f"⚠️ {UNIVERSE_SOURCES[u]['label']} 成分股不可用，本次跳过")
+                    continue
+                universes[u] = cache
+            constituents = universes["sp500"]
+            tickers = [m["symbol"] for m in constituents["members"]]
 
-        # 批次处理
-        batch_size = 100 
-        total_batches = (len(tickers) + batch_size - 1) // batch_size
-        print(f"📦 共有 {len(tickers)} 只股票，分为 {total_batches} 批处理...")
+            # 所有指数共用一次下载: 代码去重后取并集
+            fetch_tickers = list(dict.fromkeys(m["symbol"] for c in universes.values() for m in c["members"]))
+            if BREADTH_POINT_IN_TIME:
+                since = datetime.now() - timedelta(days=int(PRICE_STORE_MAX_DAYS * 1.45))
+                fetch_tickers = list(dict.fromkeys(fetch_tickers + point_in_time_universe(constituents, since)))
+            print(f"📋 {len(universes)} 个指数，去重后共 {len(fetch_tickers)} 只股票")
 
-        for i in range(0, len(tickers), batch_size):
-            batch_tickers = tickers[i:i + batch_size]
-            print(f"   🚀 处理第 {i//batch_size + 1}/{total_batches} 批...")
-            
-            try:
-                # auto_adjust=True, threads=True
-                df_batch = yf.download(batch_tickers, period="2y", auto_adjust=True, threads=True, progress=False)
-                
-                # 🛠️ 数据清洗与对齐
-                if isinstance(df_batch.columns, pd.MultiIndex):
-                    try: closes = df_batch['Close']
-                    except KeyError: 
-                        try: closes = df_batch['Adj Close']
-                        except: closes = df_batch
-                elif 'Close' in df_batch.columns:
-                    closes = df_batch['Close']
-                else:
-                    closes = df_batch
-
-                # 强制 float32
-                closes = closes.astype('float32')
+        # 2. 增量更新本地价格库 (只下载缺失的交易日)
+        with stage_timer("breadth.fetch"):
+            changes = {}
+            closes_all = update_price_store(fetch_tickers, fetch_fn=provider.get_closes, changes=changes)
+        if closes_all.empty:
+            raise RuntimeError("价格数据为空")
+        mapped = load_price_store(mmap=True) if BREADTH_RSS_BUDGET_MB else None
+        if mapped is not None:
+            # 低内存: 丢掉内存里的整表，后面直接从价格库 memmap 按块读
+            del closes_all
+            gc.collect()
+            closes_all = mapped
+        else:
+            if BREADTH_RSS_BUDGET_MB:
+                print("⚠️ 价格库无法映射 (可能写入失败)，改用内存里的收盘价")
+            closes_all = closes_all.reindex(columns=fetch_tickers)
+        report_memory("breadth.fetch")
 
-                # 计算均线
-                sma20 = closes.rolling(window=20).mean()
-                sma50 = closes.rolling(window=50).mean()
-                
-                is_above_20 = (closes > sma20)
-                is_above_50 = (closes > sma50)
-                is_valid = closes.notna() 
-                
-                # ⚠️ 【关键修复】确保索引是 DatetimeIndex 并且时区一致
-                # 有些时候 yfinance 返回的索引可能带时区，也可能不带，导致相加报错
-                if closes.index.tz is not None:
-                    # 统一移除时区信息，只保留日期
-                    is_above_20.index = is_above_20.index.tz_localize(None)
-                    is_above_50.index = is_above_50.index.tz_localize(None)
-                    is_valid.index = is_valid.index.tz_localize(None)
-
-                batch_sum_20 = is_above_20.sum(axis=1)
-                batch_sum_50 = is_above_50.sum(axis=1)
-                batch_count = is_valid.sum(axis=1)
-                
-                # 累加 (使用 add 自动对齐日期)
-                if total_above_20 is None:
-                    total_above_20 = batch_sum_20
-                    total_above_50 = batch_sum_50
-                    total_stocks_count = batch_count
-                else:
-                    # fill_value=0 非常重要，防止日期错位产生 NaN
-                    total_above_20 = total_above_20.add(batch_sum_20, fill_value=0)
-                    total_above_50 = total_above_50.add(batch_sum_50, fill_value=0)
-                    total_stocks_count = total_stocks_count.add(batch_count, fill_value=0)
+        # 覆盖率: 最新交易日真正有收盘价的 (当前) 标普成分股 / 应有股票
+        fetched_count = int(closes_all.iloc[-1].reindex(tickers).notna().sum())
+        coverage = fetched_count / len(tickers)
+        print(f"📶 样本覆盖率: {fetched_count}/{len(tickers)} ({coverage:.1%})")
+        if coverage < BREADTH_ABORT_COVERAGE:
+            raise RuntimeError(f"样本覆盖率过低 ({coverage:.1%})，放弃发布")
+        coverage_note = ""
+        if coverage < BREADTH_MIN_COVERAGE:
+            coverage_note = f"\n\n⚠️ **样本不完整:** 仅 {fetched_count}/{len(tickers)} 只股票有最新数据"
+        if constituents.get("fallback"):
+            coverage_note += "\n\n⚠️ **成分股列表获取失败，当前为备选名单，不代表标普500整体**"
+        expected = CALENDAR.last_closed_session()
+        if closes_all.index[-1].date() < expected:
+            coverage_note += f"\n\n⚠️ **数据未更新:** 最新收盘价是 {closes_all.index[-1]:%Y-%m-%d}，应为 {expected:%Y-%m-%d}"
 
-            except Exception as e:
-                print(f"⚠️ 批次跳过: {e}")
-            
-            # 内存清理
-            del df_batch
-            try: del closes; del sma20; del sma50
-            except: pass
-            gc.collect() 
-            
-        # 3. 计算最终百分比
-        print("🧮 合并计算中...")
-        total_stocks_count = total_stocks_count.replace(0, 1) 
-        
-        daily_breadth_20 = (total_above_20 / total_stocks_count) * 100
-        daily_breadth_50 = (total_above_50 / total_stocks_count) * 100
+        # 3. 计算广度: 只重算历史库里缺失 / 价格有变化的交易日 (所有指数 + 行业一次算完)
+        history = BreadthHistory()
+        with stage_timer("breadth.compute"):
+            run_cpu(refresh_breadth_history, history, closes_all, universes, changes.get("first_changed"))
+        del closes_all
+        if not publish:
+            print("✅ 广度历史库已更新 (不推送)")
+            return
 
-        # 排序索引，防止画图连线混乱
-        daily_breadth_20 = daily_breadth_20.sort_index()
-        daily_breadth_50 = daily_breadth_50.sort_index()
+        # 同一交易日的数值在容差内 (比如重启后的自检、休市日重跑) 就不再出图和推送
+        latest_date, latest = history.latest()
+        values = {"date": f"{latest_date:%Y-%m-%d}"}
+        values.update({f"{g}:{w}": round(p, 4) for g, wp in latest.items() for w, p in wp.items()})
+        changed, reason = STATE.changed("breadth", values, tolerance=BREADTH_CHANGE_TOLERANCE)
+        if not changed:
+            print(f"⏭️ 广度无实质变化 ({reason})，跳过出图和推送")
+            return
 
-        # 4. 生成图表
-        chart_buffer = generate_breadth_chart(daily_breadth_20.tail(252), daily_breadth_50.tail(252))
-        
-        current_p20 = daily_breadth_20.iloc[-1]
-        current_p50 = daily_breadth_50.iloc[-1]
-        
-        sentiment_20 = get_market_sentiment(current_p20)
-        sentiment_50 = get_market_sentiment(current_p50)
+        # 4. 图表和摘要都直接读历史库 (只画标普500；200 日线不足一年时不画)
+        with stage_timer("breadth.render"):
+            sp = {w: history.series("sp500", w, 252) for w in BREADTH_WINDOWS}
+            s200 = sp[200] if len(sp[200]) >= 252 else None
+            chart_buffer = run_cpu(generate_breadth_chart, sp[20], sp[50], s200)
+        API_CACHE.put("/chart.png", chart_buffer.getvalue(), "image/png")
+
+        current = {w: latest["sp500"][w] for w in BREADTH_WINDOWS}
+        description = f"**Date:** `{datetime.now().strftime('%Y-%m-%d')}`\n\n"
+        description += "\n\n".join(
+            f"**Stocks > SMA{w}:** **{current[w]:.1f}%**\n{get_market_sentiment(current[w])}"
+            for w in BREADTH_WINDOWS
+        )
+        description += coverage_note
+
+        # 其他指数: 一行一个指数
+        fields = []
+        for u in universes:
+            if u == "sp500" or u not in latest: continue
+            line = " | ".join(f"SMA{w} **{latest[u][w]:.1f}%**" for w in BREADTH_WINDOWS)
+            fields.append({"name": UNIVERSE_SOURCES[u]["label"], "value": line, "inline": False})
+
+        # 标普500行业: 按 SMA50 比例从高到低
+        sectors = {f"sector:{m['sector']}" for m in constituents["members"] if m.get("sector")}
+        sector_pct = {g[len("sector:"):]: v[BREADTH_SECTOR_WINDOW] for g, v in latest.items() if g in sectors}
+        if sector_pct:
+            lines = [f"`{p:5.1f}%` {name}" for name, p in sorted(sector_pct.items(), key=lambda kv: -kv[1])]
+            fields.append({"name": f"S&P 500 Sectors > SMA{BREADTH_SECTOR_WINDOW}", "value": "\n".join(lines), "inline": False})
 
         # 5. 推送
         payload_data = {
@@ -476,22 +3246,21 @@ def run_breadth_task():
             "avatar_url": BREADTH_BOT_AVATAR,
             "embeds": [{
                 "title": "S&P 500 Market Breadth", # 标题改英文防止乱码
-                "description": f"**Date:** `{datetime.now().strftime('%Y-%m-%d')}`\n\n"
-                               f"**Stocks > SMA20:** **{current_p20:.1f}%**\n"
-                               f"{sentiment_20}\n\n"
-                               f"**Stocks > SMA50:** **{current_p50:.1f}%**\n"
-                               f"{sentiment_50}",
+                "description": description,
                 "color": 0xF1C40F,
+                "fields": fields,
                 "image": {"url": "attachment://chart.png"},
                 "footer": {
-                    "text": f"S&P 500 stocks above 20/50 day moving average.\n(Sample size: {len(tickers)})"
+                    "text": f"Stocks above {'/'.join(str(w) for w in BREADTH_WINDOWS)} day moving average.\n(S&P 500 sample size: {fetched_count}/{len(tickers)})"
                 }
             }]
         }
         
         files = {'file': ('chart.png', chart_buffer, 'image/png')}
-        requests.post(WEBHOOK_URL, data={'payload_json': json.dumps(payload_data)}, files=files)
-        print(f"✅ 广度报告已推送")
+        with stage_timer("breadth.post"):
+            post_webhook(payload_data, files=files, urls=BREADTH_WEBHOOK_URLS)
+        STATE.published("breadth", values)
+        print(f"✅ 广度报告已加入推送队列")
 
     except Exception as e:
         print(f"❌ 广度任务异常: {e}")
@@ -503,9 +3272,213 @@ def run_breadth_task():
         if chart_buffer:
             try: chart_buffer.close()
             except: pass
-        try: del total_above_20; del total_above_50; del daily_breadth_20;
+        try: del sp
         except: pass
         gc.collect()
+        report_memory("breadth")
+
+# ==========================================
+# ⚡ 盘中实时广度 (Intraday Breadth)
+# ==========================================
+
+class IntradayBreadth:
+    """
+    盘中实时广度: 截至昨收的均线状态常驻内存，每次刷新只拉一份最新价快照。
+    把现价当作今天的收盘价: SMA_w = (前 w-1 日收盘之和 + 现价) / w，
+    现价 > SMA_w  ⇔  现价 > 前 w-1 日收盘均值，所以每条均线只需预先算好一个 "门槛价"，
+    刷新就是一次向量比较。
+    """
+
+    def __init__(self, windows=INTRADAY_WINDOWS):
+        self.windows = tuple(windows)
+        self.session_date = None
+        self.tickers = []
+        self.thresholds = None   # 窗口 × 股票 (float64)，历史不足的为 NaN
+        self.bands = {}          # 最近一次推送 (或昨收) 的情绪档位
+        self.baseline = {}       # 昨收广度
+
+    def prepare(self, closes, tickers, session_date, baseline=None):
+        """
+        closes: 价格库 (日期 × 股票)，只用 session_date 之前的交易日
+        """
+        session_date = pd.Timestamp(session_date).normalize()
+        closes = closes.reindex(columns=tickers)
+        closes = closes[closes.index < session_date]
+        if closes.empty:
+            # 状态保持不变，下一轮重新准备
+            raise RuntimeError(f"价格库为空: {session_date:%Y-%m-%d} 之前没有可用的收盘价")
+        tail = closes.iloc[-(max(self.windows) - 1):].to_numpy(dtype='float64')
+        self.thresholds = np.full((len(self.windows), len(tickers)), np.nan)
+        for k, w in enumerate(self.windows):
+            prior = tail[-(w - 1):]
+            if len(prior) == w - 1:
+                # 和 rolling(w) 一样: 窗口里有缺失就不算均线
+                self.thresholds[k] = prior.mean(axis=0)
+        self.tickers = list(tickers)
+        self.session_date = session_date
+        self.baseline = dict(baseline or {})
+        self.bands = {w: get_sentiment_band(p) for w, p in self.baseline.items()}
+        return closes.index[-1]
+
+    def evaluate(self, prices):
+        """
+        prices: Series (股票 → 现价)。返回 ({窗口: 百分比}, 有现价的股票数)
+        口径和收盘广度一致: 分母是有价格的股票，均线不足的算 "未站上"
+        """
+        p = prices.reindex(self.tickers).to_numpy(dtype='float64')
+        has_price = ~np.isnan(p)
+        valid = int(has_price.sum())
+        with np.errstate(invalid='ignore'):
+            above = (p[None, :] > self.thresholds) & has_price[None, :]
+        pct = {w: float(above[k].sum()) / max(valid, 1) * 100 for k, w in enumerate(self.windows)}
+        return pct, valid
+
+    def crossings(self, pct, hysteresis=INTRADAY_BAND_HYSTERESIS):
+        """
+        相对上次记录的档位，哪些均线跨过了档位 (需越过边界至少 hysteresis 个百分点)。
+        返回 {窗口: (旧档位, 新档位)}，同时更新记录；第一次 (没有昨收基准) 只记录不推送
+        """
+        crossed = {}
+        for w, p in pct.items():
+            band = get_sentiment_band(p)
+            old = self.bands.get(w)
+            if old is None:
+                self.bands[w] = band
+                continue
+            if band == old: continue
+            edge = SENTIMENT_LEVELS[band - 1] if band > old else SENTIMENT_LEVELS[band]
+            if abs(p - edge) < hysteresis: continue
+            crossed[w] = (old, band)
+            self.bands[w] = band
+        return crossed
+
+_INTRADAY = IntradayBreadth()
+# 快照单独一个线程: 上一次卡住的请求不会占用 I/O 执行器，新一轮排在它后面直接超时跳过
+_SNAPSHOT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+def fetch_last_prices(provider, tickers, timeout=None):
+    """
+    盘中快照: 整个股票池一次批量请求，不限速排队、不重试、不逐只补抓 (下一轮马上又会刷新)。
+    返回 Series (股票 → 现价)；失败或超时抛异常，由调用方跳过这一轮
+    """
+    timeout = timeout or INTRADAY_SNAPSHOT_TIMEOUT
+    future = _SNAPSHOT_EXECUTOR.submit(provider.get_last_prices, list(tickers), timeout)
+    try:
+        frame = future.result(timeout=timeout)
+    except FuturesTimeout:
+        future.cancel()
+        raise RuntimeError(f"快照请求超过 {timeout}s")
+    if frame is None or frame.empty:
+        raise RuntimeError("快照为空")
+    return frame.ffill().iloc[-1]
+
+def _prepare_intraday(state, provider, session_date):
+    """
+    每天第一次刷新时从价格库建好均线门槛 (昨收广度从历史库取，作为档位基准)
+    """
+    with stage_timer("breadth.intraday.prepare"):
+        constituents = get_constituents("sp500", provider)
+        tickers = [m["symbol"] for m in constituents["members"]]
+        closes = load_price_store(mmap=True)
+        if closes is None or closes.empty:
+            raise RuntimeError("本地价格库为空，先跑一次收盘广度任务")
+        baseline = {}
+        history = BreadthHistory()
+        date, latest = history.latest()
+        last_close = closes.index[closes.index < session_date]
+        if date is not None and len(last_close) and date == last_close[-1] and "sp500" in latest:
+            baseline = {w: latest["sp500"][w] for w in state.windows if w in latest["sp500"]}
+        as_of = state.prepare(closes, tickers, session_date, baseline)
+        del closes
+    # 重启后接着用当天已推送过的档位，不重复推送同一次跨档
+    saved = STATE.get("breadth_intraday")
+    if saved.get("date") == f"{session_date:%Y-%m-%d}":
+        state.bands.update({int(w): band for w, band in saved.get("bands", {}).items()})
+    print(f"⚡ 盘中广度状态已就绪: {len(tickers)} 只股票，均线截至 {as_of:%Y-%m-%d}")
+    expected = CALENDAR.previous_session(session_date)
+    if as_of.date() < expected:
+        print(f"⚠️ 价格库落后: 最新收盘价是 {as_of:%Y-%m-%d}，应为 {expected:%Y-%m-%d}")
+
+def run_intraday_breadth_task(state=None):
+    """
+    盘中刷新一次: 最新价快照 → 重算 SMA20/50 广度 → 跨过情绪档位 (20/40/60/80) 才推送
+    """
+    state = state or _INTRADAY
+    try:
+        now = datetime.now(ET)
+        if not CALENDAR.is_open(now):
+            print("⏸️ 当前不在交易时段 (休市或已提前收盘)，跳过盘中广度")
+            return None
+        provider = get_provider()
+        session_date = pd.Timestamp(now.date())
+        if state.session_date != session_date:
+            _prepare_intraday(state, provider, session_date)
+
+        try:
+            with stage_timer("breadth.intraday.snapshot", tickers=len(state.tickers)):
+                prices = fetch_last_prices(provider, state.tickers)
+        except Exception as e:
+            print(f"⏭️ 盘中快照失败，跳过这一轮: {e}")
+            return None
+
+        pct, valid = state.evaluate(prices)
+        coverage = valid / len(state.tickers)
+        print("⚡ 盘中广度: " + " | ".join(f"SMA{w} {p:.1f}%" for w, p in pct.items()) + f" (样本 {valid}/{len(state.tickers)})")
+        if coverage < BREADTH_ABORT_COVERAGE:
+            raise RuntimeError(f"样本覆盖率过低 ({coverage:.1%})，不判断档位")
+
+        crossed = state.crossings(pct)
+        if not crossed:
+            return pct
+
+        lines = []
+        for w, p in pct.items():
+            line = f"**Stocks > SMA{w}:** **{p:.1f}%**"
+            if w in state.baseline:
+                line += f" (昨收 {state.baseline[w]:.1f}%)"
+            if w in crossed:
+                old, new = crossed[w]
+                arrow = "⬆️" if new > old else "⬇️"
+                line += f"\n{arrow} {SENTIMENT_LABELS[old]} → {SENTIMENT_LABELS[new]}"
+            else:
+                line += f"\n{get_market_sentiment(p)}"
+            lines.append(line)
+
+        payload_data = {
+            "username": BREADTH_BOT_NAME,
+            "avatar_url": BREADTH_BOT_AVATAR,
+            "embeds": [{
+                "title": "S&P 500 Intraday Breadth",
+                "description": f"**Time:** `{now.strftime('%Y-%m-%d %H:%M')} ET`\n\n" + "\n\n".join(lines),
+                "color": 0x3498DB,
+                "footer": {
+                    "text": f"Live price treated as today's close. (S&P 500 sample size: {valid}/{len(state.tickers)})"
+                }
+            }]
+        }
+        with stage_timer("breadth.intraday.post"):
+            post_webhook(payload_data, urls=BREADTH_WEBHOOK_URLS)
+        STATE.published("breadth_intraday", {f"SMA{w}": round(p, 2) for w, p in pct.items()},
+                        date=f"{session_date:%Y-%m-%d}", bands=state.bands)
+        print(f"✅ 盘中广度跨档 ({', '.join(f'SMA{w}' for w in crossed)})，已加入推送队列")
+        return pct
+
+    except Exception as e:
+        print(f"❌ 盘中广度异常: {e}")
+        return None
+
+def intraday_times(start=None, end=None, interval=None):
+    """
+    开盘时段内每隔 interval 分钟一个触发点 ("HH:MM" 列表)
+    """
+    start = datetime.strptime(start or INTRADAY_START, "%H:%M")
+    end = datetime.strptime(end or INTRADAY_END, "%H:%M")
+    step = timedelta(minutes=max(1, interval or INTRADAY_INTERVAL_MINUTES))
+    times = []
+    while start <= end:
+        times.append(start.strftime("%H:%M"))
+        start += step
+    return times
 
 # ==========================================
 # 🛠️ 辅助函数: 计算排名变化
@@ -530,30 +3503,200 @@ def calculate_rank_change(current_rank, old_rank):
 # 🔴 模块 3: Reddit 热度榜 (完整修复+完美对齐版)
 # ==========================================
 
-def get_apewisdom_data():
+def get_apewisdom_data(max_pages=None):
     """
-    使用 ApeWisdom API 获取 Reddit (WSB/Stocks) 热门股票
+    使用 ApeWisdom API 获取 Reddit (WSB/Stocks) 热门股票 (按排名排序的完整列表)。
+    先取第 1 页拿到总页数，其余页并发抓取 (最多 max_pages 页)
     """
+    max_pages = max_pages or REDDIT_MAX_PAGES
     print("📡 正在从 ApeWisdom 获取数据...")
-    url = "https://apewisdom.io/api/v1.0/filter/all-stocks/page/1"
     
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers, timeout=20)
-        
-        if response.status_code == 200:
-            data = response.json()
-            results = data.get('results', [])
-            return results[:30] # Top 30
-        else:
-            print(f"⚠️ ApeWisdom API 错误: {response.status_code}")
+        provider = get_provider()
+        data = provider.get_apewisdom_page(1)
+        if data is None:
             return None
+        results = list(data.get('results', []))
+
+        pages = min(int(data.get('pages') or 1), max_pages)
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=REDDIT_FETCH_WORKERS) as pool:
+                def fetch_page(page):
+                    with stage_timer("reddit.fetch_page", quiet=True, page=page):
+                        return provider.get_apewisdom_page(page)
+                futures = [pool.submit(fetch_page, page) for page in range(2, pages + 1)]
+                for future in futures:
+                    try:
+                        page_data = future.result()
+                    except Exception as e:
+                        print(f"⚠️ ApeWisdom 分页失败: {e}")
+                        continue
+                    if page_data:
+                        results.extend(page_data.get('results', []))
+            print(f"📡 共 {pages} 页，{len(results)} 只股票")
+
+        return sorted(results, key=lambda item: int(item.get('rank') or 10**6))
     except Exception as e:
         print(f"❌ 获取 ApeWisdom 数据失败: {e}")
         return None
 
+class RedditHistory:
+    """
+    Reddit 提及数 / 排名的本地时间序列 (股票 × 采样点):
+    - mentions: int32，没上榜记 0
+    - rank: int16，没上榜记 0
+    - times: int64 采样时间 (Unix 秒)
+    """
+
+    def __init__(self, tickers=None, times=None, mentions=None, rank=None, path=None):
+        self.path = path or REDDIT_HISTORY_PATH
+        self.tickers = list(tickers or [])
+        self.times = np.asarray(times if times is not None else [], dtype='int64')
+        self.mentions = mentions if mentions is not None else np.zeros((0, 0), dtype='int32')
+        self.rank = rank if rank is not None else np.zeros((0, 0), dtype='int16')
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or REDDIT_HISTORY_PATH
+        if not os.path.exists(path):
+            return cls(path=path)
+        try:
+            with np.load(path) as data:
+                return cls(
+                    tickers=[str(t) for t in data["tickers"]],
+                    times=data["times"],
+                    mentions=data["mentions"].astype('int32'),
+                    rank=data["rank"].astype('int16'),
+                    path=path,
+                )
+        except Exception as e:
+            print(f"⚠️ 读取 Reddit 历史失败: {e}")
+            return cls(path=path)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, tickers=np.array(self.tickers, dtype='U'), times=self.times,
+                     mentions=self.mentions, rank=self.rank)
+        os.replace(tmp_path, self.path)
+
+    def append(self, ts, results):
+        """
+        追加一个采样点 (一次完整的榜单)。距离上一次太近时覆盖上一次，避免重复采样
+        """
+        ts = int(ts)
+        new = [str(r.get('ticker')) for r in results if r.get('ticker') and str(r.get('ticker')) not in self._index()]
+        if new:
+            self.tickers.extend(dict.fromkeys(new))
+            pad = len(self.tickers) - self.mentions.shape[0]
+            self.mentions = np.vstack([self.mentions, np.zeros((pad, self.mentions.shape[1]), dtype='int32')])
+            self.rank = np.vstack([self.rank, np.zeros((pad, self.rank.shape[1]), dtype='int16')])
+
+        if len(self.times) and ts - self.times[-1] < REDDIT_SAMPLE_MIN_GAP:
+            self.times[-1] = ts
+        else:
+            self.times = np.append(self.times, ts)
+            self.mentions = np.hstack([self.mentions, np.zeros((len(self.tickers), 1), dtype='int32')])
+            self.rank = np.hstack([self.rank, np.zeros((len(self.tickers), 1), dtype='int16')])
+
+        index = self._index()
+        rows = np.array([index[str(r['ticker'])] for r in results if r.get('ticker')], dtype='int64')
+        mentions = np.array([int(r.get('mentions') or 0) for r in results if r.get('ticker')], dtype='int32')
+        ranks = np.array([min(int(r.get('rank') or 0), 32767) for r in results if r.get('ticker')], dtype='int16')
+        self.mentions[:, -1] = 0
+        self.rank[:, -1] = 0
+        self.mentions[rows, -1] = mentions
+        self.rank[rows, -1] = ranks
+
+        # 只保留最近的采样点；整段窗口都没上过榜的股票删掉
+        if len(self.times) > REDDIT_HISTORY_MAX_SAMPLES:
+            self.times = self.times[-REDDIT_HISTORY_MAX_SAMPLES:]
+            self.mentions = self.mentions[:, -REDDIT_HISTORY_MAX_SAMPLES:]
+            self.rank = self.rank[:, -REDDIT_HISTORY_MAX_SAMPLES:]
+            alive = self.rank.any(axis=1)
+            if not alive.all():
+                self.tickers = [t for t, keep in zip(self.tickers, alive) if keep]
+                self.mentions = self.mentions[alive]
+                self.rank = self.rank[alive]
+        self._cached_index = None
+
+    def _index(self):
+        if getattr(self, "_cached_index", None) is None or len(self._cached_index) != len(self.tickers):
+            self._cached_index = {t: i for i, t in enumerate(self.tickers)}
+        return self._cached_index
+
+def reddit_momentum(history):
+    """
+    对所有股票一次性 (向量化) 计算热度动量，返回 DataFrame (index=股票):
+    - mentions / rank: 最新值
+    - velocity: 和 REDDIT_VELOCITY_HOURS 小时前 (最近一个不晚于那一刻的采样点) 相比的提及增量；
+      历史不足时和最早的采样点比
+    - zscore: 最新提及数相对前 REDDIT_ZSCORE_SAMPLES 个采样点的 z 分数
+    - streak: 提及数连续上升的采样点个数
+    """
+    m = history.mentions.astype('float32')
+    samples = m.shape[1]
+    if samples == 0:
+        return pd.DataFrame(columns=["mentions", "rank", "velocity", "zscore", "streak"])
+
+    latest = m[:, -1]
+    # 报告当天会额外多一个采样点，所以按时间戳找基准点，而不是往回数固定个数
+    cutoff = history.times[-1] - REDDIT_VELOCITY_HOURS * 3600
+    lag_idx = max(int(np.searchsorted(history.times, cutoff, side='right')) - 1, 0)
+    velocity = latest - m[:, lag_idx] if samples > 1 else np.zeros_like(latest)
+
+    base = m[:, max(0, samples - 1 - REDDIT_ZSCORE_SAMPLES):-1]
+    if base.shape[1] >= 2:
+        mean = base.mean(axis=1)
+        std = np.maximum(base.std(axis=1), 1.0)  # 长期为 0 的冷门股防止除零放大
+        zscore = (latest - mean) / std
+    else:
+        zscore = np.zeros_like(latest)
+
+    # 末尾连续上升的长度: 反转后累乘，遇到第一个 False 之后全是 0
+    rising = m[:, 1:] > m[:, :-1]
+    streak = np.cumprod(rising[:, ::-1], axis=1).sum(axis=1) if samples > 1 else np.zeros(len(latest), dtype='int64')
+
+    return pd.DataFrame({
+        "mentions": history.mentions[:, -1],
+        "rank": history.rank[:, -1],
+        "velocity": velocity.astype('int32'),
+        "zscore": zscore.astype('float32'),
+        "streak": streak.astype('int32'),
+    }, index=history.tickers)
+
+def record_reddit_sample(results, history=None):
+    """
+    把一次完整榜单写入历史并落盘，返回更新后的 RedditHistory
+    """
+    history = history or RedditHistory.load()
+    history.append(time.time(), results)
+    try:
+        history.save()
+    except Exception as e:
+        print(f"⚠️ Reddit 历史保存失败: {e}")
+    return history
+
+def sample_reddit_mentions():
+    """
+    定时采样任务: 只记录，不推送
+    """
+    with stage_timer("reddit.sample"):
+        results = get_apewisdom_data()
+        if not results:
+            return
+        history = record_reddit_sample(results)
+    print(f"🗃️ Reddit 采样完成: {len(results)} 只股票，历史 {len(history.times)} 个采样点")
+
+def reddit_spikes(momentum, min_samples_ok):
+    """
+    挑出热度异动: z 分数超过阈值且提及数够多，按 z 分数从高到低
+    """
+    if not min_samples_ok or momentum.empty:
+        return momentum.iloc[0:0]
+    hot = momentum[(momentum["zscore"] >= REDDIT_SPIKE_Z) & (momentum["mentions"] >= REDDIT_SPIKE_MIN_MENTIONS)]
+    return hot.sort_values("zscore", ascending=False).head(REDDIT_SPIKE_TOP)
+
 def calculate_rank_change(current_rank, old_rank):
     """
     计算排名变化图标
@@ -566,12 +3709,10 @@ def calculate_rank_change(current_rank, old_rank):
     elif diff < 0: return f"🔻{abs(diff)}"
     else: return "➖"
 
-def run_reddit_task():
-    # 1. 获取数据
-    data = get_apewisdom_data()
-    if not data:
-        return
-
+def build_reddit_payload(data, spikes=None):
+    """
+    data: 榜单前 30；spikes: reddit_spikes 的结果 (可为空)
+    """
     desc_lines = []
     
     for item in data:
@@ -598,37 +3739,545 @@ def run_reddit_task():
         desc_lines.append(line)
 
     date_str = datetime.now().strftime('%m月%d日') 
-    
-    payload = {
+
+    embed = {
+        "title": f"Reddit 24H 热度榜（{date_str}）",
+        "description": "\n".join(desc_lines),
+        "color": 0xFF4500, 
+    }
+
+    # 6. 热度异动: 提及数相对过去一周的 z 分数 / 24 小时增量 / 连续上升
+    if spikes is not None and not spikes.empty:
+        lines = []
+        for row in spikes.itertuples():
+            streak = f"，连升 {row.streak} 次" if row.streak >= 2 else ""
+            lines.append(f"**${row.Index}** 提及 `{row.mentions}` (24h {row.velocity:+d}，z={row.zscore:.1f}{streak})")
+        embed["fields"] = [{"name": "📈 热度异动", "value": "\n".join(lines), "inline": False}]
+
+    return {
         "username": "散户买什么？", 
         "avatar_url": "https://i.imgur.com/iXlOzKP.png", 
-        "embeds": [{
-            "title": f"Reddit 24H 热度榜（{date_str}）",
-            "description": "\n".join(desc_lines),
-            "color": 0xFF4500, 
-        }]
+        "embeds": [embed]
     }
+
+def run_reddit_task():
+    # 1. 获取数据 (完整榜单顺便记一次采样)
+    with stage_timer("reddit.fetch"):
+        results = get_apewisdom_data()
+    if not results:
+        return
+
+    spikes = None
+    try:
+        with stage_timer("reddit.analyze"):
+            history = record_reddit_sample(results)
+            momentum = reddit_momentum(history)
+            spikes = reddit_spikes(momentum, len(history.times) >= REDDIT_MIN_SAMPLES)
+    except Exception as e:
+        print(f"⚠️ Reddit 动量计算失败: {e}")
+    API_CACHE.put("/reddit", reddit_api_body(results, spikes))
+
+    # 关键数值: 前 10 名的排名顺序和提及数 + 异动名单；都没实质变化就不再推送
+    top = results[:REDDIT_CHANGE_TOP]
+    values = {"top": [item.get('ticker') for item in top]}
+    values.update({f"mentions:{item.get('ticker')}": item.get('mentions', 0) for item in top})
+    if spikes is not None and len(spikes):
+        values["spikes"] = sorted(spikes.index)
+    changed, reason = STATE.changed("reddit", values, rel_tolerance=REDDIT_CHANGE_TOLERANCE)
+    if not changed:
+        print(f"⏭️ Reddit 热度榜无实质变化 ({reason})，跳过推送")
+        return
+
+    payload = build_reddit_payload(results[:30], spikes) # Top 30
     
     try:
-        requests.post(WEBHOOK_URL, json=payload)
-        print("✅ ApeWisdom Top30 推送成功 (数字独立高亮版)")
+        with stage_timer("reddit.post"):
+            post_webhook(payload, urls=REDDIT_WEBHOOK_URLS)
+        STATE.published("reddit", values)
+        print("✅ ApeWisdom Top30 已加入推送队列 (数字独立高亮版)")
     except Exception as e:
         print(f"❌ 推送失败: {e}")
         
     gc.collect()
 # ==========================================
-# 🚀 主程序
+# ⏰ 调度器 (Scheduler)
 # ==========================================
-if __name__ == "__main__":
-    print("🚀 监控服务已启动")
-    
-    # --- 启动自检 (测试模式) ---
-    print("-------------- 系统自检 --------------")
-    
+
+def _parse_job_time(spec):
+    """
+    "HH:MM" → (None, time)；"close+00:30" / "open-00:15" → ("close" / "open", timedelta)
+    """
+    m = re.fullmatch(r"(open|close)([+-])(\d{1,2}):(\d{2})", spec.strip())
+    if m:
+        offset = timedelta(hours=int(m.group(3)), minutes=int(m.group(4)))
+        return m.group(1), offset if m.group(2) == "+" else -offset
+    return None, datetime.strptime(spec.strip(), "%H:%M").time()
+
+class Job:
+    """
+    定时任务: 在每个交易日的若干时间点 (美东 HH:MM，或相对开盘 / 收盘) 触发
+    """
+
+    def __init__(self, name, times, fn, trading_days_only=True):
+        self.name = name
+        self.times = list(times)
+        self.specs = [_parse_job_time(t) for t in times]
+        self.fn = fn
+        self.trading_days_only = trading_days_only
+        self.running = False
+        self.stats = {
+            "runs": 0, "failures": 0, "skipped_overlap": 0, "missed": 0,
+            "last_jitter_s": None, "max_jitter_s": 0.0,
+            "last_duration_s": None, "total_duration_s": 0.0,
+            "last_fire": None,
+        }
+
+    def times_on(self, day, calendar=None):
+        """
+        当天的触发时刻 (有序)；相对开盘 / 收盘的时间在非交易日不触发
+        """
+        calendar = calendar or CALENDAR
+        times = []
+        for anchor, value in self.specs:
+            if anchor is None:
+                times.append(value)
+                continue
+            hours = calendar.session_hours(day)
+            if hours:
+                base = datetime.combine(day, hours[0] if anchor == "open" else hours[1])
+                times.append((base + value).time())
+        return sorted(times)
+
+class Scheduler:
+    """
+    基于 asyncio 的事件驱动调度:
+    - 根据 (缓存的) 交易日历算出每个任务的下一次触发时间，睡到那一刻
+    - 任务交给 I/O 执行器并发运行 (CPU 密集的步骤在任务内部再交给 CPU 执行器)，
+      同一分钟触发的多个任务总耗时 ≈ 最慢的那个，而不是相加
+    - 同一个任务上一次还没跑完则跳过 (防重叠)
+    - 醒晚了但在宽限期内仍补跑，超出宽限期记为错过
+    - 每个任务记录触发延迟 (jitter) 和耗时
+    """
+
+    def __init__(self, jobs, grace=SCHEDULER_MISFIRE_GRACE, now_fn=None, executor=None, calendar=None):
+        self.jobs = list(jobs)
+        self.calendar = calendar or CALENDAR
+        self.grace = grace
+        self.now_fn = now_fn or (lambda: datetime.now(ET))
+        self.executor = executor or IO_EXECUTOR
+        self.loop = None
+        self.wake = None
+        self.tasks = set()
+        self.stopped = False
+
+    def next_fire(self, job, after):
+        """
+        job 在 after 之后 (不含) 的下一次触发时间 (带时区)
+        """
+        day = after.astimezone(ET).date()
+        for _ in range(30):
+            if job.trading_days_only and not self.calendar.is_session(day):
+                # 直接跳到下一个交易日
+                day = self.calendar.next_session(day)
+                continue
+            for t in job.times_on(day, self.calendar):
+                candidate = ET.localize(datetime.combine(day, t))
+                if candidate > after:
+                    return candidate
+            day += timedelta(days=1)
+        return None
+
+    async def _run_job(self, job, fire_at):
+        start = self.now_fn()
+        jitter = (start - fire_at).total_seconds()
+        job.stats["last_jitter_s"] = jitter
+        job.stats["max_jitter_s"] = max(job.stats["max_jitter_s"], jitter)
+        job.stats["last_fire"] = fire_at.isoformat()
+        print(f"🔔 触发 {job.name} ({fire_at.strftime('%H:%M')} ET, 延迟 {jitter:.1f}s)")
+        t0 = time.perf_counter()
+        try:
+            await self.loop.run_in_executor(self.executor, job.fn)
+        except Exception as e:
+            job.stats["failures"] += 1
+            print(f"⚠️ 任务 {job.name} 异常: {e}")
+        finally:
+            duration = time.perf_counter() - t0
+            job.stats["runs"] += 1
+            job.stats["last_duration_s"] = duration
+            job.stats["total_duration_s"] += duration
+            job.running = False
+            print(f"🏁 {job.name} 完成，用时 {duration:.1f}s")
+
+    def dispatch(self, job, fire_at):
+        if job.running:
+            job.stats["skipped_overlap"] += 1
+            print(f"⏭️ {job.name} 上一次还在运行，跳过本次 ({fire_at.strftime('%H:%M')})")
+            return
+        job.running = True
+        task = self.loop.create_task(self._run_job(job, fire_at))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def stats(self):
+        return {job.name: dict(job.stats, running=job.running) for job in self.jobs}
+
+    def stop(self):
+        self.stopped = True
+        if self.loop and self.wake:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        # 从 "现在 - 宽限期" 开始算，刚重启时能补上几分钟前错过的任务
+        start = self.now_fn() - timedelta(seconds=self.grace)
+        pending = {job: self.next_fire(job, start) for job in self.jobs}
+        announced = None
+
+        while not self.stopped:
+            upcoming = [(t, job) for job, t in pending.items() if t is not None]
+            if not upcoming:
+                print("⚠️ 没有可调度的任务")
+                break
+            fire_at, job = min(upcoming, key=lambda x: x[0])
+            now = self.now_fn()
+            wait_s = (fire_at - now).total_seconds()
+
+            if wait_s > 0:
+                if announced != (job.name, fire_at):
+                    announced = (job.name, fire_at)
+                    print(f"💤 下一个任务: {job.name} @ {fire_at.strftime('%Y-%m-%d %H:%M')} ET (还有 {wait_s / 60:.1f} 分钟)")
+                # 分段睡眠 (最多 10 分钟)，防止系统挂起 / 时钟跳变后睡过头
+                await self._sleep(min(wait_s, 600))
+                continue
+
+            lateness = -wait_s
+            if lateness > self.grace:
+                job.stats["missed"] += 1
+                print(f"⚠️ 错过 {job.name} @ {fire_at.strftime('%H:%M')} (晚了 {lateness:.0f}s)")
+            else:
+                self.dispatch(job, fire_at)
+            pending[job] = self.next_fire(job, fire_at)
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def run_forever(self):
+        asyncio.run(self.serve())
+
+def run_fed_task():
+    data = get_fed_data()
+    if data:
+        API_CACHE.put("/fed", fed_api_body(data))
+        send_fed_embed(data)
+
+def build_scheduler():
+    jobs = []
+    if ENABLE_FED_BOT:
+        jobs.append(Job("FedWatch", FED_SCHEDULE_TIMES, run_fed_task))
+    else:
+        print("⏸️ FedBot 禁用，不加入调度")
+    jobs.append(Job("市场广度", [BREADTH_SCHEDULE_TIME], run_breadth_task))
+    if INTRADAY_BREADTH:
+        jobs.append(Job("盘中广度", intraday_times(), run_intraday_breadth_task))
+    jobs.append(Job("Reddit 热度榜", [REDDIT_SCHEDULE_TIME], run_reddit_task))
+    jobs.append(Job("Reddit 采样", REDDIT_SAMPLE_TIMES, sample_reddit_mentions, trading_days_only=False))
+    return Scheduler(jobs)
+
+# ==========================================
+# 🌐 查询 API (HTTP / JSON)
+# ==========================================
+
+class ApiCache:
+    """
+    查询 API 的内存缓存: 路径 → {响应体, ETag, 类型, 生成时间}
+    - 没过期直接返回；过期才调用 loader 重新生成
+    - 同一路径同时只有一个请求在重算 (single-flight)；其他请求手里有旧数据就先拿旧的，没有才等
+    - loader 出错时继续用旧数据
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.key_locks = {}
+
+    def put(self, key, body, content_type="application/json; charset=utf-8"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        entry = {"body": body, "etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"', "type": content_type, "at": time.time()}
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def invalidate(self, prefix):
+        # 只标记过期，旧数据留着在重算期间继续服务
+        with self.lock:
+            for key, entry in self.entries.items():
+                if key.startswith(prefix):
+                    entry["at"] = 0
+
+    def ages(self):
+        now = time.time()
+        with self.lock:
+            return {key: round(now - entry["at"], 1) if entry["at"] else None for key, entry in self.entries.items()}
+
+    def get(self, key, loader, max_age):
+        with self.lock:
+            entry = self.entries.get(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        if entry and time.time() - entry["at"] < max_age:
+            return entry
+        if not key_lock.acquire(blocking=entry is None):
+            return entry
+        current = entry
+        try:
+            with self.lock:
+                current = self.entries.get(key)
+            if current and time.time() - current["at"] < max_age:
+                return current
+            with stage_timer("api.load", quiet=True, key=key):
+                result = loader()
+            if result is None:
+                return current
+            return self.put(key, *result)
+        except Exception as e:
+            print(f"⚠️ API 数据生成失败 ({key}): {e}")
+            return current
+        finally:
+            key_lock.release()
+
+API_CACHE = ApiCache()
+_API_RECOMPUTE = {"at": 0.0}
+_API_STARTED = time.time()
+
+def _maybe_recompute_breadth(last_date):
+    """
+    历史库落后于最近一个已收盘 (且过了结算时间) 的交易日时，后台更新一次 (不推送，有冷却时间)
+    """
+    settled = datetime.now(ET) - timedelta(minutes=API_BREADTH_SETTLE_MINUTES)
+    expected = CALENDAR.last_closed_session(settled)
+    if last_date is not None and last_date.date() >= expected: return
+    if time.time() - _API_RECOMPUTE["at"] < API_RECOMPUTE_COOLDOWN: return
+    _API_RECOMPUTE["at"] = time.time()
+    if last_date is None:
+        print("🔄 广度历史库为空，后台更新...")
+    else:
+        print(f"🔄 广度数据过期 (最新 {last_date:%Y-%m-%d}，应为 {expected:%Y-%m-%d})，后台更新...")
+    IO_EXECUTOR.submit(run_breadth_task, False)
+
+def _load_breadth_api(group, days):
+    history = BreadthHistory()
+    date, latest = history.latest()
+    _maybe_recompute_breadth(date)
+    if date is None: return None
+    series = pd.DataFrame({f"SMA{w}": history.series(group, w, days) for w in BREADTH_WINDOWS}).sort_index()
+    body = {
+        "date": f"{date:%Y-%m-%d}",
+        "group": group,
+        "latest": latest,
+        "coverage": history.coverage(date),
+        "series": {
+            "dates": [f"{d:%Y-%m-%d}" for d in series.index],
+            **{col: [None if pd.isna(v) else round(float(v), 4) for v in series[col]] for col in series.columns},
+        },
+    }
+    return body, "application/json; charset=utf-8"
+
+def _load_chart_api():
+    history = BreadthHistory()
+    date, _ = history.latest()
+    _maybe_recompute_breadth(date)
+    if date is None: return None
+    sp = {w: history.series("sp500", w, 252) for w in BREADTH_WINDOWS}
+    s200 = sp[200] if len(sp[200]) >= 252 else None
+    return run_cpu(generate_breadth_chart, sp[20], sp[50], s200).getvalue(), "image/png"
+
+def fed_api_body(data):
+    return {"updated": datetime.now(ET).isoformat(timespec="seconds"), **data}
+
+def _load_fed_api():
+    if not ENABLE_FED_BOT: return None
+    data = get_fed_data()
+    return (fed_api_body(data), "application/json; charset=utf-8") if data else None
+
+def reddit_api_body(results, spikes=None, top=100):
+    fields = ("rank", "ticker", "name", "mentions", "upvotes", "rank_24h_ago", "mentions_24h_ago")
+    return {
+        "updated": datetime.now(ET).isoformat(timespec="seconds"),
+        "results": [{k: item.get(k) for k in fields} for item in results[:top]],
+        "spikes": [] if spikes is None else [
+            {"ticker": row.Index, "mentions": int(row.mentions), "velocity": float(row.velocity), "zscore": float(row.zscore)}
+            for row in spikes.itertuples()
+        ],
+    }
+
+def _load_reddit_api():
+    results = get_apewisdom_data()
+    if not results: return None
+    spikes = None
+    try:
+        history = RedditHistory.load()
+        spikes = reddit_spikes(reddit_momentum(history), len(history.times) >= REDDIT_MIN_SAMPLES)
+    except Exception as e:
+        print(f"⚠️ Reddit 动量计算失败: {e}")
+    return reddit_api_body(results, spikes), "application/json; charset=utf-8"
+
+def api_health():
+    date = BreadthHistory().last_date()
+    return {
+        "status": "ok",
+        "uptime_s": round(time.time() - _API_STARTED, 1),
+        "breadth_date": f"{date:%Y-%m-%d}" if date is not None else None,
+        "last_closed_session": f"{CALENDAR.last_closed_session():%Y-%m-%d}",
+        "cache_age_s": API_CACHE.ages(),
+        "startup_s": STARTUP_TIMINGS,
+        "imports_s": IMPORT_TIMINGS,
+        "jobs": SCHEDULER.stats() if SCHEDULER is not None else {},
+    }
+
+_API_GROUPS = {"at": 0.0, "groups": set()}
+
+def _api_known_groups():
+    """
+    广度任务写进历史库的行业分组，缓存 API_CACHE_TTL 秒；广度任务跑完后立即失效
+    """
+    if time.time() - _API_GROUPS["at"] >= API_CACHE_TTL:
+        _API_GROUPS["groups"] = BreadthHistory().groups()
+        _API_GROUPS["at"] = time.time()
+    return _API_GROUPS["groups"]
+
+def _api_breadth_route(params):
+    """
+    参数不合法时抛 ValueError (回 400)，防止任意 group 把缓存撑爆
+    """
+    group = params.get("group", ["sp500"])[0]
+    # 配置里的指数总是合法 (历史库为空时照样走到 _load_breadth_api，回 503 并触发后台更新)；行业只认历史库里有的
+    if group not in UNIVERSE_SOURCES and group not in _api_known_groups():
+        raise ValueError(f"Unknown group: {group}")
+    try: days = int(params.get("days", ["252"])[0])
+    except ValueError: days = 252
+    days = min(max(days, 1), PRICE_STORE_MAX_DAYS)
+    return API_CACHE.get(f"/breadth?group={group}&days={days}", lambda: _load_breadth_api(group, days), API_CACHE_TTL)
+
+# 路径 → (取缓存的函数, 客户端可缓存秒数)
+API_ROUTES = {
+    "/breadth": (_api_breadth_route, API_CACHE_TTL),
+    "/chart.png": (lambda params: API_CACHE.get("/chart.png", _load_chart_api, API_CACHE_TTL), API_CACHE_TTL),
+    "/fed": (lambda params: API_CACHE.get("/fed", _load_fed_api, API_FED_MAX_AGE), API_FED_MAX_AGE),
+    "/reddit": (lambda params: API_CACHE.get("/reddit", _load_reddit_api, API_REDDIT_MAX_AGE), API_REDDIT_MAX_AGE),
+}
+
+class ApiHandler(MetricsHandler):
+    """
+    查询 API: 全部从 ApiCache 返回，带 ETag；客户端带 If-None-Match 且没变化时回 304 (无响应体)
+    """
+    PATHS = ["/breadth", "/fed", "/reddit", "/chart.png", "/health", "/metrics"]
+    protocol_version = "HTTP/1.1"   # 长连接，仪表盘高频轮询时不用每次握手
+    disable_nagle_algorithm = True  # 头和响应体分两次写，长连接下不关 Nagle 会等 40ms 延迟确认
+
+    def _send(self, status, body=b"", content_type="application/json; charset=utf-8", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/metrics":
+            return super().do_GET()
+        if path == "/health":
+            body = json.dumps(api_health(), ensure_ascii=False, default=str).encode("utf-8")
+            return self._send(200, body, headers={"Cache-Control": "no-store"})
+        if path not in API_ROUTES:
+            return self.send_error(404)
+
+        route, max_age = API_ROUTES[path]
+        try:
+            with stage_timer("api.request", quiet=True, path=path):
+                entry = route(parse_qs(query))
+        except ValueError as e:
+            return self.send_error(400, str(e).encode("latin-1", "replace").decode("latin-1"))
+        if entry is None:
+            return self.send_error(503, "No data yet")
+        headers = {"ETag": entry["etag"], "Cache-Control": f"max-age={max_age}"}
+        inm = self.headers.get("If-None-Match", "")
+        if inm.strip() == "*" or entry["etag"] in [tag.strip() for tag in inm.split(",")]:
+            return self._send(304, headers=headers)
+        self._send(200, entry["body"], entry["type"], headers)
+
+# ==========================================
+# 🩺 启动自检 (Self Test)
+# ==========================================
+
+def run_health_check():
+    """
+    轻量自检: 只看本地文件 / 配置，不联网，也不导入 pandas 等重依赖。返回 [(项目, 是否正常, 说明)]
+    """
+    checks = []
+    expected = CALENDAR.last_closed_session()
+    checks.append(("交易日历", True, f"最近收盘日 {expected:%Y-%m-%d}，下一交易日 {CALENDAR.next_session(datetime.now(ET)):%Y-%m-%d}"))
+
+    closes_path = os.path.join(PRICE_STORE_DIR, "closes.npy")
+    if os.path.exists(closes_path):
+        age_h = (time.time() - os.path.getmtime(closes_path)) / 3600
+        checks.append(("价格库", True, f"{os.path.getsize(closes_path) / 1024 / 1024:.1f}MB，{age_h:.1f} 小时前更新"))
+    else:
+        checks.append(("价格库", False, "不存在，第一次广度任务会完整下载"))
+
+    if not os.path.exists(BREADTH_HISTORY_PATH):
+        checks.append(("广度历史", False, "不存在，第一次广度任务会建库"))
+    else:
+        # 只读打开: 自检不建表、不留下空库文件
+        try:
+            conn = sqlite3.connect(f"file:{BREADTH_HISTORY_PATH}?mode=ro", uri=True)
+            try:
+                row = conn.execute("SELECT MAX(date) FROM breadth").fetchone()
+            finally:
+                conn.close()
+            last = row[0] if row else None
+            if last:
+                fresh = last >= f"{expected:%Y-%m-%d}"
+                checks.append(("广度历史", fresh, f"最新 {last}" + ("" if fresh else f"，落后于 {expected:%Y-%m-%d}")))
+            else:
+                checks.append(("广度历史", False, "为空"))
+        except Exception as e:
+            checks.append(("广度历史", False, f"读取失败: {e}"))
+
+    published = {job: entry.get("published_at") for job, entry in STATE.data.items()}
+    checks.append(("发布状态", True, ", ".join(f"{job} @ {at}" for job, at in published.items()) or "还没有推送记录"))
+
+    configured = bool(WEBHOOK_URL or FED_WEBHOOK_URLS or BREADTH_WEBHOOK_URLS or REDDIT_WEBHOOK_URLS)
+    checks.append(("Webhook", configured, f"待推送 {OUTBOX.pending()} 条" if configured else "未配置 WEBHOOK_URL"))
+
+    if ENABLE_FED_BOT and FED_FETCH_MODE != "http":
+        ok = os.path.exists("/usr/bin/chromedriver")
+        checks.append(("Chromium", ok, "chromedriver 就绪" if ok else "找不到 /usr/bin/chromedriver，只能走 HTTP"))
+    return checks
+
+def run_self_test(mode):
+    if mode == "off":
+        print("⏸️ 启动自检已关闭 (SELF_TEST=off)")
+        return
+    print(f"-------------- 系统自检 ({mode}) --------------")
+    if mode == "health":
+        for name, ok, detail in run_health_check():
+            print(f"{'✅' if ok else '⚠️'} {name}: {detail}")
+        return
+
     if ENABLE_FED_BOT:
         print("🧪 [测试] FedWatch...")
-        fed_data = get_fed_data()
-        if fed_data: send_fed_embed(fed_data)
+        run_fed_task()
     else:
         print("⏸️ [测试] FedWatch 已禁用")
 
@@ -637,53 +4286,56 @@ if __name__ == "__main__":
     
     print("🧪 [测试] Reddit 热度榜...")
     run_reddit_task()
+
+def print_startup_report():
+    print("⏱️ 启动耗时:")
+    for phase, seconds in STARTUP_TIMINGS.items():
+        print(f"   {phase:<24} {seconds * 1000:9.1f} ms")
+    if IMPORT_TIMINGS:
+        print("   已加载的重依赖 (首次使用时导入):")
+        for name, seconds in sorted(IMPORT_TIMINGS.items(), key=lambda kv: -kv[1]):
+            print(f"     {name:<32} {seconds * 1000:9.1f} ms")
+
+# 模块加载 (轻量导入 + 全局对象初始化) 到这里结束
+STARTUP_TIMINGS = {"module_load": time.perf_counter() - _IMPORT_T0}
+
+# ==========================================
+# 🚀 主程序
+# ==========================================
+if __name__ == "__main__":
+    print("🚀 监控服务已启动")
+    OUTBOX.start()
+    t0 = time.perf_counter()
+    if API_PORT:
+        start_metrics_server(API_PORT, ApiHandler)
+    if METRICS_PORT and METRICS_PORT != API_PORT:
+        start_metrics_server()
+    STARTUP_TIMINGS["http_servers"] = time.perf_counter() - t0
+
+    # --once 用来做离线回放 / 基准测试，总是完整跑一遍
+    t0 = time.perf_counter()
+    run_self_test("full" if "--once" in sys.argv else SELF_TEST)
+    STARTUP_TIMINGS["self_test"] = time.perf_counter() - t0
     
+    if "--once" in sys.argv:
+        # 只跑一遍 (配合 DATA_PROVIDER=fixture 做离线回放 / 基准测试)
+        OUTBOX.flush()
+        print("✅ 单次运行结束，各阶段耗时:")
+        print(f"   {'阶段':<24} {'次数':>4} {'墙钟':>9} {'CPU':>9} {'下行':>9}")
+        for name, agg in TRACER.aggregates.items():
+            print(f"   {name:<24} {agg['count']:>4} {agg['wall_s']:8.3f}s {agg['cpu_s']:8.3f}s {agg['bytes_in'] / 1024:7.1f}KB")
+        if _FIXTURE_SERVER:
+            print(f"   webhook 收到 {len(_FIXTURE_SERVER.posts)} 次推送")
+        print_startup_report()
+        sys.exit(0)
+
     print("✅ 自检结束，进入定时监听模式...")
     print("--------------------------------------")
 
-    last_run_time_str = ""
-    
-    while True:
-        try:
-            tz = pytz.timezone('US/Eastern')
-            now_et = datetime.now(tz)
-            current_str = now_et.strftime("%H:%M")
-            is_holiday, holiday_name = is_market_holiday(now_et)
-
-            if current_str != last_run_time_str:
-                print(f"⏰ {current_str} ET (Market Open: {not is_holiday})")
-                
-                # 只有在非假期/非周末时才推送
-                if not is_holiday:
-                    # 1. FedWatch
-                    if current_str in FED_SCHEDULE_TIMES:
-                        if ENABLE_FED_BOT:
-                            print(f"🔔 触发 FedWatch: {current_str}")
-                            data = get_fed_data()
-                            if data: send_fed_embed(data)
-                        else:
-                            print(f"⏸️ 时间到，但 FedBot 禁用")
-                    
-                    # 2. Market Breadth
-                    if current_str == BREADTH_SCHEDULE_TIME:
-                        print(f"🔔 触发 市场广度: {current_str}")
-                        run_breadth_task()
-                        
-                    # 3. Reddit Trending (新增)
-                    if current_str == REDDIT_SCHEDULE_TIME:
-                        print(f"🔔 触发 Reddit 热度榜: {current_str}")
-                        run_reddit_task()
-                        
-                else:
-                    # 假期/周末时，只打印心跳
-                    all_times = FED_SCHEDULE_TIMES + [BREADTH_SCHEDULE_TIME, REDDIT_SCHEDULE_TIME]
-                    if current_str in all_times:
-                        print(f"😴 今日休市 ({holiday_name})，跳过推送")
-
-                last_run_time_str = current_str
-        
-        except Exception as e:
-            print(f"⚠️ 主循环报错: {e}")
-            time.sleep(5)
-            
-        time.sleep(30)
+    scheduler = SCHEDULER = build_scheduler()
+    STARTUP_TIMINGS["ready"] = time.perf_counter() - _IMPORT_T0
+    print_startup_report()
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()